@@ -0,0 +1,514 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This module is a local stand-in for the parts of the ArcGIS API for Python that the scripts use, so they can be
+    benchmarked without an organization. Layers are backed by pandas DataFrames, every call that would send a request
+    is counted and can be delayed by a fixed latency, and the geometry service operations are done with shapely.
+"""
+import collections
+import math
+import os
+import re
+import threading
+import time
+import uuid
+import numpy
+import pandas
+from shapely.geometry import Point
+from shapely.ops import unary_union
+from geometry_utils import contains_xy, rings_to_shapely, shapely_to_rings
+
+EARTH_RADIUS = 6378137.0
+# Timestamp literals in where clauses, with or without the timestamp keyword
+TIMESTAMP_LITERAL = re.compile(r"(?:\btimestamp\s*)?'(\d{4}-\d{2}-\d{2}(?: \d{2}:\d{2}:\d{2}(?:\.\d+)?)?)'", re.IGNORECASE)
+IN_LIST = re.compile(r"\bIN\s*\(((?:'[^']*'|[^()'])*)\)", re.IGNORECASE)
+STRING_LITERAL = re.compile(r"('(?:[^']|'')*')")
+STATISTIC_FUNCTIONS = {"count": "count", "min": "min", "max": "max", "sum": "sum", "avg": "mean", "stddev": "std", "var": "var"}
+
+
+class PropertyMap(dict):
+    """
+    A dict that also allows attribute access, like the properties of items and layers in the ArcGIS API for Python
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class RequestLog(object):
+    """
+    Counts the requests sent to the fake services and delays each of them by a fixed latency
+    """
+
+    def __init__(self, latency=0):
+        """
+        :param latency: (float) The number of seconds each request takes
+        """
+        self.latency = latency
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def request(self, name, count=1):
+        """
+        Records requests. The latency is simulated outside of any lock, so concurrent requests overlap like they would with a server
+        :param name: (string) The name of the operation
+        :param count: (int) The number of requests, for example the number of pages fetched by a query returning all records
+        """
+        with self._lock:
+            self.counts[name] += count
+        if self.latency:
+            time.sleep(self.latency * count)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+
+class Feature(object):
+    def __init__(self, attributes, geometry=None):
+        self.attributes = attributes
+        self.geometry = geometry
+
+
+class FeatureSet(object):
+    def __init__(self, features, exceeded_transfer_limit=False):
+        self.features = features
+        self.exceeded_transfer_limit = exceeded_transfer_limit
+
+    def __len__(self):
+        return len(self.features)
+
+
+def to_epoch_ms(text):
+    """
+    Converts a UTC date string to epoch milliseconds
+    """
+    return int(pandas.Timestamp(text).value // 1000000)
+
+
+def where_to_expression(where):
+    """
+    Translates the SQL where clauses used by the scripts to a pandas expression. Supports comparisons, IN lists,
+    AND/OR/NOT, and timestamp literals, which are compared as epoch milliseconds
+    :param where: (string) The where clause
+    :return: (string) The expression for DataFrame.eval
+    """
+    expression = TIMESTAMP_LITERAL.sub(lambda match: str(to_epoch_ms(match.group(1))), where or "1=1")
+    expression = IN_LIST.sub(lambda match: f" in [{match.group(1)}]", expression)
+    parts = STRING_LITERAL.split(expression)
+    # the even parts are outside of string literals
+    for index in range(0, len(parts), 2):
+        part = parts[index].replace("<>", "!=")
+        part = re.sub(r"(?<![<>!=])=(?!=)", "==", part)
+        for keyword in ("and", "or", "not"):
+            part = re.sub(rf"\b{keyword}\b", keyword, part, flags=re.IGNORECASE)
+        parts[index] = part
+    for index in range(1, len(parts), 2):
+        parts[index] = repr(parts[index][1:-1].replace("''", "'"))
+    return "".join(parts)
+
+
+def to_wgs84(xs, ys):
+    longitudes = numpy.degrees(xs / EARTH_RADIUS)
+    latitudes = numpy.degrees(2 * numpy.arctan(numpy.exp(ys / EARTH_RADIUS)) - numpy.pi / 2)
+    return longitudes, latitudes
+
+
+def get_wkid(sr):
+    if isinstance(sr, dict):
+        return sr.get("latestWkid") or sr.get("wkid")
+    return sr
+
+
+def normalize_global_id(global_id):
+    return str(global_id).strip("{}").lower()
+
+
+class FakeFeatureLayer(object):
+    """
+    A feature layer backed by a DataFrame. Point layers have x and y columns and polygon layers a rings column,
+    in Web Mercator. Date fields are stored as epoch milliseconds
+    """
+
+    def __init__(self, requests, url, data, fields, geometry_type="esriGeometryPoint", max_record_count=2000):
+        """
+        :param requests: (RequestLog) The log to record the requests in
+        :param url: (string) The url of the layer
+        :param data: (DataFrame) The features
+        :param fields: (list) The fields of the layer, as {"name", "type"} dicts
+        :param geometry_type: (string) esriGeometryPoint or esriGeometryPolygon
+        :param max_record_count: (int) The maximum number of features returned per request
+        """
+        self.requests = requests
+        self.url = url
+        self.data = data.reset_index(drop=True)
+        self.properties = PropertyMap({
+            "fields": [PropertyMap(field) for field in fields],
+            "objectIdField": next(field["name"] for field in fields if field["type"] == "esriFieldTypeOID"),
+            "globalIdField": next((field["name"] for field in fields if field["type"] == "esriFieldTypeGlobalID"), None),
+            "maxRecordCount": max_record_count,
+            "geometryType": geometry_type,
+        })
+        self._lock = threading.Lock()
+        self._version = 0
+        self._cache = None
+
+    @property
+    def _lyr_json(self):
+        return dict(self.properties)
+
+    @property
+    def _date_fields(self):
+        return [field["name"] for field in self.properties.fields if field["type"] == "esriFieldTypeDate"]
+
+    @property
+    def _field_names(self):
+        return [field["name"] for field in self.properties.fields]
+
+    def _select(self, where, geometry_filter=None, order_by_fields=None):
+        """
+        Finds the positions of the rows matching a query. The result of the last query is cached, so paging through
+        the results of a query evaluates it only once
+        """
+        key = (where, repr(geometry_filter), order_by_fields, self._version)
+        cache = self._cache
+        if cache is not None and cache[0] == key:
+            return cache[1]
+        data = self.data
+        mask = numpy.broadcast_to(numpy.asarray(data.eval(where_to_expression(where), engine="python")), (len(data),)).copy()
+        if geometry_filter:
+            mask &= self._geometry_mask(geometry_filter["geometry"], data)
+        positions = numpy.flatnonzero(mask)
+        if order_by_fields:
+            columns, ascending = [], []
+            for clause in order_by_fields.split(","):
+                field, _, direction = clause.strip().partition(" ")
+                columns.append(field)
+                ascending.append(direction.strip().upper() != "DESC")
+            positions = positions[numpy.asarray(data.iloc[positions].reset_index(drop=True).sort_values(columns, ascending=ascending, kind="mergesort").index)]
+        self._cache = (key, positions)
+        return positions
+
+    def _geometry_mask(self, geometry, data):
+        if self.properties.geometryType != "esriGeometryPoint":
+            raise NotImplementedError("Geometry filters are only supported for point layers")
+        xs, ys = data["x"].values, data["y"].values
+        if "xmin" in geometry:
+            return (xs >= geometry["xmin"]) & (xs <= geometry["xmax"]) & (ys >= geometry["ymin"]) & (ys <= geometry["ymax"])
+        if not geometry.get("rings"):
+            return numpy.zeros(len(xs), dtype=bool)
+        return contains_xy(rings_to_shapely(geometry["rings"]), xs, ys)
+
+    def _geometries(self, rows, out_sr):
+        if self.properties.geometryType == "esriGeometryPolygon":
+            return [{"rings": rings, "spatialReference": {"wkid": 3857}} for rings in rows["rings"]]
+        xs, ys = rows["x"].values, rows["y"].values
+        wkid = get_wkid(out_sr) or 3857
+        if wkid == 4326:
+            xs, ys = to_wgs84(xs, ys)
+        return [{"x": x, "y": y, "spatialReference": {"wkid": wkid}} for x, y in zip(xs.tolist(), ys.tolist())]
+
+    def query(self, where="1=1", out_fields="*", out_sr=None, geometry_filter=None, return_count_only=False, return_ids_only=False,
+              return_extent_only=False, out_statistics=None, group_by_fields_for_statistics=None, order_by_fields=None,
+              result_offset=None, result_record_count=None, return_all_records=True, as_df=False, **kwargs):
+        """
+        Queries the layer, like FeatureLayer.query. A query returning all records is counted as one request per page.
+        Like the real API, the offset and record count are ignored unless return_all_records is False, and like a real
+        server, a page never has more than maxRecordCount features and sets exceeded_transfer_limit when more remain
+        """
+        with self._lock:
+            positions = self._select(where, geometry_filter, order_by_fields)
+        if return_count_only:
+            self.requests.request("query")
+            return len(positions)
+        if return_ids_only:
+            self.requests.request("query")
+            return {"objectIdFieldName": self.properties.objectIdField,
+                    "objectIds": self.data[self.properties.objectIdField].values[positions].tolist()}
+        if return_extent_only:
+            self.requests.request("query")
+            rows = self.data.iloc[positions]
+            return {"extent": {"xmin": rows["x"].min(), "ymin": rows["y"].min(), "xmax": rows["x"].max(), "ymax": rows["y"].max(),
+                               "spatialReference": {"wkid": 3857}}}
+        if out_statistics:
+            self.requests.request("query")
+            return self._statistics(self.data.iloc[positions], out_statistics, group_by_fields_for_statistics)
+        exceeded_transfer_limit = False
+        if not return_all_records and result_record_count is not None:
+            offset = result_offset or 0
+            end = offset + min(result_record_count, self.properties.maxRecordCount)
+            exceeded_transfer_limit = end < len(positions)
+            positions = positions[offset:end]
+            self.requests.request("query")
+        else:
+            self.requests.request("query", max(1, math.ceil(len(positions) / self.properties.maxRecordCount)))
+        rows = self.data.iloc[positions]
+        field_names = self._field_names if out_fields == "*" else [field.strip() for field in out_fields.split(",")]
+        if as_df:
+            return self._to_dataframe(rows, field_names)
+        records = rows[field_names].to_dict("records")
+        return FeatureSet([Feature(attributes, geometry) for attributes, geometry in zip(records, self._geometries(rows, out_sr))],
+                          exceeded_transfer_limit)
+
+    def _to_dataframe(self, rows, field_names):
+        from arcgis.geometry import Geometry
+        df = rows[field_names].reset_index(drop=True)
+        for field in self._date_fields:
+            if field in df.columns:
+                df[field] = pandas.to_datetime(df[field], unit="ms")
+        df["SHAPE"] = [Geometry(geometry) for geometry in self._geometries(rows, 3857)]
+        return df
+
+    def _statistics(self, rows, out_statistics, group_by_fields_for_statistics):
+        groups = [field.strip() for field in group_by_fields_for_statistics.split(",")] if group_by_fields_for_statistics else []
+        if groups:
+            grouped = rows.groupby(groups)
+            result = pandas.DataFrame({statistic["outStatisticFieldName"]: grouped[statistic["onStatisticField"]].agg(
+                STATISTIC_FUNCTIONS[statistic["statisticType"].lower()]) for statistic in out_statistics}).reset_index()
+            records = result.to_dict("records")
+        else:
+            record = {}
+            for statistic in out_statistics:
+                function = STATISTIC_FUNCTIONS[statistic["statisticType"].lower()]
+                value = rows[statistic["onStatisticField"]].agg(function) if len(rows) or function == "count" else None
+                record[statistic["outStatisticFieldName"]] = value.item() if hasattr(value, "item") else value
+            records = [record]
+        return FeatureSet([Feature({name: value.item() if hasattr(value, "item") else value for name, value in record.items()}) for record in records])
+
+    def _to_rows(self, features):
+        rows = []
+        for feature in features:
+            attributes = feature.attributes if hasattr(feature, "attributes") else feature["attributes"]
+            geometry = feature.geometry if hasattr(feature, "geometry") else feature.get("geometry")
+            row = {name: value for name, value in attributes.items() if name in self._field_names}
+            if geometry:
+                if self.properties.geometryType == "esriGeometryPolygon":
+                    row["rings"] = geometry["rings"]
+                else:
+                    row["x"], row["y"] = geometry["x"], geometry["y"]
+            rows.append(row)
+        return pandas.DataFrame(rows)
+
+    def _keys(self, use_global_ids):
+        if use_global_ids:
+            return self.data[self.properties.globalIdField].map(normalize_global_id)
+        return self.data[self.properties.objectIdField]
+
+    def edit_features(self, adds=None, updates=None, deletes=None, use_global_ids=False, rollback_on_failure=True, **kwargs):
+        """
+        Applies edits, like FeatureLayer.edit_features
+        """
+        self.requests.request("edit_features")
+        object_id_field = self.properties.objectIdField
+        global_id_field = self.properties.globalIdField
+        key_field = global_id_field if use_global_ids else object_id_field
+        results = {"addResults": [], "updateResults": [], "deleteResults": []}
+        with self._lock:
+            if adds:
+                added = self._to_rows(adds)
+                first_id = int(self.data[object_id_field].max()) + 1 if len(self.data) else 1
+                added[object_id_field] = numpy.arange(first_id, first_id + len(added))
+                if global_id_field:
+                    if global_id_field not in added.columns:
+                        added[global_id_field] = None
+                    added[global_id_field] = [global_id or f"{{{str(uuid.uuid4()).upper()}}}" for global_id in added[global_id_field]]
+                self.data = pandas.concat([self.data, added], ignore_index=True, sort=False)
+                results["addResults"] = [{"objectId": object_id, "globalId": added[global_id_field].iloc[index] if global_id_field else None,
+                                          "success": True} for index, object_id in enumerate(added[object_id_field].tolist())]
+            if updates:
+                updated = self._to_rows(updates).drop(columns=[object_id_field], errors="ignore")
+                keys = self._keys(use_global_ids)
+                update_keys = updated[key_field].map(normalize_global_id) if use_global_ids else updated[key_field]
+                positions = pandas.Index(keys).get_indexer(update_keys)
+                found = positions >= 0
+                for column in updated.columns:
+                    if column != key_field:
+                        values = self.data[column].values.copy() if column in self.data.columns else numpy.full(len(self.data), None, dtype=object)
+                        if values.dtype != updated[column].dtype:
+                            values = values.astype(object)
+                        values[positions[found]] = updated[column].values[found]
+                        self.data[column] = values
+                object_ids = self.data[object_id_field].values
+                results["updateResults"] = [{"objectId": int(object_ids[position]) if position >= 0 else None, "success": bool(position >= 0)}
+                                            for position in positions]
+            if deletes:
+                results["deleteResults"] = self._delete_keys(deletes, use_global_ids)
+            self._version += 1
+        return results
+
+    def _delete_keys(self, deletes, use_global_ids=False):
+        if isinstance(deletes, str):
+            deletes = [value for value in deletes.split(",") if value]
+        if use_global_ids:
+            delete_keys = {normalize_global_id(value) for value in deletes}
+        else:
+            delete_keys = {int(value) for value in deletes}
+        keys = self._keys(use_global_ids)
+        mask = keys.isin(delete_keys).values
+        deleted = set(keys[mask].tolist())
+        self.data = self.data[~mask].reset_index(drop=True)
+        return [{"objectId" if not use_global_ids else "globalId": key, "success": key in deleted} for key in delete_keys]
+
+    def delete_features(self, deletes=None, where=None, geometry_filter=None, **kwargs):
+        """
+        Deletes features by object id or by query, like FeatureLayer.delete_features
+        """
+        self.requests.request("delete_features")
+        with self._lock:
+            if deletes is not None:
+                results = self._delete_keys(deletes)
+            else:
+                positions = self._select(where or "1=1", geometry_filter)
+                object_ids = self.data[self.properties.objectIdField].values[positions].tolist()
+                results = self._delete_keys(object_ids)
+            self._version += 1
+        return {"deleteResults": results}
+
+    def export_csv(self, where, path):
+        """
+        Writes the features matching a where clause to a CSV file, like a CSV export of the layer
+        """
+        rows = self.data.iloc[self._select(where)]
+        df = rows[self._field_names].copy()
+        for field in self._date_fields:
+            df[field] = pandas.to_datetime(df[field], unit="ms").dt.strftime("%Y-%m-%d %H:%M:%S.%f").str[:-3]
+        if self.properties.geometryType == "esriGeometryPoint":
+            df["x"], df["y"] = to_wgs84(rows["x"].values, rows["y"].values)
+        df.to_csv(path, index=False)
+
+
+class FakeItem(object):
+    """
+    An item with layers that can be exported
+    """
+
+    def __init__(self, requests, item_id, layers):
+        self.requests = requests
+        self.id = item_id
+        self.layers = layers
+
+    def export(self, title, export_format, parameters=None, **kwargs):
+        self.requests.request("export")
+        layer_where = (parameters or {}).get("layers", [{"id": 0, "where": "1=1"}])[0]
+        return FakeExportItem(self.requests, self.layers[layer_where["id"]], layer_where.get("where", "1=1"))
+
+
+class FakeExportItem(object):
+    """
+    The CSV file item created by exporting an item
+    """
+
+    def __init__(self, requests, layer, where):
+        self.requests = requests
+        self.layer = layer
+        self.where = where
+
+    def download(self, save_path=None, file_name=None):
+        self.requests.request("download")
+        path = os.path.join(save_path, file_name)
+        self.layer.export_csv(self.where, path)
+        return path
+
+    def delete(self):
+        self.requests.request("delete_item")
+        return True
+
+
+class FakeContentManager(object):
+    def __init__(self, requests):
+        self.requests = requests
+        self.items = {}
+
+    def get(self, item_id):
+        self.requests.request("get_item")
+        return self.items.get(item_id)
+
+
+class FakeGIS(object):
+    """
+    A GIS with fake layers and items. Use feature_layer in place of the FeatureLayer constructor to get a layer by url
+    """
+
+    def __init__(self, latency=0, is_portal=False):
+        """
+        :param latency: (float) The number of seconds each request takes
+        :param is_portal: (bool) Whether the GIS is ArcGIS Enterprise
+        """
+        self.requests = RequestLog(latency)
+        self.properties = PropertyMap({"isPortal": is_portal})
+        self.content = FakeContentManager(self.requests)
+        self.admin = PropertyMap({"location_tracking": PropertyMap({"tracks_layer": None, "last_known_locations_layer": None})})
+        self.layers = {}
+
+    def add_layer(self, url, data, fields, geometry_type="esriGeometryPoint", max_record_count=2000):
+        """
+        Adds a layer
+        :return: (FakeFeatureLayer) The layer
+        """
+        self.layers[url] = FakeFeatureLayer(self.requests, url, data, fields, geometry_type, max_record_count)
+        return self.layers[url]
+
+    def add_item(self, item_id, layers):
+        """
+        Adds an item
+        :return: (FakeItem) The item
+        """
+        self.content.items[item_id] = FakeItem(self.requests, item_id, layers)
+        return self.content.items[item_id]
+
+    def feature_layer(self, url=None, gis=None):
+        return self.layers[url]
+
+
+class FakeGeometryService(object):
+    """
+    The geometry service operations used by the scripts, done locally with shapely
+    """
+
+    def __init__(self, requests):
+        self.requests = requests
+
+    def buffer(self, geometries, in_sr, distances, unit, **kwargs):
+        from arcgis.geometry import Geometry
+        self.requests.request("geometry")
+        distances = distances if isinstance(distances, (list, tuple)) else [distances] * len(geometries)
+        return [Geometry({"rings": shapely_to_rings(Point(geometry["x"], geometry["y"]).buffer(distance)), "spatialReference": {"wkid": 3857}})
+                for geometry, distance in zip(geometries, distances)]
+
+    def union(self, spatial_ref, geometries, gis=None, **kwargs):
+        from arcgis.geometry import Geometry
+        self.requests.request("geometry")
+        union = unary_union([rings_to_shapely(geometry["rings"]) for geometry in geometries])
+        return Geometry({"rings": shapely_to_rings(union), "spatialReference": {"wkid": 3857}})
+
+    def intersect(self, spatial_ref, geometries, geometry, gis=None, **kwargs):
+        from arcgis.geometry import Geometry
+        self.requests.request("geometry")
+        shape = rings_to_shapely(geometry["rings"])
+        return [Geometry({"rings": shapely_to_rings(shape.intersection(rings_to_shapely(tile["rings"]))), "spatialReference": {"wkid": 3857}})
+                for tile in geometries]
+
+    def install(self):
+        """
+        Replaces the geometry service functions of the ArcGIS API for Python with the local ones
+        """
+        import arcgis.geometry
+        arcgis.geometry.buffer = self.buffer
+        arcgis.geometry.union = self.union
+        arcgis.geometry.intersect = self.intersect
@@ -0,0 +1,324 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This script benchmarks check_edit_location, mirror_lkl_layer, polygon_cleanup_tracks, and export_tracks against a
+    local fake GIS filled with synthetic tracks, so the effect of a change can be measured without an organization.
+    It reports the wall time, the number of requests, and the peak memory of each script at several scales.
+    Each benchmark runs in its own process so the peak memory of one benchmark doesn't affect the others.
+"""
+import argparse
+import collections
+import concurrent.futures
+import csv
+import functools
+import importlib
+import logging
+import logging.handlers
+import os
+import sys
+import tempfile
+import time
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import session_cache  # noqa: E402
+from fake_gis import FakeGIS, FakeGeometryService  # noqa: E402
+from synthetic_data import generate_edited_features, generate_last_known_locations, generate_polygons, generate_tracks  # noqa: E402
+from track_store import TrackStore  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where the peak memory isn't reported
+    resource = None
+
+TRACKS_URL = "https://fake.arcgis.com/server/rest/services/Hosted/location_tracking/FeatureServer/0"
+LKL_URL = "https://fake.arcgis.com/server/rest/services/Hosted/location_tracking/FeatureServer/1"
+MIRROR_URL = "https://fake.arcgis.com/server/rest/services/Hosted/lkl_mirror/FeatureServer/0"
+EDITS_URL = "https://fake.arcgis.com/server/rest/services/Hosted/work_orders/FeatureServer/0"
+POLYGONS_URL = "https://fake.arcgis.com/server/rest/services/Hosted/cleanup_polygons/FeatureServer/0"
+TRACKS_ITEM_ID = "tracks"
+MIRROR_ITEM_ID = "mirror"
+TRACK_FIELDS = [{"name": "objectid", "type": "esriFieldTypeOID"},
+                {"name": "created_user", "type": "esriFieldTypeString"},
+                {"name": "location_timestamp", "type": "esriFieldTypeDate"},
+                {"name": "horizontal_accuracy", "type": "esriFieldTypeDouble"},
+                {"name": "speed", "type": "esriFieldTypeDouble"},
+                {"name": "course", "type": "esriFieldTypeDouble"},
+                {"name": "altitude", "type": "esriFieldTypeDouble"}]
+LKL_FIELDS = TRACK_FIELDS + [{"name": "globalid", "type": "esriFieldTypeGlobalID"},
+                             {"name": "last_edited_date", "type": "esriFieldTypeDate"}]
+EDIT_FIELDS = [{"name": "objectid", "type": "esriFieldTypeOID"},
+               {"name": "Editor", "type": "esriFieldTypeString"},
+               {"name": "EditDate", "type": "esriFieldTypeDate"}]
+POLYGON_FIELDS = [{"name": "objectid", "type": "esriFieldTypeOID"},
+                  {"name": "name", "type": "esriFieldTypeString"}]
+
+
+def create_arguments(**kwargs):
+    """
+    Creates the parsed command line arguments of a script, with the arguments that all of the scripts share
+    """
+    arguments = {"username": "benchmark", "password": "benchmark", "org_url": "https://fake.arcgis.com", "log_file": None,
+                 "skip_ssl_verification": False}
+    arguments.update(kwargs)
+    return argparse.Namespace(**arguments)
+
+
+def add_tracks_layer(gis, tracks):
+    tracks_layer = gis.add_layer(TRACKS_URL, tracks, TRACK_FIELDS)
+    gis.admin.location_tracking["tracks_layer"] = tracks_layer
+    gis.add_item(TRACKS_ITEM_ID, [tracks_layer])
+    return tracks_layer
+
+
+def prepare_check_edit_location(gis, tracks, options, temp_dir, bulk=False, stream=False, store=False):
+    tracks_layer = add_tracks_layer(gis, tracks)
+    users = tracks["created_user"].unique()
+    edits = generate_edited_features(tracks, count=len(users) * options.edits_per_user, seed=options.seed)
+    gis.add_layer(EDITS_URL, edits, EDIT_FIELDS)
+    track_store = None
+    if store:
+        # the store is synced before the benchmark starts, like a store kept up to date on a schedule
+        track_store = os.path.join(temp_dir, "tracks.sqlite")
+        synced_store = TrackStore(track_store)
+        synced_store.sync(tracks_layer, logging.getLogger())
+        synced_store.close()
+    return create_arguments(workers=",".join(users), field_name=["EditDate"], layer_url=[EDITS_URL], time_tolerance=10, distance_tolerance=100,
+                            min_accuracy=50, tracks_layer_url=None, bulk=bulk, stream=stream, start_date=None, end_date=None, time_slice_hours=24,
+                            chunk_size=1000, page_size=None, output_file=None, track_store=track_store)
+
+
+def prepare_mirror_lkl_layer(gis, tracks, options, temp_dir):
+    lkl = generate_last_known_locations(tracks, seed=options.seed)
+    gis.add_layer(LKL_URL, lkl, LKL_FIELDS)
+    # the mirror is missing 10% of the LKLs, 10% have moved since the last sync, and it has 5% extra LKLs of users that were removed
+    rng = numpy.random.RandomState(options.seed)
+    mirror = lkl[rng.rand(len(lkl)) >= 0.1].copy()
+    moved = rng.rand(len(mirror)) < 0.1
+    mirror.loc[moved, "x"] -= 100
+    mirror.loc[moved, "last_edited_date"] -= 60000
+    removed = lkl.sample(frac=0.05, random_state=options.seed)
+    removed = removed.assign(globalid=[f"{{00000000-0000-0000-0000-{index:012d}}}" for index in range(len(removed))])
+    mirror = pandas.concat([mirror, removed], ignore_index=True)
+    mirror["objectid"] = numpy.arange(1, len(mirror) + 1)
+    gis.add_item(MIRROR_ITEM_ID, [gis.add_layer(MIRROR_URL, mirror, LKL_FIELDS)])
+    return create_arguments(item_id=MIRROR_ITEM_ID, lkl_layer_url=LKL_URL, state_file=None, full_sync=False, batch_size=500, max_workers=4,
+                            max_retries=3, watch=False, interval=60, jitter=None)
+
+
+def prepare_polygon_cleanup_tracks(gis, tracks, options, temp_dir, tiled=False):
+    add_tracks_layer(gis, tracks)
+    gis.properties["isPortal"] = True
+    gis.add_layer(POLYGONS_URL, generate_polygons(options.polygons, seed=options.seed), POLYGON_FIELDS, geometry_type="esriGeometryPolygon")
+    return create_arguments(layer_url=POLYGONS_URL, where="1=1", symmetric_difference=False, local_geometry=False, dry_run=False, page_size=None,
+                            tiled=tiled, tile_size=10000, time_slice_hours=24, batch_size=1000, state_file=os.path.join(temp_dir, "cleanup_state.json"))
+
+
+def prepare_export_tracks(gis, tracks, options, temp_dir, engine="query", thin=False, page_size=None):
+    add_tracks_layer(gis, tracks)
+    return create_arguments(tracks_item=TRACKS_ITEM_ID, track_age=options.days, time_zone="UTC", output_directory=temp_dir, partition="day",
+                            max_workers=4, engine=engine, page_size=page_size, output_format="csv", thin=thin, thin_max_accuracy=50,
+                            thin_stationary_radius=20, thin_stationary_time=60, thin_min_distance=10, thin_min_interval=5, thin_tolerance=5,
+                            thin_max_gap=600)
+
+
+def check_export_tracks(tracks, temp_dir):
+    """
+    Checks that every track was exported exactly once
+    """
+    exported = sum(len(pandas.read_csv(os.path.join(temp_dir, file_name))) for file_name in os.listdir(temp_dir) if file_name.endswith(".csv"))
+    if exported != len(tracks):
+        raise Exception(f"Exported {exported} of {len(tracks)} tracks")
+
+
+# The module and the function that sets up the data and creates the arguments of each benchmark
+BENCHMARKS = collections.OrderedDict([
+    ("check_edit_location", ("check_edit_location", prepare_check_edit_location)),
+    ("check_edit_location_bulk", ("check_edit_location", functools.partial(prepare_check_edit_location, bulk=True))),
+    ("check_edit_location_stream", ("check_edit_location", functools.partial(prepare_check_edit_location, stream=True))),
+    ("check_edit_location_stream_store", ("check_edit_location", functools.partial(prepare_check_edit_location, stream=True, store=True))),
+    ("mirror_lkl_layer", ("mirror_lkl_layer", prepare_mirror_lkl_layer)),
+    ("polygon_cleanup_tracks", ("polygon_cleanup_tracks", prepare_polygon_cleanup_tracks)),
+    ("polygon_cleanup_tracks_tiled", ("polygon_cleanup_tracks", functools.partial(prepare_polygon_cleanup_tracks, tiled=True))),
+    ("export_tracks_query", ("export_tracks", prepare_export_tracks)),
+    ("export_tracks_export", ("export_tracks", functools.partial(prepare_export_tracks, engine="export"))),
+    ("export_tracks_query_large_pages", ("export_tracks", functools.partial(prepare_export_tracks, page_size=5000))),
+    ("export_tracks_query_thin", ("export_tracks", functools.partial(prepare_export_tracks, thin=True))),
+    ("export_tracks_export_thin", ("export_tracks", functools.partial(prepare_export_tracks, engine="export", thin=True))),
+])
+# The benchmarks whose output is checked, with the function that raises if the script lost or duplicated tracks
+CHECKS = {
+    "export_tracks_query": check_export_tracks,
+    "export_tracks_export": check_export_tracks,
+    # requests pages larger than the maxRecordCount of the fake layers (2000), which the server caps
+    "export_tracks_query_large_pages": check_export_tracks,
+}
+RESULT_COLUMNS = ["benchmark", "users", "points_per_day", "days", "tracks", "seconds", "requests", "request_counts", "peak_memory_mb", "data_memory_mb"]
+
+
+def initialize_logging(log_file=None):
+    """
+    Setup logging
+    :param log_file: (string) The file to log to
+    :return: (Logger) a logging instance
+    """
+    # initialize logging
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(filename)30s:%(lineno)4s - %(funcName)30s()][%(threadName)5s] [%(name)10.10s] [%(levelname)8s] %(message)s")
+    # Grab the root logger
+    logger = logging.getLogger()
+    # Set the root logger logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+    logger.setLevel(logging.DEBUG)
+    # Create a handler to print to the console. stdout is reserved for the results table
+    sh = logging.StreamHandler(sys.stderr)
+    sh.setFormatter(formatter)
+    sh.setLevel(logging.INFO)
+    # Create a handler to log to the specified file
+    if log_file:
+        rh = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760)
+        rh.setFormatter(formatter)
+        rh.setLevel(logging.DEBUG)
+        logger.addHandler(rh)
+    # Add the handlers to the root logger
+    logger.addHandler(sh)
+    return logger
+
+
+def get_peak_memory():
+    """
+    Gets the peak memory (resident set size) of the current process
+    :return: (float) The peak memory in MB, or None if it can't be measured on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def run_benchmark(name, users, points_per_day, options):
+    """
+    Runs one benchmark: generates the data, replaces the GIS, layers, and geometry service of the script with the fakes, and runs it.
+    This runs in a separate process, so the scripts can be patched and the peak memory is the peak of this benchmark only
+    :param name: (string) The name of the benchmark
+    :param users: (int) The number of users
+    :param points_per_day: (int) The number of tracks of each user per day
+    :param options: (Namespace) The benchmark options
+    :return: (dict) The results
+    """
+    # the scripts log every step, only their warnings and errors are shown
+    logging.disable(logging.INFO)
+    module_name, prepare = BENCHMARKS[name]
+    module = importlib.import_module(module_name)
+    gis = FakeGIS(latency=options.latency)
+    FakeGeometryService(gis.requests).install()
+    # the scripts sign in and resolve the tracks layer through session_cache
+    for patched_module in (module, session_cache):
+        patched_module.GIS = lambda *args, **kwargs: gis
+        if hasattr(patched_module, "FeatureLayer"):
+            patched_module.FeatureLayer = gis.feature_layer
+    tracks = generate_tracks(users, points_per_day, options.days, seed=options.seed)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        arguments = prepare(gis, tracks, options, temp_dir)
+        data_memory = get_peak_memory()
+        gis.requests.reset()
+        start_time = time.perf_counter()
+        try:
+            module.main(arguments)
+        except SystemExit:
+            # some scripts exit when there is nothing to do
+            pass
+        seconds = time.perf_counter() - start_time
+        if name in CHECKS:
+            CHECKS[name](tracks, temp_dir)
+    return {
+        "benchmark": name,
+        "users": users,
+        "points_per_day": points_per_day,
+        "days": options.days,
+        "tracks": len(tracks),
+        "seconds": round(seconds, 3),
+        "requests": gis.requests.total,
+        "request_counts": " ".join(f"{operation}={count}" for operation, count in sorted(gis.requests.counts.items())),
+        "peak_memory_mb": round(get_peak_memory(), 1) if resource else None,
+        "data_memory_mb": round(data_memory, 1) if resource else None,
+    }
+
+
+def parse_scales(scales):
+    """
+    Parses scales like "10x1000,100x1000" into (users, points per day) pairs
+    """
+    return [tuple(int(value) for value in scale.lower().split("x")) for scale in scales.replace(" ", "").split(",")]
+
+
+def format_table(results):
+    rows = [RESULT_COLUMNS] + [[str(result[column]) for column in RESULT_COLUMNS] for result in results]
+    widths = [max(len(row[index]) for row in rows) for index in range(len(RESULT_COLUMNS))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def main(arguments):
+    # initialize logger
+    logger = initialize_logging(arguments.log_file)
+    names = list(BENCHMARKS) if arguments.benchmarks == "all" else arguments.benchmarks.replace(" ", "").split(",")
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        logger.error(f"Unknown benchmark(s): {', '.join(unknown)}. Choose from: {', '.join(BENCHMARKS)}")
+        sys.exit(1)
+
+    results = []
+    for users, points_per_day in parse_scales(arguments.scales):
+        for name in names:
+            logger.info(f"Running {name} with {users} users x {points_per_day} tracks per day x {arguments.days} day(s)")
+            # a new process for every benchmark
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                try:
+                    result = executor.submit(run_benchmark, name, users, points_per_day, arguments).result()
+                except Exception as e:
+                    logger.error(f"{name} failed: {e}")
+                    continue
+            logger.info(f"{name}: {result['seconds']} seconds, {result['requests']} requests, {result['peak_memory_mb']} MB peak memory")
+            results.append(result)
+
+    print(format_table(results))
+    if arguments.output_file:
+        with open(arguments.output_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(results)
+        logger.info(f"Results written to {arguments.output_file}")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Benchmark the scripts against a local fake GIS with synthetic tracks")
+    parser.add_argument('-benchmarks', dest='benchmarks', default="all",
+                        help=f"Comma separated list of the benchmarks to run, from: {', '.join(BENCHMARKS)}. Defaults to all")
+    parser.add_argument('-scales', dest='scales', default="10x1000,100x1000",
+                        help="Comma separated list of the scales to run the benchmarks at, as <users>x<tracks per user per day>. "
+                             "Defaults to 10x1000,100x1000")
+    parser.add_argument('-days', dest='days', type=int, default=1, help="The number of days of tracks to generate. Defaults to 1")
+    parser.add_argument('-latency', dest='latency', type=float, default=0,
+                        help="The number of seconds each request to the fake GIS takes. Defaults to 0")
+    parser.add_argument('-edits-per-user', dest='edits_per_user', type=int, default=2,
+                        help="The number of features each user edited, checked by check_edit_location. Defaults to 2")
+    parser.add_argument('-polygons', dest='polygons', type=int, default=10,
+                        help="The number of polygons used by polygon_cleanup_tracks. Defaults to 10")
+    parser.add_argument('-seed', dest='seed', type=int, default=0, help="The random seed used to generate the data. Defaults to 0")
+    parser.add_argument('-output-file', dest='output_file', default=None, help="A CSV file to write the results to (optional)")
+    parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,146 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This module generates synthetic tracks, last known locations (LKL), polygons, and edited features for the benchmarks.
+    Each user walks or drives around an area during the working hours of each day, and the data is in Web Mercator.
+"""
+import datetime
+import uuid
+import numpy
+import pandas
+
+# Redlands, CA in Web Mercator
+CENTER = (-13046000.0, 4036000.0)
+# Each user records tracks from 08:00 to 18:00 UTC
+WORKDAY_START_MS = 8 * 3600000
+WORKDAY_LENGTH_MS = 10 * 3600000
+
+
+def generate_tracks(users=10, points_per_day=1000, days=1, end_date=None, center=CENTER, spread=20000, seed=0):
+    """
+    Generates the tracks of users moving around an area. Each user makes a random walk per day, walking or driving,
+    with the heading drifting between tracks
+    :param users: (int) The number of users
+    :param points_per_day: (int) The number of tracks of each user per day
+    :param days: (int) The number of days
+    :param end_date: (datetime.date) The last day (UTC). Defaults to yesterday, so the tracks are within the export window of export_tracks
+    :param center: (tuple) The x, y coordinates of the center of the area
+    :param spread: (float) The maximum distance in meters from the center where users start their day
+    :param seed: (int) The random seed
+    :return: (DataFrame) The tracks, with objectid, created_user, location_timestamp (epoch ms), horizontal_accuracy, speed, course,
+             altitude, x, and y columns, sorted by user and time
+    """
+    rng = numpy.random.RandomState(seed)
+    end_date = end_date or datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
+    first_day = datetime.datetime.combine(end_date - datetime.timedelta(days=days - 1), datetime.time())
+    first_day_ms = int((first_day - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+    segments = users * days
+    count = segments * points_per_day
+    interval_ms = max(WORKDAY_LENGTH_MS // points_per_day, 1)
+
+    # each (user, day) is a segment of points_per_day consecutive tracks
+    segment_starts = numpy.arange(0, count, points_per_day)
+    day_index = numpy.tile(numpy.arange(days), users)
+    timestamps = (first_day_ms + WORKDAY_START_MS + numpy.repeat(day_index * 86400000, points_per_day)
+                  + numpy.tile(numpy.arange(points_per_day, dtype=numpy.int64) * interval_ms, segments)
+                  + rng.randint(0, max(interval_ms // 2, 1), count))
+
+    # users either walk or drive for the whole day
+    segment_speeds = numpy.where(rng.rand(segments) < 0.5, 1.4, 12.0)
+    speeds = numpy.repeat(segment_speeds, points_per_day) * rng.lognormal(0, 0.3, count)
+    headings = _segment_cumsum(rng.normal(0, 0.3, count), segment_starts, points_per_day) + numpy.repeat(rng.uniform(0, 2 * numpy.pi, segments),
+                                                                                                         points_per_day)
+    distances = speeds * interval_ms / 1000
+    start_angles = rng.uniform(0, 2 * numpy.pi, segments)
+    start_distances = spread * numpy.sqrt(rng.rand(segments))
+    xs = numpy.repeat(center[0] + start_distances * numpy.cos(start_angles), points_per_day) + \
+        _segment_cumsum(distances * numpy.cos(headings), segment_starts, points_per_day)
+    ys = numpy.repeat(center[1] + start_distances * numpy.sin(start_angles), points_per_day) + \
+        _segment_cumsum(distances * numpy.sin(headings), segment_starts, points_per_day)
+
+    return pandas.DataFrame({
+        "objectid": numpy.arange(1, count + 1),
+        "created_user": numpy.repeat([f"user_{index:05d}" for index in range(users)], points_per_day * days),
+        "location_timestamp": timestamps,
+        "horizontal_accuracy": numpy.round(rng.lognormal(2, 0.6, count), 1),
+        "speed": numpy.round(speeds, 2),
+        "course": numpy.round(numpy.degrees(headings) % 360, 1),
+        "altitude": numpy.round(400 + rng.normal(0, 10, count), 1),
+        "x": xs,
+        "y": ys,
+    })
+
+
+def _segment_cumsum(values, segment_starts, segment_length):
+    """
+    Computes the cumulative sum of values, restarting at the start of each segment
+    """
+    sums = numpy.cumsum(values)
+    return sums - numpy.repeat(sums[segment_starts] - values[segment_starts], segment_length)
+
+
+def generate_last_known_locations(tracks, seed=0):
+    """
+    Generates the last known location of each user from their tracks
+    :param tracks: (DataFrame) The tracks, as returned by generate_tracks
+    :param seed: (int) The random seed used to create the global ids
+    :return: (DataFrame) The LKLs, with a globalid and a last_edited_date column
+    """
+    rng = numpy.random.RandomState(seed)
+    lkl = tracks.groupby("created_user", sort=True).last().reset_index()
+    lkl["objectid"] = numpy.arange(1, len(lkl) + 1)
+    lkl["globalid"] = [f"{{{str(uuid.UUID(bytes=rng.bytes(16))).upper()}}}" for _ in range(len(lkl))]
+    lkl["last_edited_date"] = lkl["location_timestamp"]
+    return lkl
+
+
+def generate_polygons(count=10, center=CENTER, spread=20000, size=2000, seed=0):
+    """
+    Generates square polygons around an area, for example the polygons used to clean up tracks
+    :param count: (int) The number of polygons
+    :param center: (tuple) The x, y coordinates of the center of the area
+    :param spread: (float) The maximum distance in meters from the center of the polygons
+    :param size: (float) The width of the polygons in meters
+    :param seed: (int) The random seed
+    :return: (DataFrame) The polygons, with objectid, name, and rings columns. The rings are clockwise
+    """
+    rng = numpy.random.RandomState(seed)
+    xs = center[0] + rng.uniform(-spread, spread, count)
+    ys = center[1] + rng.uniform(-spread, spread, count)
+    half = size / 2
+    rings = [[[[x - half, y - half], [x - half, y + half], [x + half, y + half], [x + half, y - half], [x - half, y - half]]]
+             for x, y in zip(xs, ys)]
+    return pandas.DataFrame({"objectid": numpy.arange(1, count + 1), "name": [f"Polygon {index + 1}" for index in range(count)], "rings": rings})
+
+
+def generate_edited_features(tracks, count=100, invalid_ratio=0.2, invalid_distance=5000, seed=0):
+    """
+    Generates features edited by the users while they were tracked, as checked by check_edit_location.
+    Valid features are edited next to a track of their editor, invalid features far away from it
+    :param tracks: (DataFrame) The tracks, as returned by generate_tracks
+    :param count: (int) The number of features
+    :param invalid_ratio: (float) The share of features edited away from the editor's location
+    :param invalid_distance: (float) How far from the editor's location (in meters) invalid features are edited
+    :param seed: (int) The random seed
+    :return: (DataFrame) The features, with objectid, Editor, EditDate (epoch ms), x, and y columns
+    """
+    rng = numpy.random.RandomState(seed)
+    sample = tracks.iloc[numpy.sort(rng.randint(0, len(tracks), count))]
+    offsets = numpy.where(rng.rand(count) < invalid_ratio, invalid_distance, rng.uniform(0, 20, count))
+    angles = rng.uniform(0, 2 * numpy.pi, count)
+    return pandas.DataFrame({
+        "objectid": numpy.arange(1, count + 1),
+        "Editor": sample["created_user"].values,
+        "EditDate": sample["location_timestamp"].values,
+        "x": sample["x"].values + offsets * numpy.cos(angles),
+        "y": sample["y"].values + offsets * numpy.sin(angles),
+    })
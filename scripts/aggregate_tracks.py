@@ -0,0 +1,460 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This sample aggregates tracks into hexagon, square, or geohash bins locally, as an alternative to aggregated map
+    services and GeoAnalytics. The tracks are read one page (or one file chunk) at a time and added to running
+    count/sum/min/max accumulators per bin, so any number of tracks can be aggregated without loading them all.
+"""
+import argparse
+import csv
+import glob
+import json
+import logging
+import logging.handlers
+import math
+import os
+import traceback
+import sys
+import numpy
+import pandas
+import pendulum
+from arcgis.gis import GIS
+from arcgis.features import Feature, FeatureLayer
+from edit_utils import edit_features_in_batches
+from instrumentation import add_profile_arguments, profile
+from track_index import create_time_clause, query_pages
+
+WEB_MERCATOR = {'wkid': 102100, 'latestWkid': 3857}
+WGS84 = {'wkid': 4326}
+EARTH_RADIUS = 6378137.0
+# Bin indexes are packed into a single int64 key: (i + KEY_OFFSET) * KEY_BASE + (j + KEY_OFFSET)
+KEY_BASE = 2 ** 32
+KEY_OFFSET = 2 ** 30
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+STYLES = ["flatHexagon", "pointyHexagon", "square", "geohash"]
+
+
+def initialize_logging(log_file=None):
+    """
+    Setup logging
+    :param log_file: (string) The file to log to
+    :return: (Logger) a logging instance
+    """
+    # initialize logging
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(filename)30s:%(lineno)4s - %(funcName)30s()][%(threadName)5s] [%(name)10.10s] [%(levelname)8s] %(message)s")
+    # Grab the root logger
+    logger = logging.getLogger()
+    # Set the root logger logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+    logger.setLevel(logging.DEBUG)
+    # Create a handler to print to the console
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(formatter)
+    sh.setLevel(logging.INFO)
+    # Create a handler to log to the specified file
+    if log_file:
+        rh = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760)
+        rh.setFormatter(formatter)
+        rh.setLevel(logging.DEBUG)
+        logger.addHandler(rh)
+    # Add the handlers to the root logger
+    logger.addHandler(sh)
+    return logger
+
+
+def to_web_mercator(longitudes, latitudes):
+    xs = EARTH_RADIUS * numpy.radians(longitudes)
+    ys = EARTH_RADIUS * numpy.log(numpy.tan(numpy.pi / 4 + numpy.radians(numpy.clip(latitudes, -85.05112878, 85.05112878)) / 2))
+    return xs, ys
+
+
+def to_wgs84(xs, ys):
+    return numpy.degrees(numpy.asarray(xs) / EARTH_RADIUS), numpy.degrees(2 * numpy.arctan(numpy.exp(numpy.asarray(ys) / EARTH_RADIUS)) - numpy.pi / 2)
+
+
+class BinGrid(object):
+    """
+    Assigns points to bins and creates the polygon of each bin. Hexagon and square bins are in Web Mercator, with a size in
+    meters (the distance from the center to a corner for hexagons, the width for squares). Geohash bins are in WGS84
+    """
+
+    def __init__(self, style="flatHexagon", size=500, geohash_precision=7):
+        if style not in STYLES:
+            raise ValueError(f"Unknown bin style {style}, expected one of {', '.join(STYLES)}")
+        self.style = style
+        self.size = float(size)
+        self.geohash_precision = geohash_precision
+        self.spatial_reference = WGS84 if style == "geohash" else WEB_MERCATOR
+        # geohashes alternate between longitude and latitude bits, starting with longitude
+        self._longitude_bits = (5 * geohash_precision + 1) // 2
+        self._latitude_bits = 5 * geohash_precision // 2
+
+    def bin_keys(self, xs, ys):
+        """
+        Finds the bin of each point
+        :param xs: (ndarray) The x coordinates, in the spatial reference of the grid
+        :param ys: (ndarray) The y coordinates, in the spatial reference of the grid
+        :return: (ndarray) The int64 key of the bin of each point
+        """
+        if self.style == "square":
+            i = numpy.floor(xs / self.size)
+            j = numpy.floor(ys / self.size)
+        elif self.style == "geohash":
+            i = numpy.clip(numpy.floor((xs + 180) / 360 * 2 ** self._longitude_bits), 0, 2 ** self._longitude_bits - 1)
+            j = numpy.clip(numpy.floor((ys + 90) / 180 * 2 ** self._latitude_bits), 0, 2 ** self._latitude_bits - 1)
+        else:
+            if self.style == "pointyHexagon":
+                q = (math.sqrt(3) / 3 * xs - ys / 3) / self.size
+                r = (2 / 3 * ys) / self.size
+            else:
+                q = (2 / 3 * xs) / self.size
+                r = (-xs / 3 + math.sqrt(3) / 3 * ys) / self.size
+            i, j = self._round_axial(q, r)
+        return (i.astype(numpy.int64) + KEY_OFFSET) * KEY_BASE + (j.astype(numpy.int64) + KEY_OFFSET)
+
+    @staticmethod
+    def _round_axial(q, r):
+        """
+        Rounds fractional axial hexagon coordinates to the hexagon containing them
+        """
+        s = -q - r
+        rq, rr, rs = numpy.round(q), numpy.round(r), numpy.round(s)
+        dq, dr, ds = numpy.abs(rq - q), numpy.abs(rr - r), numpy.abs(rs - s)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        rq = numpy.where(fix_q, -rr - rs, rq)
+        rr = numpy.where(fix_r, -rq - rs, rr)
+        return rq, rr
+
+    @staticmethod
+    def unpack(keys):
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        return keys // KEY_BASE - KEY_OFFSET, keys % KEY_BASE - KEY_OFFSET
+
+    def bin_id(self, key):
+        """
+        :param key: (int) The key of a bin
+        :return: (string) A readable id of the bin, the geohash for geohash bins
+        """
+        i, j = (int(value) for value in self.unpack(key))
+        if self.style != "geohash":
+            return f"{i}_{j}"
+        bits = 0
+        for bit in range(self._longitude_bits + self._latitude_bits):
+            # even bits (from the most significant) are longitude bits
+            if bit % 2 == 0:
+                value = (i >> (self._longitude_bits - 1 - bit // 2)) & 1
+            else:
+                value = (j >> (self._latitude_bits - 1 - bit // 2)) & 1
+            bits = (bits << 1) | value
+        return "".join(BASE32[(bits >> (5 * (self.geohash_precision - 1 - n))) & 31] for n in range(self.geohash_precision))
+
+    def polygon(self, key):
+        """
+        Creates the polygon of a bin
+        :param key: (int) The key of the bin
+        :return: (list) The clockwise ring of the bin, in the spatial reference of the grid
+        """
+        i, j = (float(value) for value in self.unpack(key))
+        if self.style in ("square", "geohash"):
+            if self.style == "square":
+                width = height = self.size
+                xmin, ymin = i * width, j * height
+            else:
+                width, height = 360 / 2 ** self._longitude_bits, 180 / 2 ** self._latitude_bits
+                xmin, ymin = i * width - 180, j * height - 90
+            return [[xmin, ymin], [xmin, ymin + height], [xmin + width, ymin + height], [xmin + width, ymin], [xmin, ymin]]
+        if self.style == "pointyHexagon":
+            center = (self.size * math.sqrt(3) * (i + j / 2), self.size * 1.5 * j)
+            angles = [90 - 60 * n for n in range(7)]
+        else:
+            center = (self.size * 1.5 * i, self.size * math.sqrt(3) * (j + i / 2))
+            angles = [120 - 60 * n for n in range(7)]
+        return [[center[0] + self.size * math.cos(math.radians(angle)), center[1] + self.size * math.sin(math.radians(angle))] for angle in angles]
+
+
+class BinAccumulator(object):
+    """
+    Keeps a running count, and the sum, min and max of statistic fields, for each bin.
+    The bins are kept in a sorted array of keys, with one array per statistic, so adding a batch of points is a
+    few vectorized operations no matter how many points have been added before
+    """
+
+    def __init__(self, fields=None):
+        self.fields = list(fields or [])
+        self.keys = numpy.array([], dtype=numpy.int64)
+        self.counts = numpy.array([], dtype=numpy.int64)
+        self.value_counts = {field: numpy.array([], dtype=numpy.int64) for field in self.fields}
+        self.sums = {field: numpy.array([], dtype=numpy.float64) for field in self.fields}
+        self.mins = {field: numpy.array([], dtype=numpy.float64) for field in self.fields}
+        self.maxs = {field: numpy.array([], dtype=numpy.float64) for field in self.fields}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, keys, values=None):
+        """
+        Adds a batch of points
+        :param keys: (ndarray) The bin key of each point
+        :param values: (dict) The values of each statistic field for each point. Missing values are NaN
+        """
+        if len(keys) == 0:
+            return
+        values = values or {}
+        batch_keys, inverse = numpy.unique(keys, return_inverse=True)
+        batch_counts = numpy.bincount(inverse, minlength=len(batch_keys))
+        # sort the values by bin so the min and max of each bin can be reduced in one pass
+        order = numpy.argsort(inverse, kind="stable")
+        starts = numpy.cumsum(batch_counts) - batch_counts
+        batch = {}
+        for field in self.fields:
+            field_values = numpy.asarray(values[field], dtype=numpy.float64)
+            valid = ~numpy.isnan(field_values)
+            sorted_values = field_values[order]
+            batch[field] = (numpy.bincount(inverse[valid], minlength=len(batch_keys)),
+                            numpy.bincount(inverse[valid], weights=field_values[valid], minlength=len(batch_keys)),
+                            numpy.minimum.reduceat(numpy.where(numpy.isnan(sorted_values), numpy.inf, sorted_values), starts),
+                            numpy.maximum.reduceat(numpy.where(numpy.isnan(sorted_values), -numpy.inf, sorted_values), starts))
+
+        # merge the batch into the existing bins, inserting the bins that are new
+        positions = numpy.searchsorted(self.keys, batch_keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == batch_keys[found]
+        existing = positions[found]
+        self.counts[existing] += batch_counts[found]
+        for field in self.fields:
+            value_counts, sums, mins, maxs = batch[field]
+            self.value_counts[field][existing] += value_counts[found]
+            self.sums[field][existing] += sums[found]
+            self.mins[field][existing] = numpy.minimum(self.mins[field][existing], mins[found])
+            self.maxs[field][existing] = numpy.maximum(self.maxs[field][existing], maxs[found])
+        new = ~found
+        if new.any():
+            insert_at = positions[new]
+            self.keys = numpy.insert(self.keys, insert_at, batch_keys[new])
+            self.counts = numpy.insert(self.counts, insert_at, batch_counts[new])
+            for field in self.fields:
+                value_counts, sums, mins, maxs = batch[field]
+                self.value_counts[field] = numpy.insert(self.value_counts[field], insert_at, value_counts[new])
+                self.sums[field] = numpy.insert(self.sums[field], insert_at, sums[new])
+                self.mins[field] = numpy.insert(self.mins[field], insert_at, mins[new])
+                self.maxs[field] = numpy.insert(self.maxs[field], insert_at, maxs[new])
+
+    def statistics(self):
+        """
+        :return: (generator) Yields (key, dict of statistics) for each bin, including the average of each field
+        """
+        for position, key in enumerate(self.keys):
+            statistics = {"count": int(self.counts[position])}
+            for field in self.fields:
+                has_values = self.value_counts[field][position] > 0
+                statistics[f"{field}_avg"] = float(self.sums[field][position] / self.value_counts[field][position]) if has_values else None
+                statistics[f"{field}_min"] = float(self.mins[field][position]) if has_values else None
+                statistics[f"{field}_max"] = float(self.maxs[field][position]) if has_values else None
+                statistics[f"{field}_sum"] = float(self.sums[field][position])
+            yield int(key), statistics
+
+
+def read_layer(tracks_layer, where, fields, spatial_reference, page_size=None):
+    """
+    Reads the tracks of a layer one page at a time
+    :return: (generator) Yields (xs, ys, dict of field values) of each page
+    """
+    out_fields = ",".join(fields) if fields else "objectid"
+    for page in query_pages(tracks_layer, where, out_fields=out_fields, out_sr=spatial_reference, page_size=page_size):
+        xs = numpy.array([feature.geometry["x"] for feature in page], dtype=numpy.float64)
+        ys = numpy.array([feature.geometry["y"] for feature in page], dtype=numpy.float64)
+        values = {field: numpy.array([feature.attributes.get(field) for feature in page], dtype=numpy.float64) for field in fields}
+        yield xs, ys, values
+
+
+def read_files(path, fields, x_field="x", y_field="y", chunk_size=500000):
+    """
+    Reads tracks from exported CSV files or Parquet files (for example the output of export_tracks) one chunk at a time
+    :param path: (string) A file, or a directory that is searched for .csv and .parquet files
+    :return: (generator) Yields (xs, ys, dict of field values) of each chunk
+    """
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, "**", "*.csv"), recursive=True) + glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True))
+    else:
+        files = [path]
+    for file in files:
+        if file.endswith(".parquet"):
+            import pyarrow.parquet
+            columns = pyarrow.parquet.read_schema(file).names
+            lookup = {column.lower(): column for column in columns}
+            chunks = [pyarrow.parquet.read_table(file, columns=[lookup[name.lower()] for name in [x_field, y_field] + fields]).to_pandas()]
+        else:
+            chunks = pandas.read_csv(file, chunksize=chunk_size)
+        for chunk in chunks:
+            lookup = {column.lower(): column for column in chunk.columns}
+            values = {field: pandas.to_numeric(chunk[lookup[field.lower()]], errors="coerce").values.astype(numpy.float64) for field in fields}
+            yield chunk[lookup[x_field.lower()]].values.astype(numpy.float64), chunk[lookup[y_field.lower()]].values.astype(numpy.float64), values
+
+
+def write_output(grid, accumulator, output_file):
+    """
+    Writes the bins to a CSV file (with the bin centers in WGS84) or a GeoJSON file, based on the file extension
+    """
+    with open(output_file, "w", newline="") as f:
+        if output_file.lower().endswith((".geojson", ".json")):
+            features = []
+            for key, statistics in accumulator.statistics():
+                ring = numpy.array(grid.polygon(key))
+                if grid.style != "geohash":
+                    ring = numpy.column_stack(to_wgs84(ring[:, 0], ring[:, 1]))
+                # GeoJSON exterior rings are counterclockwise
+                features.append({"type": "Feature", "properties": dict(bin_id=grid.bin_id(key), **statistics),
+                                 "geometry": {"type": "Polygon", "coordinates": [ring[::-1].tolist()]}})
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+            return
+        writer = csv.writer(f)
+        header = None
+        for key, statistics in accumulator.statistics():
+            ring = numpy.array(grid.polygon(key)[:-1])
+            x, y = ring[:, 0].mean(), ring[:, 1].mean()
+            if grid.style != "geohash":
+                x, y = to_wgs84(x, y)
+            if header is None:
+                header = ["bin_id", "longitude", "latitude"] + list(statistics)
+                writer.writerow(header)
+            writer.writerow([grid.bin_id(key), float(x), float(y)] + list(statistics.values()))
+
+
+def create_bin_features(grid, accumulator):
+    """
+    :return: (list) A polygon feature for each bin, with its statistics as attributes
+    """
+    return [Feature(geometry={"rings": [grid.polygon(key)], "spatialReference": grid.spatial_reference},
+                    attributes=dict(bin_id=grid.bin_id(key), **statistics))
+            for key, statistics in accumulator.statistics()]
+
+
+def main(arguments):
+    # initialize logger
+    logger = initialize_logging(arguments.log_file)
+    if not arguments.input_path and not arguments.org_url:
+        raise Exception("Either -input-path or the authentication arguments (-u, -p, -org) are required")
+    grid = BinGrid(arguments.style, arguments.bin_size, arguments.geohash_precision)
+    fields = arguments.statistic_fields.split(",") if arguments.statistic_fields else []
+    accumulator = BinAccumulator(fields)
+
+    gis = None
+    if arguments.org_url:
+        # Create the GIS
+        logger.info("Authenticating...")
+        # First step is to get authenticate and get a valid token
+        gis = GIS(arguments.org_url,
+                  username=arguments.username,
+                  password=arguments.password,
+                  verify_cert=not arguments.skip_ssl_verification)
+
+    if arguments.input_path:
+        logger.info(f"Reading tracks from {arguments.input_path}")
+        batches = read_files(arguments.input_path, fields, arguments.x_field, arguments.y_field)
+        input_is_wgs84 = arguments.input_wkid == 4326
+    else:
+        logger.info("Getting tracks layer")
+        if arguments.tracks_layer_url:
+            tracks_layer = FeatureLayer(url=arguments.tracks_layer_url, gis=gis)
+        else:
+            try:
+                tracks_layer = gis.admin.location_tracking.tracks_layer
+            except Exception as e:
+                logger.info(e)
+                logger.info("Getting location tracking service failed - "
+                            "check that you are an admin and that location tracking is enabled for your organization")
+                sys.exit(0)
+        start_date = pendulum.parse(arguments.start_date, tz=arguments.time_zone).in_tz('UTC') if arguments.start_date else None
+        end_date = pendulum.parse(arguments.end_date, tz=arguments.time_zone).in_tz('UTC') if arguments.end_date else None
+        where = f"({create_time_clause(start_date, end_date)}) AND ({arguments.where})"
+        batches = read_layer(tracks_layer, where, fields, grid.spatial_reference, arguments.page_size)
+        input_is_wgs84 = grid.style == "geohash"
+
+    total = 0
+    for xs, ys, values in batches:
+        valid = ~(numpy.isnan(xs) | numpy.isnan(ys))
+        xs, ys = xs[valid], ys[valid]
+        values = {field: field_values[valid] for field, field_values in values.items()}
+        if input_is_wgs84 and grid.style != "geohash":
+            xs, ys = to_web_mercator(xs, ys)
+        elif not input_is_wgs84 and grid.style == "geohash":
+            xs, ys = to_wgs84(xs, ys)
+        accumulator.add(grid.bin_keys(xs, ys), values)
+        total += len(xs)
+        logger.debug(f"Aggregated {total} tracks into {len(accumulator)} bins")
+    logger.info(f"Aggregated {total} tracks into {len(accumulator)} bins")
+
+    failed = 0
+    if arguments.output_layer_url:
+        output_layer = FeatureLayer(url=arguments.output_layer_url, gis=gis)
+        # The output layer doesn't need a global id field, so the bins are added by object id
+        failed = edit_features_in_batches(output_layer, logger, adds=create_bin_features(grid, accumulator), batch_size=arguments.batch_size)["failed"]
+    if arguments.output_file:
+        write_output(grid, accumulator, arguments.output_file)
+        logger.info(f"Bins written to {arguments.output_file}")
+    if failed:
+        raise Exception(f"{failed} bins could not be added to the output layer")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Aggregate tracks into hexagon, square, or geohash bins")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with")
+    parser.add_argument('-p', dest='password', help="The password to authenticate with")
+    parser.add_argument('-org', dest='org_url', help="The url of the org/portal to use. Not required when reading from -input-path and writing to a file")
+    # Parameters for tracker
+    parser.add_argument('-tracks-layer-url', dest='tracks_layer_url', default=None,
+                        help="The tracks layer (either location tracking service or tracks view) you'd like to use. "
+                             "Defaults to the Location Tracking Service tracks layer")
+    parser.add_argument('-where', dest='where', default="1=1", help="Query conditions for the tracks to aggregate. Defaults to all (1=1)")
+    parser.add_argument('-start-date', dest='start_date', default=None, help="The start of the time period to aggregate (optional)")
+    parser.add_argument('-end-date', dest='end_date', default=None, help="The end of the time period to aggregate (optional)")
+    parser.add_argument('-time-zone', dest='time_zone', default='UTC', help="The time zone of the start and end dates. Defaults to UTC")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of tracks to request per page. Defaults to the max record count of the tracks layer")
+    parser.add_argument('-input-path', dest='input_path', default=None,
+                        help="Aggregate tracks from a CSV or Parquet file, or a directory of them (for example the output of export_tracks), "
+                             "instead of the tracks layer")
+    parser.add_argument('-input-wkid', dest='input_wkid', type=int, default=4326,
+                        help="The spatial reference of the coordinates in the input files, 3857 or 4326. "
+                             "Defaults to 4326, the spatial reference export_tracks writes")
+    parser.add_argument('-x-field', dest='x_field', default="x", help="The x coordinate column of the input files. Defaults to x")
+    parser.add_argument('-y-field', dest='y_field', default="y", help="The y coordinate column of the input files. Defaults to y")
+    parser.add_argument('-style', dest='style', default="flatHexagon", choices=STYLES, help="The shape of the bins. Defaults to flatHexagon")
+    parser.add_argument('-bin-size', dest='bin_size', type=float, default=500,
+                        help="The size of the bins in meters: the distance from the center to a corner for hexagons, the width for squares. "
+                             "Defaults to 500")
+    parser.add_argument('-geohash-precision', dest='geohash_precision', type=int, default=7,
+                        help="The number of characters of the geohash bins, 1 to 12. Defaults to 7")
+    parser.add_argument('-statistic-fields', dest='statistic_fields', default="horizontal_accuracy",
+                        help="A comma separated list of numeric fields to calculate the average, min, max, and sum of per bin. "
+                             "Defaults to horizontal_accuracy")
+    parser.add_argument('-output-file', dest='output_file', default=None,
+                        help="The file to write the bins to. Files ending in .geojson are written as GeoJSON polygons, others as CSV")
+    parser.add_argument('-output-layer-url', dest='output_layer_url', default=None,
+                        help="A polygon layer to add the bins to. It must have bin_id, count, and <field>_avg/_min/_max/_sum fields")
+    parser.add_argument('-batch-size', dest='batch_size', type=int, default=500, help="The number of bins to add per request. Defaults to 500")
+    parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('--skip-ssl-verification',
+                        dest='skip_ssl_verification',
+                        action='store_true',
+                        help="Verify the SSL Certificate of the server")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        with profile(args):
+            main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
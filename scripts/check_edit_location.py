@@ -14,6 +14,7 @@
     You must be an admin in your organization to use this script
 """
 import argparse
+import csv
 import datetime
 import logging
 import logging.handlers
@@ -21,8 +22,17 @@ import pandas
 import traceback
 import sys
 import arcgis
-from arcgis.gis import GIS
 from arcgis.features import FeatureLayer
+from instrumentation import add_profile_arguments, profile
+from session_cache import add_cache_arguments, connect, get_tracks_layer
+from track_index import TrackIndex, create_time_clause, query_pages
+from track_store import add_track_store_arguments, open_track_store
+
+# Spatial reference and field names of the tracks layer
+SR = {'wkid': 3857, 'latestWkid': 3857}
+ACCURACY_FIELD = "horizontal_accuracy"
+CREATOR_FIELD = "created_user"
+TIMESTAMP_FIELD = "location_timestamp"
 
 
 def initialize_logging(log_file=None):
@@ -59,9 +69,15 @@ def return_field_name(layer, name_to_check):
             return field['name']
 
 
-def get_invalid_work_orders(layer, field_name, time_tolerance, dist_tolerance, min_accuracy, workers, tracks_layer, logger):
+def get_features_to_check(layer, dist_tolerance, min_accuracy, workers, logger):
     """
-    Finds all invalid work orders by comparing a date vs. worker location
+    Queries the features last edited by the workers and buffers them by the distance tolerance and minimum accuracy
+    :param layer: (FeatureLayer) The layer with the features to verify
+    :param dist_tolerance: (int) The distance tolerance in meters
+    :param min_accuracy: (int) The minimum accuracy in meters
+    :param workers: (list) The user_id's of the workers to check
+    :param logger: (Logger) The logger to use
+    :return: (tuple) The spatially enabled dataframe of features, the editor field name, and the object id field name
     """
     # Query for all features last edited by a worker in your list
     logger.info("Querying for features edited by a worker in your list")
@@ -77,8 +93,7 @@ def get_invalid_work_orders(layer, field_name, time_tolerance, dist_tolerance, m
         logger.info("Please pass at least one worker user_id")
         sys.exit()
     # These are the features whose corresponding editors we will check
-    sr = {'wkid': 3857, 'latestWkid': 3857}
-    features_df = layer.query(where=layer_query_string, out_sr=sr, return_all_records=True, as_df=True)
+    features_df = layer.query(where=layer_query_string, out_sr=SR, return_all_records=True, as_df=True)
     if len(features_df.index) == 0:
         logger.info("No features found to check. Please check the user_id's that you have passed")
         sys.exit(0)
@@ -86,15 +101,18 @@ def get_invalid_work_orders(layer, field_name, time_tolerance, dist_tolerance, m
     # buffer features to use as geometry filter
     # Use the geometry service instead of the local geometry engine because there is a bug in the Python API
     # when using a shapely geometry as a filter
-    buffered_geometries = arcgis.geometry.buffer(features_df["SHAPE"].tolist(), in_sr=sr, distances=dist_tolerance + min_accuracy, unit=9001)
+    buffered_geometries = arcgis.geometry.buffer(features_df["SHAPE"].tolist(), in_sr=SR, distances=dist_tolerance + min_accuracy, unit=9001)
     features_df["BUFFERED"] = buffered_geometries
     features_df.spatial.set_geometry("BUFFERED")
-    features_df.spatial.sr = sr
+    features_df.spatial.sr = SR
+    return features_df, editor_field, object_id_field
 
-    # Set field names
-    accuracy_field = "horizontal_accuracy"
-    creator_field = "created_user"
-    timestamp_field = "location_timestamp"
+
+def get_invalid_work_orders(layer, field_name, time_tolerance, dist_tolerance, min_accuracy, workers, tracks_layer, logger):
+    """
+    Finds all invalid work orders by comparing a date vs. worker location
+    """
+    features_df, editor_field, object_id_field = get_features_to_check(layer, dist_tolerance, min_accuracy, workers, logger)
 
     # Find invalid features
     invalid_features = []
@@ -117,7 +135,7 @@ def get_invalid_work_orders(layer, field_name, time_tolerance, dist_tolerance, m
         end_date = date_to_check + datetime.timedelta(minutes=time_tolerance)
 
         # Check there are actually tracks in your LTS in that time period. Otherwise, go to next feature
-        check_track_query = f"{timestamp_field} < timestamp '{end_date.strftime('%Y-%m-%d %H:%M:%S')}'"
+        check_track_query = f"{TIMESTAMP_FIELD} < timestamp '{end_date.strftime('%Y-%m-%d %H:%M:%S')}'"
         check_tracks = tracks_layer.query(where=check_track_query, return_count_only=True)
         if check_tracks == 0:
             logger.info("For this feature, no tracks exist for the time period in your LTS. "
@@ -125,20 +143,20 @@ def get_invalid_work_orders(layer, field_name, time_tolerance, dist_tolerance, m
             continue
 
         # Check worker has tracks for that time period
-        check_worker_tracks_query = f"{timestamp_field} < timestamp '{end_date.strftime('%Y-%m-%d %H:%M:%S')}' AND {creator_field} = '{row[editor_field]}' "
+        check_worker_tracks_query = f"{TIMESTAMP_FIELD} < timestamp '{end_date.strftime('%Y-%m-%d %H:%M:%S')}' AND {CREATOR_FIELD} = '{row[editor_field]}' "
         check_worker_tracks = tracks_layer.query(where=check_worker_tracks_query, return_count_only=True)
         if check_worker_tracks == 0:
             logger.info(f"The worker {row[editor_field]} who edited the feature {row[object_id_field]} does not have tracks for this time period")
             continue
 
         # Make a query string to select location by the worker during the time period
-        loc_query_string = f"{creator_field} = '{row[editor_field]}' " \
-            f"AND {timestamp_field} >= timestamp '{start_date.strftime('%Y-%m-%d %H:%M:%S')}' " \
-            f"AND {timestamp_field} <= timestamp '{end_date.strftime('%Y-%m-%d %H:%M:%S')}' " \
-            f"AND {accuracy_field} <= {min_accuracy}" \
+        loc_query_string = f"{CREATOR_FIELD} = '{row[editor_field]}' " \
+            f"AND {TIMESTAMP_FIELD} >= timestamp '{start_date.strftime('%Y-%m-%d %H:%M:%S')}' " \
+            f"AND {TIMESTAMP_FIELD} <= timestamp '{end_date.strftime('%Y-%m-%d %H:%M:%S')}' " \
+            f"AND {ACCURACY_FIELD} <= {min_accuracy}" \
 
         # Generate geometry filter, query the feature layer
-        geom_filter = arcgis.geometry.filters.intersects(row['BUFFERED'], sr=sr)
+        geom_filter = arcgis.geometry.filters.intersects(row['BUFFERED'], sr=SR)
         tracks_within_buffer = tracks_layer.query(where=loc_query_string, geometry_filter=geom_filter, return_count_only=True)
         # each element of the list is a list with two elements - user_id and object_id
         if tracks_within_buffer == 0:
@@ -146,50 +164,394 @@ def get_invalid_work_orders(layer, field_name, time_tolerance, dist_tolerance, m
     return invalid_features
 
 
+def to_epoch_ms(date):
+    """
+    Converts a (UTC) pandas Timestamp or datetime to epoch milliseconds
+    :param date: (Timestamp) The date to convert
+    :return: (int) The epoch milliseconds
+    """
+    return int(pandas.Timestamp(date).value // 1000000)
+
+
+def get_first_track_times(tracks_layer, workers):
+    """
+    Gets the timestamp of the first track in the layer overall and for each worker (2 statistics queries in total)
+    :param tracks_layer: (FeatureLayer) The tracks layer to query
+    :param workers: (list) The user_id's of the workers to check
+    :return: (tuple) The first track time overall (epoch ms or None) and a dict of worker to first track time (epoch ms)
+    """
+    statistics = [{"statisticType": "min", "onStatisticField": TIMESTAMP_FIELD, "outStatisticFieldName": "first_track"}]
+    overall = tracks_layer.query(where="1=1", out_statistics=statistics).features
+    first_track = overall[0].attributes["first_track"] if overall else None
+    workers_string = ", ".join(f"'{worker}'" for worker in workers)
+    per_worker = tracks_layer.query(where=f"{CREATOR_FIELD} IN ({workers_string})",
+                                    group_by_fields_for_statistics=CREATOR_FIELD,
+                                    out_statistics=statistics).features
+    return first_track, {f.attributes[CREATOR_FIELD]: f.attributes["first_track"] for f in per_worker}
+
+
+def get_worker_window_clause(worker, start_date, end_date, min_accuracy):
+    """
+    Creates the where clause for the tracks of a worker within a time window that meet the minimum accuracy
+    :param worker: (string) The user_id of the worker
+    :param start_date: (Timestamp) The start of the window
+    :param end_date: (Timestamp) The end of the window
+    :param min_accuracy: (int) The minimum accuracy in meters
+    :return: (string) The where clause
+    """
+    return f"({CREATOR_FIELD} = '{worker}' " \
+        f"AND {TIMESTAMP_FIELD} >= timestamp '{start_date.strftime('%Y-%m-%d %H:%M:%S')}' " \
+        f"AND {TIMESTAMP_FIELD} <= timestamp '{end_date.strftime('%Y-%m-%d %H:%M:%S')}' " \
+        f"AND {ACCURACY_FIELD} <= {min_accuracy})"
+
+
+def is_near(buffered_geometry, xs, ys):
+    """
+    Checks if any of the points fall within the buffered geometry
+    :param buffered_geometry: (Polygon) The buffered feature geometry
+    :param xs: (ndarray) The x coordinates of the candidate points
+    :param ys: (ndarray) The y coordinates of the candidate points
+    :return: (bool) True if at least one point falls within the buffer
+    """
+    xmin, ymin, xmax, ymax = buffered_geometry.extent
+    in_extent = (xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)
+    for x, y in zip(xs[in_extent], ys[in_extent]):
+        if buffered_geometry.contains(arcgis.geometry.Point({"x": x, "y": y, "spatialReference": SR})):
+            return True
+    return False
+
+
+def get_invalid_work_orders_bulk(layer, field_name, time_tolerance, dist_tolerance, min_accuracy, workers, tracks_layer, logger, page_size=None,
+                                 track_store=None):
+    """
+    Finds all invalid work orders by comparing a date vs. worker location.
+    Rather than querying the tracks layer for every feature, the tracks of the workers are fetched once (in pages) for
+    the whole audit window into a TrackIndex, or loaded from a track store, and each feature is checked locally
+    """
+    features_df, editor_field, object_id_field = get_features_to_check(layer, dist_tolerance, min_accuracy, workers, logger)
+    if field_name not in features_df.columns:
+        logger.info("Check that the exact field name exists in the feature layer")
+        sys.exit(0)
+    # date field may not be populated
+    features_df = features_df[features_df[field_name].notnull()]
+    tolerance = datetime.timedelta(minutes=time_tolerance)
+
+    logger.info("Checking the first track of each worker")
+    first_track, first_worker_tracks = get_first_track_times(tracks_layer, workers)
+
+    # Fetch the tracks of every worker for the time window covering all of their features
+    logger.info("Fetching the tracks of the workers")
+    if track_store:
+        # the store is queried for one window covering every worker, the features are still checked against their own window
+        track_index = track_store.to_track_index(start=to_epoch_ms(features_df[field_name].min() - tolerance),
+                                                 end=to_epoch_ms(features_df[field_name].max() + tolerance) + 1000,
+                                                 users=sorted(features_df[editor_field].unique()),
+                                                 max_accuracy=float(min_accuracy))
+    else:
+        window_clauses = []
+        for worker, worker_df in features_df.groupby(editor_field):
+            start_date = worker_df[field_name].min() - tolerance
+            end_date = worker_df[field_name].max() + tolerance
+            window_clauses.append(get_worker_window_clause(worker, start_date, end_date, min_accuracy))
+        track_index = TrackIndex.from_layer(tracks_layer, where=" OR ".join(window_clauses), out_sr=SR, page_size=page_size)
+    logger.info(f"Fetched {len(track_index)} tracks")
+
+    # Find invalid features
+    invalid_features = []
+    logger.info("Finding invalid features")
+    for worker, worker_df in features_df.groupby(editor_field):
+        for index, row in worker_df.iterrows():
+            feature_start = to_epoch_ms(row[field_name] - tolerance)
+            feature_end = to_epoch_ms(row[field_name] + tolerance)
+
+            # Check there are actually tracks in your LTS in that time period. Otherwise, go to next feature
+            if first_track is None or first_track >= feature_end:
+                logger.info("For this feature, no tracks exist for the time period in your LTS. "
+                            "Ensure that tracks have been retained for the time period you're verifying")
+                continue
+
+            # Check worker has tracks for that time period
+            if worker not in first_worker_tracks or first_worker_tracks[worker] >= feature_end:
+                logger.info(f"The worker {worker} who edited the feature {row[object_id_field]} does not have tracks for this time period")
+                continue
+
+            # Select locations by the worker during the time period
+            positions = track_index.query_time(worker, feature_start, feature_end, max_accuracy=float(min_accuracy))
+            # each element of the list is a list with two elements - user_id and object_id
+            if not is_near(row['BUFFERED'], track_index.xs[positions], track_index.ys[positions]):
+                invalid_features.append([worker, row[object_id_field]])
+    return invalid_features
+
+
+def get_date_range(layer, field_name, where):
+    """
+    Gets the first and last date of the features of a layer (1 statistics query)
+    :param layer: (FeatureLayer) The layer with the features to verify
+    :param field_name: (string) The date field
+    :param where: (string) The where clause of the features
+    :return: (tuple) The first and last date in epoch ms, or None if no features have a date
+    """
+    statistics = [{"statisticType": "min", "onStatisticField": field_name, "outStatisticFieldName": "first_date"},
+                  {"statisticType": "max", "onStatisticField": field_name, "outStatisticFieldName": "last_date"}]
+    features = layer.query(where=where, out_statistics=statistics).features
+    if not features or features[0].attributes["first_date"] is None:
+        return None
+    return features[0].attributes["first_date"], features[0].attributes["last_date"]
+
+
+def create_date_clause(field_name, start, end):
+    """
+    Creates a where clause for the features with a date within a time slice
+    :param field_name: (string) The date field
+    :param start: (int) The start of the slice in epoch ms (inclusive)
+    :param end: (int) The end of the slice in epoch ms (exclusive)
+    :return: (string) The where clause
+    """
+    start_date = pandas.Timestamp(start, unit="ms")
+    end_date = pandas.Timestamp(end, unit="ms")
+    return f"{field_name} >= timestamp '{start_date.strftime('%Y-%m-%d %H:%M:%S')}' " \
+        f"AND {field_name} < timestamp '{end_date.strftime('%Y-%m-%d %H:%M:%S')}'"
+
+
+def query_feature_chunks(layer, where, field_name, object_id_field, editor_field, chunk_size):
+    """
+    Queries the features of a layer one chunk at a time, ordered by date so the chunks are time ordered and paging is stable
+    :param layer: (FeatureLayer) The layer with the features to verify
+    :param where: (string) The where clause
+    :param field_name: (string) The date field
+    :param object_id_field: (string) The object id field
+    :param editor_field: (string) The editor field
+    :param chunk_size: (int) The number of features per chunk. Capped to the maxRecordCount of the layer
+    :return: (generator) Yields the list of features of each chunk
+    """
+    return query_pages(layer, where, out_fields=f"{object_id_field},{field_name},{editor_field}", out_sr=SR, page_size=chunk_size,
+                       order_by=f"{field_name} ASC, {object_id_field} ASC")
+
+
+def iter_invalid_work_orders_stream(layers, time_tolerance, dist_tolerance, min_accuracy, workers, tracks_layer, logger,
+                                    start_date=None, end_date=None, time_slice_hours=24, chunk_size=1000, page_size=None, track_store=None):
+    """
+    Finds invalid work orders across several layers and date fields, one time slice at a time. The tracks of the
+    workers for each slice are fetched once and shared by all of the layers, and the features of each layer are
+    checked in chunks, so memory use depends on the slice length and the chunk size rather than the audit length
+    :param layers: (list) The (FeatureLayer, date field name) pairs to verify
+    :param time_tolerance: (int) The time tolerance in minutes
+    :param dist_tolerance: (int) The distance tolerance in meters
+    :param min_accuracy: (int) The minimum accuracy in meters
+    :param workers: (list) The user_id's of the workers to check
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :param logger: (Logger) The logger to use
+    :param start_date: (Timestamp) The start of the audit in UTC. Defaults to the first date of the features
+    :param end_date: (Timestamp) The end of the audit in UTC. Defaults to the last date of the features
+    :param time_slice_hours: (float) The length of each time slice in hours
+    :param chunk_size: (int) The number of features to check at a time
+    :param page_size: (int) The number of tracks to request per page
+    :param track_store: (TrackStore) Load the tracks of each slice from this store instead of the tracks layer (optional)
+    :return: (generator) Yields the (layer url, date field, user_id, object_id, date in epoch ms) of each invalid feature
+    """
+    tolerance_ms = time_tolerance * 60000
+    # The where clauses have a precision of seconds, so the slices start and end on whole seconds
+    slice_ms = max(int(time_slice_hours * 3600), 1) * 1000
+    targets = []
+    for layer, field_name in layers:
+        if field_name not in (field["name"] for field in layer.properties.fields):
+            logger.info(f"Check that the exact field name {field_name} exists in the feature layer {layer.url}")
+            sys.exit(0)
+        editor_field = return_field_name(layer, name_to_check="Editor")
+        workers_clause = " OR ".join(f"{editor_field} = '{worker}'" for worker in workers)
+        targets.append((layer, field_name, return_field_name(layer, name_to_check="OBJECTID"), editor_field, f"({workers_clause})"))
+
+    # Use the dates of the features for the bounds of the audit that weren't provided
+    start = to_epoch_ms(start_date) if start_date is not None else None
+    end = to_epoch_ms(end_date) if end_date is not None else None
+    if start is None or end is None:
+        date_ranges = [date_range for date_range in (get_date_range(layer, field_name, where) for layer, field_name, _, _, where in targets) if date_range]
+        if not date_ranges:
+            logger.info("No features found to check. Please check the user_id's that you have passed")
+            return
+        start = min(date_range[0] for date_range in date_ranges) if start is None else start
+        end = max(date_range[1] for date_range in date_ranges) + 1 if end is None else end
+    start = start // 1000 * 1000
+    end = -(-end // 1000) * 1000
+
+    logger.info("Checking the first track of each worker")
+    first_track, first_worker_tracks = get_first_track_times(tracks_layer, workers)
+    workers_string = ", ".join(f"'{worker}'" for worker in workers)
+
+    for slice_start in range(start, end, slice_ms):
+        slice_end = min(slice_start + slice_ms, end)
+        slice_label = f"{pandas.Timestamp(slice_start, unit='ms')} - {pandas.Timestamp(slice_end, unit='ms')}"
+        slice_targets = []
+        for layer, field_name, object_id_field, editor_field, workers_clause in targets:
+            where = f"{workers_clause} AND {create_date_clause(field_name, slice_start, slice_end)}"
+            if layer.query(where=where, return_count_only=True) > 0:
+                slice_targets.append((layer, field_name, object_id_field, editor_field, where))
+        if not slice_targets:
+            continue
+
+        # Fetch the tracks of the workers for the slice once for all of the layers
+        window_start = pandas.Timestamp(slice_start - tolerance_ms, unit="ms")
+        window_end = pandas.Timestamp(slice_end + tolerance_ms + 1000, unit="ms")
+        if track_store:
+            track_index = track_store.to_track_index(start=to_epoch_ms(window_start), end=to_epoch_ms(window_end), users=workers,
+                                                     max_accuracy=float(min_accuracy))
+        else:
+            tracks_where = f"{CREATOR_FIELD} IN ({workers_string}) AND {ACCURACY_FIELD} <= {min_accuracy} AND {create_time_clause(window_start, window_end)}"
+            track_index = TrackIndex.from_layer(tracks_layer, where=tracks_where, out_sr=SR, page_size=page_size)
+        logger.info(f"Fetched {len(track_index)} tracks for {slice_label}")
+
+        checked = 0
+        for layer, field_name, object_id_field, editor_field, where in slice_targets:
+            for chunk in query_feature_chunks(layer, where, field_name, object_id_field, editor_field, chunk_size):
+                chunk = [feature for feature in chunk if feature.geometry]
+                if not chunk:
+                    continue
+                # buffer features to use as geometry filter, one geometry service request per chunk
+                geometries = [arcgis.geometry.Geometry(feature.geometry) for feature in chunk]
+                buffered_geometries = arcgis.geometry.buffer(geometries, in_sr=SR, distances=dist_tolerance + min_accuracy, unit=9001)
+                for feature, buffered_geometry in zip(chunk, buffered_geometries):
+                    worker = feature.attributes[editor_field]
+                    edit_date = feature.attributes[field_name]
+                    feature_start = edit_date - tolerance_ms
+                    feature_end = edit_date + tolerance_ms
+                    # Skip features edited before the tracks (of the worker) were retained
+                    if first_track is None or first_track >= feature_end:
+                        continue
+                    if worker not in first_worker_tracks or first_worker_tracks[worker] >= feature_end:
+                        continue
+                    positions = track_index.query_time(worker, feature_start, feature_end, max_accuracy=float(min_accuracy))
+                    if not is_near(buffered_geometry, track_index.xs[positions], track_index.ys[positions]):
+                        yield layer.url, field_name, worker, feature.attributes[object_id_field], edit_date
+                checked += len(chunk)
+        logger.info(f"Checked {checked} features for {slice_label}")
+
+
+def iter_invalid_work_orders(layers, arguments, workers, tracks_layer, logger, track_store=None):
+    """
+    Finds the invalid work orders of each layer, using --bulk if provided
+    :param layers: (list) The (FeatureLayer, date field name) pairs to verify
+    :param arguments: (Namespace) The command line arguments
+    :param workers: (list) The user_id's of the workers to check
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :param logger: (Logger) The logger to use
+    :param track_store: (TrackStore) Load the tracks from this store with --bulk (optional)
+    :return: (generator) Yields the (layer url, date field, user_id, object_id, date) of each invalid feature. The date is not known
+    """
+    for layer, field_name in layers:
+        if arguments.bulk:
+            invalid_work_orders = get_invalid_work_orders_bulk(layer,
+                                                               field_name,
+                                                               arguments.time_tolerance,
+                                                               arguments.distance_tolerance,
+                                                               arguments.min_accuracy,
+                                                               workers,
+                                                               tracks_layer,
+                                                               logger,
+                                                               arguments.page_size,
+                                                               track_store)
+        else:
+            invalid_work_orders = get_invalid_work_orders(layer,
+                                                          field_name,
+                                                          arguments.time_tolerance,
+                                                          arguments.distance_tolerance,
+                                                          arguments.min_accuracy,
+                                                          workers,
+                                                          tracks_layer,
+                                                          logger)
+        for worker, object_id in invalid_work_orders:
+            yield layer.url, field_name, worker, object_id, None
+
+
+def report_invalid_work_orders(invalid_work_orders, output_file, logger):
+    """
+    Logs the invalid work orders as they are found, and writes them to a CSV file if provided. Each row is flushed
+    so the file is complete up to the last feature checked, even if the run is interrupted
+    :param invalid_work_orders: (iterable) The (layer url, date field, user_id, object_id, date in epoch ms) of each invalid feature
+    :param output_file: (string) The CSV file to write to (optional)
+    :param logger: (Logger) The logger to use
+    :return: (int) The number of invalid work orders
+    """
+    f = open(output_file, "w", newline="") if output_file else None
+    try:
+        writer = csv.writer(f) if f else None
+        if writer:
+            writer.writerow(["layer_url", "field_name", "user_id", "object_id", "date"])
+        count = 0
+        for layer_url, field_name, worker, object_id, edit_date in invalid_work_orders:
+            logger.info(f"The user {worker} who last edited the feature with OBJECTID {object_id} in {layer_url} was potentially "
+                        f"not within the distance tolerance when updating the field {field_name}")
+            if writer:
+                writer.writerow([layer_url, field_name, worker, object_id,
+                                 pandas.Timestamp(edit_date, unit="ms").isoformat() if edit_date is not None else ""])
+                f.flush()
+            count += 1
+        return count
+    finally:
+        if f:
+            f.close()
+
+
 def main(arguments):
     # initialize logger
     logger = initialize_logging(arguments.log_file)
     # Create the GIS
     logger.info("Authenticating...")
     # First step is to get authenticate and get a valid token
-    gis = GIS(arguments.org_url,
-              username=arguments.username,
-              password=arguments.password,
-              verify_cert=not arguments.skip_ssl_verification)
-
-    # Get the feature layer
-    logger.info("Getting feature layer")
-    layer = FeatureLayer(arguments.layer_url)
+    # A streaming audit can run for longer than a cached token is valid, so it always signs in
+    gis = connect(arguments, logger, use_cached_token=not arguments.stream)
+
+    # Get the feature layers, each paired with its date field
+    logger.info("Getting feature layers")
+    field_names = arguments.field_name * len(arguments.layer_url) if len(arguments.field_name) == 1 else arguments.field_name
+    if len(field_names) != len(arguments.layer_url):
+        logger.info("Pass either one -field-name for all of the layers or one -field-name per -layer-url")
+        sys.exit(0)
+    layers = [(FeatureLayer(layer_url), field_name) for layer_url, field_name in zip(arguments.layer_url, field_names)]
     logger.info("Getting tracks layer")
     if arguments.tracks_layer_url:
         tracks_layer = FeatureLayer(url=arguments.tracks_layer_url)
     else:
         try:
-            tracks_layer = gis.admin.location_tracking.tracks_layer
+            tracks_layer = get_tracks_layer(gis)
         except Exception as e:
             logger.info(e)
             logger.info("Getting location tracking service failed - check that you are an admin and that location tracking is enabled for your organization")
             sys.exit(0)
 
+    track_store = open_track_store(arguments.track_store, logger) if arguments.track_store and (arguments.bulk or arguments.stream) else None
+
     # Return invalid work orders
     workers = arguments.workers.replace(" ", "").split(",")
-    invalid_work_orders = get_invalid_work_orders(layer,
-                                                  arguments.field_name,
-                                                  arguments.time_tolerance,
-                                                  arguments.distance_tolerance,
-                                                  arguments.min_accuracy,
-                                                  workers,
-                                                  tracks_layer,
-                                                  logger)
-    if len(invalid_work_orders) == 0:
-        logger.info("No features found that match the criteria you've set")
+    if arguments.stream:
+        start_date = pandas.Timestamp(arguments.start_date) if arguments.start_date else None
+        end_date = pandas.Timestamp(arguments.end_date) if arguments.end_date else None
+        invalid_work_orders = iter_invalid_work_orders_stream(layers,
+                                                              arguments.time_tolerance,
+                                                              arguments.distance_tolerance,
+                                                              arguments.min_accuracy,
+                                                              workers,
+                                                              tracks_layer,
+                                                              logger,
+                                                              start_date,
+                                                              end_date,
+                                                              arguments.time_slice_hours,
+                                                              arguments.chunk_size,
+                                                              arguments.page_size,
+                                                              track_store)
     else:
-        for work_order in invalid_work_orders:
-            logger.info(f"The user {work_order[0]} who last edited the feature with OBJECTID {work_order[1]} was potentially "
-                        f"not within the distance tolerance when updating the field {arguments.field_name}")
+        invalid_work_orders = iter_invalid_work_orders(layers, arguments, workers, tracks_layer, logger, track_store)
+    count = report_invalid_work_orders(invalid_work_orders, arguments.output_file, logger)
+    if count == 0:
+        logger.info("No features found that match the criteria you've set")
+    elif arguments.output_file:
+        logger.info(f"Wrote {count} features to {arguments.output_file}")
 
 
-if __name__ == "__main__":
+def create_parser():
+    """
+    Creates the parser of the command line arguments
+    :return: (ArgumentParser) The parser
+    """
     # Get all of the commandline arguments
     parser = argparse.ArgumentParser("Check that the worker was nearby when editing features")
     parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
@@ -197,11 +559,11 @@ if __name__ == "__main__":
     parser.add_argument('-org', dest='org_url', help="The url of the org/portal to use", required=True)
     # Parameters for tracker
     parser.add_argument('-workers', dest='workers', help="Comma separated list of user_id's for the workers to check")
-    parser.add_argument('-field-name', dest='field_name', default="EditDate",
+    parser.add_argument('-field-name', dest='field_name', nargs='+', default=["EditDate"],
                         help="The date field name within the feature layer you use to integrate with Tracker. "
-                             "Use actual field name, not alias. Default is EditDate (for AGOL)")
-    parser.add_argument('-layer-url', dest='layer_url',
-                        help="The feature service URL for your Survey, Collector, or Workforce assignments feature layer with features to be verified",
+                             "Use actual field name, not alias. Either one for all of the layers or one per layer. Default is EditDate (for AGOL)")
+    parser.add_argument('-layer-url', dest='layer_url', nargs='+',
+                        help="The feature service URLs for your Survey, Collector, or Workforce assignments feature layers with features to be verified",
                         required=True)
     parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
     parser.add_argument('-time-tolerance', dest='time_tolerance',
@@ -213,13 +575,39 @@ if __name__ == "__main__":
     parser.add_argument('-tracks-layer-url', dest='tracks_layer_url', default=None,
                         help="The tracks layer (either location tracking service or tracks view) you'd like to use. "
                              "Defaults to the Location Tracking Service tracks layer")
+    parser.add_argument('--bulk', dest='bulk', action='store_true',
+                        help="If provided, fetch the tracks of each worker once for the whole audit window and check the features locally "
+                             "instead of querying the tracks layer for every feature")
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help="If provided, check the features of all of the layers one time slice and one chunk at a time, fetching the tracks "
+                             "of each time slice once. Memory use depends on the slice length and chunk size rather than the audit length")
+    parser.add_argument('-start-date', dest='start_date', default=None,
+                        help="The start of the audit in UTC when using --stream. Defaults to the first date of the features (optional)")
+    parser.add_argument('-end-date', dest='end_date', default=None,
+                        help="The end of the audit in UTC when using --stream. Defaults to the last date of the features (optional)")
+    parser.add_argument('-time-slice-hours', dest='time_slice_hours', type=float, default=24,
+                        help="The length of each time slice in hours when using --stream. Defaults to 24")
+    parser.add_argument('-chunk-size', dest='chunk_size', type=int, default=1000,
+                        help="The number of features to check at a time when using --stream. Defaults to 1000")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of tracks to request per page when using --bulk or --stream. Defaults to the max record count of the tracks layer")
+    parser.add_argument('-output-file', dest='output_file', default=None,
+                        help="A CSV file to write the invalid features to as they are found (optional)")
     parser.add_argument('--skip-ssl-verification',
                         dest='skip_ssl_verification',
                         action='store_true',
                         help="Verify the SSL Certificate of the server")
-    args = parser.parse_args()
+    add_track_store_arguments(parser)
+    add_profile_arguments(parser)
+    add_cache_arguments(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
     try:
-        main(args)
+        with profile(args):
+            main(args)
     except Exception as e:
         logging.getLogger().critical("Exception detected, script exiting")
         logging.getLogger().critical(e)
@@ -0,0 +1,260 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This sample creates track lines from the track points of every user in a time window, the same way the
+    Tracker web and mobile apps render them, and adds them to a polyline layer.
+    The inclusion criteria, step distances, and time gaps are computed for all users at once with NumPy.
+"""
+import argparse
+import logging
+import logging.handlers
+import traceback
+import sys
+import numpy
+import pendulum
+from arcgis.gis import GIS
+from arcgis.features import Feature, FeatureLayer
+from edit_utils import edit_features_in_batches
+from instrumentation import add_profile_arguments, profile
+from track_index import CREATOR_FIELD, TIMESTAMP_FIELD, ACCURACY_FIELD, create_time_clause, query_pages
+from track_thinning import TrackThinner, add_thinning_arguments
+
+WGS84 = {'wkid': 4326}
+EARTH_RADIUS = 6371008.8
+
+
+def initialize_logging(log_file=None):
+    """
+    Setup logging
+    :param log_file: (string) The file to log to
+    :return: (Logger) a logging instance
+    """
+    # initialize logging
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(filename)30s:%(lineno)4s - %(funcName)30s()][%(threadName)5s] [%(name)10.10s] [%(levelname)8s] %(message)s")
+    # Grab the root logger
+    logger = logging.getLogger()
+    # Set the root logger logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+    logger.setLevel(logging.DEBUG)
+    # Create a handler to print to the console
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(formatter)
+    sh.setLevel(logging.INFO)
+    # Create a handler to log to the specified file
+    if log_file:
+        rh = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760)
+        rh.setFormatter(formatter)
+        rh.setLevel(logging.DEBUG)
+        logger.addHandler(rh)
+    # Add the handlers to the root logger
+    logger.addHandler(sh)
+    return logger
+
+
+def load_tracks(tracks_layer, where, page_size=None):
+    """
+    Queries the tracks one page at a time into NumPy arrays, sorted by user and then by time
+    :param tracks_layer: (FeatureLayer) The tracks layer to query
+    :param where: (string) The where clause
+    :param page_size: (int) The number of tracks to request per page. Defaults to the maxRecordCount of the layer
+    :return: (dict) The user names, and the user codes, timestamps (epoch ms), x, y, accuracy, speed, and course arrays
+    """
+    columns = {"users": [], "timestamps": [], "xs": [], "ys": [], "accuracies": [], "speeds": [], "courses": []}
+    out_fields = f"{CREATOR_FIELD},{TIMESTAMP_FIELD},{ACCURACY_FIELD},speed,course"
+    for page in query_pages(tracks_layer, where, out_fields=out_fields, out_sr=WGS84, page_size=page_size):
+        for feature in page:
+            attributes = feature.attributes
+            columns["users"].append(attributes[CREATOR_FIELD])
+            columns["timestamps"].append(attributes[TIMESTAMP_FIELD])
+            columns["xs"].append(feature.geometry["x"])
+            columns["ys"].append(feature.geometry["y"])
+            # missing values become NaN, which fails every comparison in the inclusion criteria
+            columns["accuracies"].append(numpy.nan if attributes.get(ACCURACY_FIELD) is None else attributes[ACCURACY_FIELD])
+            columns["speeds"].append(numpy.nan if attributes.get("speed") is None else attributes["speed"])
+            columns["courses"].append(numpy.nan if attributes.get("course") is None else attributes["course"])
+    names, codes = numpy.unique(numpy.asarray(columns["users"], dtype=object).astype(str), return_inverse=True)
+    timestamps = numpy.asarray(columns["timestamps"], dtype=numpy.int64)
+    order = numpy.lexsort((timestamps, codes))
+    tracks = {"names": [str(name) for name in names], "codes": codes[order], "timestamps": timestamps[order]}
+    for column in ("xs", "ys", "accuracies", "speeds", "courses"):
+        tracks[column] = numpy.asarray(columns[column], dtype=numpy.float64)[order]
+    return tracks
+
+
+def meets_inclusion_criteria(accuracies, speeds, courses):
+    """
+    Applies the "smart rendering" logic of the Tracker apps to determine which tracks are included in the lines
+    :param accuracies: (ndarray) The horizontal accuracy of each track
+    :param speeds: (ndarray) The speed of each track
+    :param courses: (ndarray) The course of each track
+    :return: (ndarray) True for each track that should be included
+    """
+    with numpy.errstate(invalid="ignore"):
+        has_speed = speeds >= 0
+        has_course = courses >= 0
+        return (accuracies <= 10) | ((accuracies <= 25) & (has_speed | has_course)) | (has_speed & has_course)
+
+
+def step_distances(xs, ys):
+    """
+    Computes the great circle distance between each point and the one before it
+    :param xs: (ndarray) The longitudes
+    :param ys: (ndarray) The latitudes
+    :return: (ndarray) The distance in meters from the previous point (0 for the first point)
+    """
+    lons = numpy.radians(xs)
+    lats = numpy.radians(ys)
+    a = numpy.sin(numpy.diff(lats) / 2) ** 2 + numpy.cos(lats[:-1]) * numpy.cos(lats[1:]) * numpy.sin(numpy.diff(lons) / 2) ** 2
+    distances = numpy.zeros(len(xs))
+    distances[1:] = 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
+    return distances
+
+
+def build_track_lines(codes, timestamps, xs, ys, max_distance=500, max_time_gap=600, max_vertices=100, thinner=None):
+    """
+    Splits the tracks into lines. A new line starts for each user, and whenever the distance and the time between
+    two consecutive tracks are both more than the limits. Each line is made of paths of at most max_vertices vertices
+    :param codes: (ndarray) The user code of each track, sorted by user and time along with the other arrays
+    :param timestamps: (ndarray) The timestamp (epoch ms) of each track
+    :param xs: (ndarray) The x coordinates
+    :param ys: (ndarray) The y coordinates
+    :param max_distance: (float) The distance (meters) between tracks above which a line may be split
+    :param max_time_gap: (float) The time (seconds) between tracks above which a line may be split
+    :param max_vertices: (int) The maximum number of vertices of each path
+    :param thinner: (TrackThinner) Thins the vertices of each line (optional)
+    :return: (list) (user code, start time, end time, paths) of each line with at least two vertices
+    """
+    if len(timestamps) == 0:
+        return []
+    breaks = numpy.ones(len(timestamps), dtype=bool)
+    breaks[1:] = (codes[1:] != codes[:-1]) | ((step_distances(xs, ys)[1:] > max_distance) & (numpy.diff(timestamps) > max_time_gap * 1000))
+    starts = numpy.flatnonzero(breaks)
+    ends = numpy.append(starts[1:], len(timestamps))
+    coordinates = numpy.column_stack((xs, ys))
+    if thinner:
+        # each line is thinned on its own, and keeps its first and last vertices
+        keep = thinner.thin(numpy.repeat(numpy.arange(len(starts)), ends - starts), timestamps, xs, ys)
+    else:
+        keep = numpy.ones(len(timestamps), dtype=bool)
+    lines = []
+    for start, end in zip(starts, ends):
+        if end - start < 2:
+            continue
+        line = coordinates[start:end][keep[start:end]]
+        # consecutive paths share a vertex so the line is continuous
+        paths = [line[i:min(i + max_vertices, len(line))].tolist() for i in range(0, len(line) - 1, max_vertices - 1)]
+        lines.append((codes[start], int(timestamps[start]), int(timestamps[end - 1]), paths))
+    return lines
+
+
+def create_track_line_features(tracks, max_distance=500, max_time_gap=600, max_vertices=100, thinner=None):
+    """
+    Creates the track line features of all users
+    :param tracks: (dict) The tracks, as returned by load_tracks
+    :param max_distance: (float) The distance (meters) between tracks above which a line may be split
+    :param max_time_gap: (float) The time (seconds) between tracks above which a line may be split
+    :param max_vertices: (int) The maximum number of vertices of each path
+    :param thinner: (TrackThinner) Thins the vertices of each line (optional)
+    :return: (list) The polyline features
+    """
+    included = meets_inclusion_criteria(tracks["accuracies"], tracks["speeds"], tracks["courses"])
+    lines = build_track_lines(tracks["codes"][included], tracks["timestamps"][included], tracks["xs"][included], tracks["ys"][included],
+                              max_distance, max_time_gap, max_vertices, thinner)
+    return [Feature(geometry={"paths": paths, "spatialReference": WGS84},
+                    attributes={"username": tracks["names"][code], "start_time": start_time, "end_time": end_time})
+            for code, start_time, end_time, paths in lines]
+
+
+def main(arguments):
+    # initialize logger
+    logger = initialize_logging(arguments.log_file)
+    # Create the GIS
+    logger.info("Authenticating...")
+    # First step is to get authenticate and get a valid token
+    gis = GIS(arguments.org_url,
+              username=arguments.username,
+              password=arguments.password,
+              verify_cert=not arguments.skip_ssl_verification)
+
+    logger.info("Getting tracks layer")
+    if arguments.tracks_layer_url:
+        tracks_layer = FeatureLayer(url=arguments.tracks_layer_url, gis=gis)
+    else:
+        try:
+            tracks_layer = gis.admin.location_tracking.tracks_layer
+        except Exception as e:
+            logger.info(e)
+            logger.info("Getting location tracking service failed - check that you are an admin and that location tracking is enabled for your organization")
+            sys.exit(0)
+    lines_layer = FeatureLayer(url=arguments.lines_layer_url, gis=gis)
+
+    start_date = pendulum.parse(arguments.start_date, tz=arguments.time_zone).in_tz('UTC')
+    end_date = pendulum.parse(arguments.end_date, tz=arguments.time_zone).in_tz('UTC')
+    where = create_time_clause(start_date, end_date)
+    if arguments.users:
+        users = ",".join(f"'{user.strip()}'" for user in arguments.users.split(","))
+        where = f"{where} AND {CREATOR_FIELD} IN ({users})"
+
+    logger.info("Querying tracks")
+    tracks = load_tracks(tracks_layer, where, arguments.page_size)
+    logger.info(f"Loaded {len(tracks['timestamps'])} tracks for {len(tracks['names'])} users")
+    thinner = TrackThinner.from_arguments(arguments)
+    features = create_track_line_features(tracks, arguments.max_distance, arguments.max_time_gap, thinner=thinner)
+    logger.info(f"Created {len(features)} track lines")
+    if thinner:
+        logger.info(thinner.summary())
+    if features:
+        # The lines layer doesn't need a global id field, so the lines are added by object id
+        summary = edit_features_in_batches(lines_layer, logger, adds=features, batch_size=arguments.batch_size, max_workers=arguments.max_workers)
+        if summary["failed"]:
+            raise Exception(f"{summary['failed']} of {len(features)} track lines could not be added")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Create track lines from the track points of all users in a time window")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
+    parser.add_argument('-p', dest='password', help="The password to authenticate with", required=True)
+    parser.add_argument('-org', dest='org_url', help="The url of the org/portal to use", required=True)
+    # Parameters for tracker
+    parser.add_argument('-lines-layer-url', dest='lines_layer_url', required=True,
+                        help="The polyline layer to add the track lines to. It must have username (string), start_time (date), and end_time (date) fields")
+    parser.add_argument('-tracks-layer-url', dest='tracks_layer_url', default=None,
+                        help="The tracks layer (either location tracking service or tracks view) you'd like to use. "
+                             "Defaults to the Location Tracking Service tracks layer")
+    parser.add_argument('-start-date', dest='start_date', required=True, help="The start of the time window, e.g. '2019-03-03 18:10:00'")
+    parser.add_argument('-end-date', dest='end_date', required=True, help="The end of the time window, e.g. '2019-03-03 20:30:00'")
+    parser.add_argument('-time-zone', dest='time_zone', default='UTC', help="The time zone of the start and end dates. Defaults to UTC")
+    parser.add_argument('-users', dest='users', default=None, help="A comma separated list of users to create lines for. Defaults to all users")
+    parser.add_argument('-max-distance', dest='max_distance', type=float, default=500,
+                        help="A line is split when two consecutive tracks are more than this many meters and -max-time-gap seconds apart. Defaults to 500")
+    parser.add_argument('-max-time-gap', dest='max_time_gap', type=float, default=600,
+                        help="A line is split when two consecutive tracks are more than this many seconds and -max-distance meters apart. Defaults to 600")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of tracks to request per page. Defaults to the max record count of the tracks layer")
+    parser.add_argument('-batch-size', dest='batch_size', type=int, default=200, help="The number of lines to add per request. Defaults to 200")
+    parser.add_argument('-max-workers', dest='max_workers', type=int, default=4, help="The number of add requests to send concurrently. Defaults to 4")
+    parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('--skip-ssl-verification',
+                        dest='skip_ssl_verification',
+                        action='store_true',
+                        help="Verify the SSL Certificate of the server")
+    add_thinning_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        with profile(args):
+            main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
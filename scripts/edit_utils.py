@@ -0,0 +1,123 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This module posts large numbers of edits to a feature layer in concurrent batches, retrying failed batches without
+    applying an edit twice.
+"""
+import concurrent.futures
+import random
+import time
+
+
+def normalize_global_id(global_id):
+    """
+    Normalizes a global id so that ids with and without brackets or with different casing match
+    :param global_id: (string) The global id
+    :return: (string) The normalized global id
+    """
+    return global_id.strip("{}").lower() if global_id else global_id
+
+
+def query_existing_global_ids(layer, global_ids, chunk_size=500):
+    """
+    Finds which of the given global ids are already in a layer
+    :param layer: (FeatureLayer) The layer
+    :param global_ids: (list) The global ids to look for
+    :param chunk_size: (int) The number of global ids to put in each query
+    :return: (set) The normalized global ids that are in the layer
+    """
+    global_id_field = layer.properties.globalIdField
+    existing = set()
+    for i in range(0, len(global_ids), chunk_size):
+        ids_string = ", ".join(f"'{global_id}'" for global_id in global_ids[i:i + chunk_size])
+        features = layer.query(f"{global_id_field} IN ({ids_string})", out_fields=global_id_field, return_geometry=False).features
+        existing.update(normalize_global_id(f.attributes[global_id_field]) for f in features)
+    return existing
+
+
+def get_global_id(feature, global_id_field):
+    """
+    Gets the global id of a feature, matching the field name regardless of case and underscores
+    :param feature: (Feature) The feature
+    :param global_id_field: (string) The global id field name
+    :return: (string) The global id, or None if the feature has none
+    """
+    return next((value for name, value in feature.attributes.items()
+                 if name.replace("_", "").lower() == global_id_field.replace("_", "").lower()), None)
+
+
+def edit_features_in_batches(layer, logger, adds=None, updates=None, deletes=None, batch_size=500, max_workers=4, max_retries=3,
+                             use_global_ids=False):
+    """
+    Posts edits in chunks over a bounded thread pool, retrying failed chunks with exponential backoff.
+    A request that fails may still have been applied, so before a chunk of adds is retried, the features that are already in
+    the layer (by global id) are removed from it. Without global ids there is no way to tell, so failed adds are not retried.
+    Updates and deletes can be retried as they are.
+    A chunk that still fails after all retries is reported as failed for each of its features rather than failing the whole run
+    :param layer: (FeatureLayer) The layer to edit
+    :param logger: (Logger) The logger to use
+    :param adds: (list) The features to add, with their global ids when use_global_ids is True
+    :param updates: (list) The features to update
+    :param deletes: (list) The global ids (or object ids) to delete
+    :param batch_size: (int) The number of features to send in each request
+    :param max_workers: (int) The number of requests to send concurrently
+    :param max_retries: (int) The number of times to retry a failed request
+    :param use_global_ids: (bool) Whether the edits identify features by global id rather than by object id. The layer must support
+                           applyEdits with global ids
+    :return: (dict) The combined addResults, updateResults, and deleteResults, and the number of edits that failed (failed)
+    """
+    batches = []
+    for kind, edits in (("adds", adds or []), ("updates", updates or []), ("deletes", deletes or [])):
+        for i in range(0, len(edits), batch_size):
+            batches.append((kind, edits[i:i + batch_size]))
+
+    def send(kind, edits):
+        results_key = f"{kind[:-1]}Results"
+        # the results of adds found in the layer after a failed request
+        applied = []
+        for attempt in range(max_retries + 1):
+            try:
+                results = layer.edit_features(use_global_ids=use_global_ids, **{kind: edits}).get(results_key, []) if edits else []
+                return kind, applied + results
+            except Exception as e:
+                if attempt == max_retries or (kind == "adds" and not use_global_ids):
+                    logger.error(f"Posting {len(edits)} {kind} failed after {attempt + 1} attempt(s): {e}")
+                    return kind, applied + [{"success": False, "error": str(e)}] * len(edits)
+                delay = 2 ** attempt + random.random()
+                logger.warning(f"Posting {len(edits)} {kind} failed ({e}), retrying in {delay:.1f} seconds")
+                time.sleep(delay)
+            if kind == "adds":
+                # The failed request may still have added some of the features, only the missing ones are retried
+                global_id_field = layer.properties.globalIdField
+                try:
+                    existing = query_existing_global_ids(layer, [get_global_id(f, global_id_field) for f in edits])
+                except Exception as e:
+                    # Without knowing what was added, retrying could add duplicates
+                    logger.error(f"Checking which of {len(edits)} adds were applied failed, not retrying them: {e}")
+                    return kind, applied + [{"success": False, "error": str(e)}] * len(edits)
+                applied += [{"globalId": get_global_id(f, global_id_field), "success": True} for f in edits
+                            if normalize_global_id(get_global_id(f, global_id_field)) in existing]
+                edits = [f for f in edits if normalize_global_id(get_global_id(f, global_id_field)) not in existing]
+
+    summary = {"addResults": [], "updateResults": [], "deleteResults": []}
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(send, kind, edits) for kind, edits in batches]
+        for future in concurrent.futures.as_completed(futures):
+            kind, results = future.result()
+            summary[f"{kind[:-1]}Results"].extend(results)
+    elapsed = time.time() - start_time
+    results = summary["addResults"] + summary["updateResults"] + summary["deleteResults"]
+    summary["failed"] = len([r for r in results if not r.get("success")])
+    logger.info(f"Posted {len(results)} edits in {len(batches)} requests in {elapsed:.1f} seconds "
+                f"({len(results) / elapsed if elapsed else 0:.0f} features/second). Failed: {summary['failed']}")
+    return summary
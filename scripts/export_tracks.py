@@ -10,17 +10,39 @@
    See the License for the specific language governing permissions and
    limitations under the License.​
 
-    This sample demonstrates how tracks can be exported from AGOL to CSV files
+    This sample demonstrates how tracks can be exported from AGOL or ArcGIS Enterprise to CSV or Parquet files
 """
 import argparse
+import concurrent.futures
+import csv
 import datetime
+import json
 import pendulum
 import logging
 import logging.handlers
+import numpy
 import os
+import pandas
+import threading
 import traceback
 import sys
-from arcgis.gis import GIS
+import urllib.parse
+from instrumentation import add_profile_arguments, profile
+from session_cache import add_cache_arguments, connect
+from track_index import query_pages
+from track_thinning import TrackThinner, add_thinning_arguments, find_segments
+
+# The file in the output directory that records the partitions that have been exported
+MANIFEST_FILE_NAME = "export_manifest.json"
+# The directory in the output directory that Parquet files are written to
+PARQUET_DIRECTORY_NAME = "tracks_parquet"
+# The number of CSV rows converted to Parquet at a time
+PARQUET_CHUNK_SIZE = 500000
+# Columns stored as timestamps and as float32 in Parquet files
+TIMESTAMP_COLUMNS = {"location_timestamp", "created_date", "last_edited_date"}
+FLOAT32_COLUMNS = {"x", "y", "longitude", "latitude", "horizontal_accuracy", "vertical_accuracy", "altitude", "speed", "course"}
+# The field types stored as (nullable) 64-bit integers in Parquet files
+INTEGER_FIELD_TYPES = {"esriFieldTypeOID", "esriFieldTypeInteger", "esriFieldTypeSmallInteger", "esriFieldTypeBigInteger"}
 
 
 def initialize_logging(log_file=None):
@@ -51,49 +73,377 @@ def initialize_logging(log_file=None):
     return logger
 
 
+def create_partitions(start_date, end_date, partition, timestamp_prefix=""):
+    """
+    Splits the export window into partitions with deterministic names
+    :param start_date: (pendulum.Pendulum) The start of the window
+    :param end_date: (pendulum.Pendulum) The end of the window (inclusive)
+    :param partition: (string) "day" or "hour". Any other value creates a single partition for the whole window
+    :param timestamp_prefix: (string) Put before the timestamp literals of the where clauses (e.g. "timestamp " for layer queries)
+    :return: (list) (name, where clause) for each partition
+    """
+    if partition not in ("day", "hour"):
+        name = f"tracks_{start_date.to_date_string()}_{end_date.to_date_string()}"
+        where = f"location_timestamp <= {timestamp_prefix}'{end_date.in_tz('UTC').to_datetime_string()}' AND " \
+                f"location_timestamp >= {timestamp_prefix}'{start_date.in_tz('UTC').to_datetime_string()}'"
+        return [(name, where)]
+    partitions = []
+    partition_start = start_date
+    while partition_start <= end_date:
+        if partition == "day":
+            partition_end = partition_start.add(days=1)
+            name = f"tracks_{partition_start.to_date_string()}"
+        else:
+            partition_end = partition_start.add(hours=1)
+            name = f"tracks_{partition_start.in_tz('UTC').strftime('%Y-%m-%dT%H')}Z"
+        where = f"location_timestamp < {timestamp_prefix}'{partition_end.in_tz('UTC').to_datetime_string()}' AND " \
+                f"location_timestamp >= {timestamp_prefix}'{partition_start.in_tz('UTC').to_datetime_string()}'"
+        partitions.append((name, where))
+        partition_start = partition_end
+    return partitions
+
+
+def load_manifest(manifest_path):
+    """
+    Loads the manifest of partitions that have already been exported
+    :param manifest_path: (string) The path of the manifest file
+    :return: (dict) The manifest
+    """
+    if not os.path.exists(manifest_path):
+        return {"partitions": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path, manifest):
+    """
+    Saves the manifest, replacing the file atomically so an interrupted run can't corrupt it
+    :param manifest_path: (string) The path of the manifest file
+    :param manifest: (dict) The manifest to save
+    """
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def is_exported(manifest, name, save_path):
+    """
+    Checks whether a partition was exported by a previous run and its files still exist
+    :param manifest: (dict) The manifest
+    :param name: (string) The name of the partition
+    :param save_path: (string) The output directory
+    :return: (bool) True if the partition can be skipped
+    """
+    if name not in manifest["partitions"]:
+        return False
+    entry = manifest["partitions"][name]
+    # Manifests written before the Parquet output format record a single CSV file
+    files = entry["files"] if "files" in entry else [entry["file"]]
+    return all(os.path.exists(os.path.join(save_path, file_name)) for file_name in files)
+
+
+def create_parquet_schema(columns, fields=None):
+    """
+    Creates the schema of the Parquet files from the fields of the tracks layer, so every chunk is written with the same
+    types whether or not a column has values in that chunk. Columns that are not fields of the layer are stored as strings
+    :param columns: (list) The columns of the CSV file that are written to the Parquet files
+    :param fields: (list) The fields of the tracks layer (optional)
+    :return: (tuple) The pyarrow schema, and the pandas dtype to read each column of the CSV file with
+    """
+    import pyarrow
+    field_types = {field["name"].lower(): field["type"] for field in fields or []}
+    arrow_fields = []
+    dtypes = {}
+    for column in columns:
+        field_type = field_types.get(column.lower())
+        if column.lower() in TIMESTAMP_COLUMNS or field_type == "esriFieldTypeDate":
+            arrow_fields.append(pyarrow.field(column, pyarrow.timestamp("ns", tz="UTC")))
+            dtypes[column] = str
+        elif column.lower() in FLOAT32_COLUMNS or field_type == "esriFieldTypeSingle":
+            arrow_fields.append(pyarrow.field(column, pyarrow.float32()))
+            dtypes[column] = "float32"
+        elif field_type == "esriFieldTypeDouble":
+            arrow_fields.append(pyarrow.field(column, pyarrow.float64()))
+            dtypes[column] = "float64"
+        elif field_type in INTEGER_FIELD_TYPES:
+            arrow_fields.append(pyarrow.field(column, pyarrow.int64()))
+            dtypes[column] = "Int64"
+        else:
+            arrow_fields.append(pyarrow.field(column, pyarrow.string()))
+            dtypes[column] = str
+    return pyarrow.schema(arrow_fields), dtypes
+
+
+def write_parquet(csv_path, save_path, name, time_zone, fields=None, chunk_size=PARQUET_CHUNK_SIZE):
+    """
+    Streams an exported CSV file into Parquet files partitioned by date and created_user
+    (<save_path>/tracks_parquet/date=<date>/created_user=<user>/<name>-<chunk>.parquet).
+    Timestamps are stored as UTC timestamps and coordinates as float32. The types of the other columns come from the
+    fields of the tracks layer rather than from the values of each chunk, so all of the files share one schema
+    :param csv_path: (string) The CSV file to convert
+    :param save_path: (string) The output directory
+    :param name: (string) The name of the partition, used to name the files deterministically
+    :param time_zone: (string) The time zone that defines the date of a track
+    :param fields: (list) The fields of the tracks layer (optional). Without them, columns other than the timestamps
+                   and coordinates are stored as strings
+    :param chunk_size: (int) The number of rows to read at a time
+    :return: (list) The Parquet files that were written, relative to the output directory
+    """
+    import pyarrow
+    import pyarrow.parquet
+    columns = list(pandas.read_csv(csv_path, nrows=0).columns)
+    timestamp_column = next(column for column in columns if column.lower() == "location_timestamp")
+    user_column = next(column for column in columns if column.lower() == "created_user")
+    schema, dtypes = create_parquet_schema([column for column in columns if column != user_column], fields)
+    dtypes[user_column] = str
+    timestamp_columns = [field.name for field in schema if pyarrow.types.is_timestamp(field.type)]
+    files = []
+    for chunk_index, chunk in enumerate(pandas.read_csv(csv_path, chunksize=chunk_size, dtype=dtypes)):
+        for column in timestamp_columns:
+            chunk[column] = pandas.to_datetime(chunk[column], utc=True)
+        dates = chunk[timestamp_column].dt.tz_convert(time_zone).dt.strftime("%Y-%m-%d")
+        for (date, user), group in chunk.groupby([dates, user_column]):
+            directory = os.path.join(PARQUET_DIRECTORY_NAME, f"date={date}", f"created_user={urllib.parse.quote(str(user), safe='@.-_')}")
+            os.makedirs(os.path.join(save_path, directory), exist_ok=True)
+            file_name = os.path.join(directory, f"{name}-{chunk_index}.parquet")
+            table = pyarrow.Table.from_pandas(group.drop(columns=[user_column]), schema=schema, preserve_index=False)
+            pyarrow.parquet.write_table(table, os.path.join(save_path, file_name))
+            files.append(file_name)
+    return files
+
+
+def thin_csv(csv_path, thinner):
+    """
+    Thins the tracks of an exported CSV file in place. The file is read into memory, one partition at a time
+    :param csv_path: (string) The CSV file
+    :param thinner: (TrackThinner) The thinner
+    """
+    df = pandas.read_csv(csv_path, dtype=str, keep_default_na=False)
+    columns = {column.lower(): column for column in df.columns}
+    timestamps = pandas.to_datetime(df[columns["location_timestamp"]], utc=True).values.astype("datetime64[ms]").astype(numpy.int64)
+    accuracies = pandas.to_numeric(df[columns["horizontal_accuracy"]], errors="coerce").values if "horizontal_accuracy" in columns else None
+    keep = thinner.thin(df[columns["created_user"]].values, timestamps,
+                        pandas.to_numeric(df[columns["x"]], errors="coerce").values, pandas.to_numeric(df[columns["y"]], errors="coerce").values, accuracies)
+    df[keep].to_csv(csv_path, index=False)
+
+
+def find_open_segment(features, thinner):
+    """
+    Finds where the last segment of a page of features starts. The segment may continue on the next page, so it is
+    thinned together with that page rather than on its own
+    :param features: (list) The features, ordered by user and time
+    :param thinner: (TrackThinner) The thinner
+    :return: (int) The position of the first feature of the last segment
+    """
+    if not features:
+        return 0
+    starts, _ = find_segments(numpy.array([feature.attributes.get("created_user") for feature in features], dtype=object),
+                              numpy.array([feature.attributes["location_timestamp"] for feature in features], dtype=numpy.int64),
+                              thinner.max_gap * 1000)
+    return int(starts[-1])
+
+
+def thin_features(features, thinner):
+    """
+    Thins the tracks of a list of features made of whole segments
+    :param features: (list) The features, ordered by user and time
+    :param thinner: (TrackThinner) The thinner
+    :return: (list) The features that are kept, in the same order
+    """
+    def value(attribute):
+        return numpy.nan if attribute is None else attribute
+
+    geometries = [feature.geometry or {} for feature in features]
+    keep = thinner.thin([feature.attributes.get("created_user") for feature in features],
+                        numpy.array([feature.attributes["location_timestamp"] for feature in features], dtype=numpy.int64),
+                        numpy.array([value(geometry.get("x")) for geometry in geometries], dtype=numpy.float64),
+                        numpy.array([value(geometry.get("y")) for geometry in geometries], dtype=numpy.float64),
+                        numpy.array([value(feature.attributes.get("horizontal_accuracy")) for feature in features], dtype=numpy.float64))
+    return [feature for feature, kept in zip(features, keep) if kept]
+
+
+def export_partition(tracks_item, name, where, save_path, logger, output_format="csv", time_zone="UTC", thinner=None, fields=None):
+    """
+    Exports one partition to a CSV file, downloads it, and deletes the exported item
+    :param tracks_item: (Item) The location tracking service or track view item
+    :param name: (string) The name of the partition, used for the exported item and file
+    :param where: (string) The where clause of the partition
+    :param save_path: (string) The directory to download the file to
+    :param logger: (Logger) The logger to use
+    :param output_format: (string) "csv" to keep the CSV file, or "parquet" to convert it to partitioned Parquet files
+    :param time_zone: (string) The time zone that defines the date of a track when writing Parquet files
+    :param thinner: (TrackThinner) Thins the tracks of the downloaded file (optional)
+    :param fields: (list) The fields of the tracks layer, which define the types of the Parquet columns (optional)
+    :return: (list) The names of the files that were written, relative to the output directory
+    """
+    logger.info(f"Exporting {name}...")
+    csv_item = tracks_item.export(name,
+                                  export_format='CSV',
+                                  parameters={
+                                      "layers": [
+                                          {
+                                              "id": 0,
+                                              "where": where
+                                          }
+                                      ]
+                                  }
+                                  )
+    try:
+        logger.info(f"Downloading {name}...")
+        # Download to a temporary name so a partially downloaded file is never mistaken for a complete one
+        file_name = f"{name}.csv"
+        csv_item.download(save_path=save_path, file_name=f"{file_name}.part")
+        os.replace(os.path.join(save_path, f"{file_name}.part"), os.path.join(save_path, file_name))
+    finally:
+        # Delete the hosted CSV file
+        csv_item.delete()
+    if thinner:
+        logger.info(f"Thinning {name}...")
+        thin_csv(os.path.join(save_path, file_name), thinner)
+    if output_format == "parquet":
+        logger.info(f"Writing {name} to Parquet...")
+        files = write_parquet(os.path.join(save_path, file_name), save_path, name, time_zone, fields)
+        os.remove(os.path.join(save_path, file_name))
+        return files
+    return [file_name]
+
+
+def query_partition(tracks_layer, name, where, save_path, logger, page_size=None, max_workers=4, output_format="csv", time_zone="UTC",
+                    thinner=None):
+    """
+    Pages through the tracks of one partition and streams them to a CSV file, without creating an export item.
+    Up to max_workers pages are fetched concurrently, and pages are written in order as soon as they arrive,
+    so at most max_workers pages are held in memory no matter how many tracks are exported
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :param name: (string) The name of the partition, used for the file
+    :param where: (string) The where clause of the partition
+    :param save_path: (string) The directory to write the file to
+    :param logger: (Logger) The logger to use
+    :param page_size: (int) The number of records to request per page. Defaults to (and is capped to) the maxRecordCount of the layer
+    :param max_workers: (int) The number of pages to fetch concurrently
+    :param output_format: (string) "csv" to keep the CSV file, or "parquet" to convert it to partitioned Parquet files
+    :param time_zone: (string) The time zone that defines the date of a track when writing Parquet files
+    :param thinner: (TrackThinner) Thins the tracks before they are written (optional). The pages are then ordered by
+                    user and time, and the last segment of each page is carried over to the next page, so the same
+                    tracks are kept whatever the page size
+    :return: (list) The names of the files that were written, relative to the output directory
+    """
+    logger.info(f"Querying tracks for {name}...")
+    fields = tracks_layer.properties.fields
+    field_names = [field["name"] for field in fields]
+    date_fields = {field["name"] for field in fields if field["type"] == "esriFieldTypeDate"}
+    file_name = f"{name}.csv"
+    object_id_field = tracks_layer.properties.objectIdField
+    order_by = f"created_user ASC, location_timestamp ASC, {object_id_field} ASC" if thinner else f"{object_id_field} ASC"
+    pages = query_pages(tracks_layer, where, out_sr=4326, page_size=page_size, order_by=order_by, max_workers=max_workers)
+    count = 0
+    with open(os.path.join(save_path, f"{file_name}.part"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(field_names + ["x", "y"])
+
+        def write_features(features):
+            for feature in features:
+                row = []
+                for field_name in field_names:
+                    value = feature.attributes.get(field_name)
+                    if field_name in date_fields and value is not None:
+                        value = datetime.datetime.utcfromtimestamp(value / 1000).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+                    row.append(value)
+                geometry = feature.geometry or {}
+                writer.writerow(row + [geometry.get("x"), geometry.get("y")])
+            return len(features)
+
+        carried = []
+        for features in pages:
+            if thinner:
+                features = carried + features
+                split = find_open_segment(features, thinner)
+                features, carried = thin_features(features[:split], thinner), features[split:]
+            count += write_features(features)
+        if carried:
+            count += write_features(thin_features(carried, thinner))
+    os.replace(os.path.join(save_path, f"{file_name}.part"), os.path.join(save_path, file_name))
+    logger.info(f"Wrote {count} tracks for {name}")
+    if output_format == "parquet":
+        logger.info(f"Writing {name} to Parquet...")
+        files = write_parquet(os.path.join(save_path, file_name), save_path, name, time_zone, fields)
+        os.remove(os.path.join(save_path, file_name))
+        return files
+    return [file_name]
+
+
 def main(arguments):
     logger = initialize_logging(arguments.log_file)
-    save_path = os.path.abspath(args.output_directory)
+    save_path = os.path.abspath(arguments.output_directory)
     if not os.path.isdir(save_path):
         raise Exception(f"Invalid directory: {save_path}")
     logger.info("Authenticating...")
     # Authenticate to ArcGIS Online
-    gis = GIS(arguments.org_url,
-              username=arguments.username,
-              password=arguments.password)
-    if gis.properties['isPortal']:
-        raise Exception("Export is not supported for the location tracking service with ArcGIS Enterprise")
+    # Exports can run for longer than a cached token is valid, so always sign in (the new token is still cached)
+    gis = connect(arguments, logger, use_cached_token=False)
+    engine = arguments.engine
+    if engine == "auto":
+        engine = "query" if gis.properties['isPortal'] else "export"
+    if engine == "export" and gis.properties['isPortal']:
+        raise Exception("Export is not supported for the location tracking service with ArcGIS Enterprise, use the query engine instead")
     logger.info("Exporting...")
-    tracks_item = gis.content.get(args.tracks_item)
+    tracks_item = gis.content.get(arguments.tracks_item)
     if tracks_item is None:
-        raise Exception(f"Unable to get item id: {args.tracks_item}")
+        raise Exception(f"Unable to get item id: {arguments.tracks_item}")
     # Create date range using track age
     # Always export up through the last full day (intentionally excludes part of current day)
-    start_date = pendulum.today(args.time_zone) - datetime.timedelta(days=args.track_age)
-    end_date = pendulum.today(args.time_zone).at(23, 59, 59) - datetime.timedelta(days=1)
+    start_date = pendulum.today(arguments.time_zone) - datetime.timedelta(days=arguments.track_age)
+    end_date = pendulum.today(arguments.time_zone).at(23, 59, 59) - datetime.timedelta(days=1)
+    partitions = create_partitions(start_date, end_date, arguments.partition, timestamp_prefix="timestamp " if engine == "query" else "")
+
+    # Skip the partitions that a previous run already exported
+    manifest_path = os.path.join(save_path, MANIFEST_FILE_NAME)
+    manifest = load_manifest(manifest_path)
+    remaining = [(name, where) for name, where in partitions if not is_exported(manifest, name, save_path)]
+    logger.info(f"Exporting {len(remaining)} of {len(partitions)} partition(s)")
+
     # Export the tracks
-    name = f"tracks_{start_date.to_date_string()}_{end_date.to_date_string()}"
-    csv_item = tracks_item.export(name,
-                                  export_format='CSV',
-                                  parameters={
-                                      "layers": [
-                                          {
-                                              "id": 0,
-                                              "where": f"location_timestamp <= '{end_date.in_tz('UTC').to_datetime_string()}' AND "
-                                                       f"location_timestamp >= '{start_date.in_tz('UTC').to_datetime_string()}'"
-                                          }
-                                      ]
-                                  }
-                                  )
-    logger.info("Downloading...")
-    # Download the CSV file
-    csv_item.download(save_path=save_path, file_name=f"{name}.csv")
-    # Delete the hosted CSV file
-    csv_item.delete()
+    manifest_lock = threading.Lock()
+    failed = []
+    thinner = TrackThinner.from_arguments(arguments)
+
+    def record(name, get_files):
+        try:
+            files = get_files()
+        except Exception as e:
+            logger.error(f"Exporting {name} failed: {e}")
+            failed.append(name)
+            return
+        with manifest_lock:
+            manifest["partitions"][name] = {"files": files, "completed": pendulum.now('UTC').to_iso8601_string()}
+            save_manifest(manifest_path, manifest)
+
+    tracks_layer = tracks_item.layers[0]
+    if engine == "query":
+        # Partitions are queried one at a time, the pages of each partition are fetched concurrently
+        for name, where in remaining:
+            record(name, lambda: query_partition(tracks_layer, name, where, save_path, logger, arguments.page_size,
+                                                 arguments.max_workers, arguments.output_format, arguments.time_zone, thinner))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=arguments.max_workers) as executor:
+            futures = {executor.submit(export_partition, tracks_item, name, where, save_path, logger, arguments.output_format, arguments.time_zone,
+                                       thinner, tracks_layer.properties.fields if arguments.output_format == "parquet" else None): name
+                       for name, where in remaining}
+            for future in concurrent.futures.as_completed(futures):
+                record(futures[future], future.result)
+    if thinner:
+        logger.info(thinner.summary())
+    if failed:
+        raise Exception(f"{len(failed)} partition(s) failed to export, run the script again to retry them: {', '.join(sorted(failed))}")
     logger.info("Complete")
 
 
-if __name__ == "__main__":
+def create_parser():
+    """
+    Creates the parser of the command line arguments
+    :return: (ArgumentParser) The parser
+    """
     parser = argparse.ArgumentParser(
         "This exports tracks from a track view or location tracking service hosted in AGOL")
     parser.add_argument('-username', dest='username', help="The username to authenticate with", required=True)
@@ -106,9 +456,30 @@ if __name__ == "__main__":
     parser.add_argument('-time-zone', dest='time_zone', help="The timezone to use", default='UTC')
     parser.add_argument('-output-directory', dest='output_directory', help="The directory where the exported file will be stored", required=True)
     parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
-    args = parser.parse_args()
+    parser.add_argument('-partition', dest='partition', choices=['none', 'day', 'hour'], default='none',
+                        help="Split the export into one file per day or per hour. Defaults to a single file (none)")
+    parser.add_argument('-max-workers', dest='max_workers', type=int, default=4,
+                        help="The number of partitions to export concurrently. Defaults to 4")
+    parser.add_argument('-engine', dest='engine', choices=['auto', 'export', 'query'], default='auto',
+                        help="export creates and downloads export items (ArcGIS Online only). query pages through the tracks layer "
+                             "and streams the tracks to disk (ArcGIS Online and ArcGIS Enterprise). "
+                             "Defaults to query for ArcGIS Enterprise and export otherwise")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of tracks to request per page with the query engine. Defaults to the max record count of the layer")
+    parser.add_argument('-output-format', dest='output_format', choices=['csv', 'parquet'], default='csv',
+                        help="Keep the exported CSV files (csv) or convert them to Parquet files partitioned by date and created_user (parquet). "
+                             "Defaults to csv")
+    add_thinning_arguments(parser)
+    add_profile_arguments(parser)
+    add_cache_arguments(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
     try:
-        main(args)
+        with profile(args):
+            main(args)
     except Exception as e:
         logging.getLogger().critical("Exception detected, script exiting")
         logging.getLogger().critical(e)
@@ -0,0 +1,240 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This sample finds the time periods that users were dwelling in polygons (for example parks) using Tracker data.
+    The tracks of the users near the polygons are fetched once for the time period and assigned to the polygons locally.
+"""
+import argparse
+import csv
+import logging
+import logging.handlers
+import traceback
+import sys
+import numpy
+import pendulum
+import arcgis
+from arcgis.gis import GIS
+from arcgis.features import FeatureLayer
+from geometry_utils import contains_xy, rings_to_shapely
+from instrumentation import add_profile_arguments, profile
+from track_index import CREATOR_FIELD, SR, TrackIndex, create_time_clause
+from track_store import add_track_store_arguments, open_track_store
+
+
+def initialize_logging(log_file=None):
+    """
+    Setup logging
+    :param log_file: (string) The file to log to
+    :return: (Logger) a logging instance
+    """
+    # initialize logging
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(filename)30s:%(lineno)4s - %(funcName)30s()][%(threadName)5s] [%(name)10.10s] [%(levelname)8s] %(message)s")
+    # Grab the root logger
+    logger = logging.getLogger()
+    # Set the root logger logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+    logger.setLevel(logging.DEBUG)
+    # Create a handler to print to the console
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(formatter)
+    sh.setLevel(logging.INFO)
+    # Create a handler to log to the specified file
+    if log_file:
+        rh = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760)
+        rh.setFormatter(formatter)
+        rh.setLevel(logging.DEBUG)
+        logger.addHandler(rh)
+    # Add the handlers to the root logger
+    logger.addHandler(sh)
+    return logger
+
+
+def find_user_dwell_events(timestamps, inside, gap_tolerance=None):
+    """
+    Finds the dwell events of a user in a polygon with a single pass over all of their time-sorted tracks.
+    A dwell starts at the first track inside the polygon and ends at the next track outside of it, however far away.
+    If the time between two tracks is more than the gap tolerance, a dwell ends at the last track before the gap
+    :param timestamps: (ndarray) The timestamps (epoch ms) of the tracks, sorted
+    :param inside: (ndarray) Whether each track is inside the polygon
+    :param gap_tolerance: (int) The longest time (ms) between tracks that doesn't end a dwell (optional)
+    :return: (list) (start, end) timestamps of each dwell. The end is None if the user had not left by the last track
+    """
+    if len(timestamps) == 0:
+        return []
+    gaps = numpy.zeros(len(timestamps), dtype=bool)
+    if gap_tolerance is not None:
+        gaps[1:] = numpy.diff(timestamps) > gap_tolerance
+    # A run is a sequence of tracks that are all inside or all outside the polygon, without any gaps
+    run_starts = numpy.flatnonzero(numpy.concatenate(([True], (inside[1:] != inside[:-1]) | gaps[1:])))
+    run_ends = numpy.append(run_starts[1:], len(timestamps))
+    events = []
+    for run_start, run_end in zip(run_starts, run_ends):
+        if not inside[run_start]:
+            continue
+        if run_end == len(timestamps):
+            end = None
+        elif gaps[run_end]:
+            end = timestamps[run_end - 1]
+        else:
+            end = timestamps[run_end]
+        events.append((timestamps[run_start], end))
+    return events
+
+
+def find_dwell_events(track_index, polygons, gap_tolerance=None):
+    """
+    Finds the dwell events of all users in all polygons
+    :param track_index: (TrackIndex) The tracks. Every track of each user in the time period is needed, so that any
+                        track outside of a polygon ends a dwell
+    :param polygons: (list) (polygon id, shapely polygon) pairs
+    :param gap_tolerance: (int) The longest time (ms) between tracks that doesn't end a dwell (optional)
+    :return: (list) (polygon id, user, start, end) of each dwell event
+    """
+    events = []
+    for polygon_id, polygon in polygons:
+        # Use the grid of the index to find the candidate tracks, then test them all at once
+        positions = track_index.query_envelope(*polygon.bounds)
+        positions = positions[contains_xy(polygon, track_index.xs[positions], track_index.ys[positions])]
+        for user, user_positions in track_index.split_by_user(positions):
+            # The tracks of a user are contiguous in the index, so the tracks inside the polygon are marked in all of them
+            track_positions = track_index.query_time(user)
+            inside = numpy.zeros(len(track_positions), dtype=bool)
+            inside[user_positions - track_positions[0]] = True
+            for start, end in find_user_dwell_events(track_index.timestamps[track_positions], inside, gap_tolerance):
+                events.append((polygon_id, user, start, end))
+    return events
+
+
+def query_users(tracks_layer, where, geometry_filter):
+    """
+    Finds the users with tracks matching a query, with a single statistics request
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :param where: (string) The where clause
+    :param geometry_filter: (dict) The geometry filter
+    :return: (list) The users
+    """
+    statistics = [{"statisticType": "count", "onStatisticField": "objectid", "outStatisticFieldName": "track_count"}]
+    features = tracks_layer.query(where=where, geometry_filter=geometry_filter, group_by_fields_for_statistics=CREATOR_FIELD,
+                                  out_statistics=statistics).features
+    return sorted(feature.attributes[CREATOR_FIELD] for feature in features)
+
+
+def format_timestamp(timestamp):
+    return pendulum.from_timestamp(timestamp / 1000).to_datetime_string() if timestamp is not None else "N/A"
+
+
+def main(arguments):
+    # initialize logger
+    logger = initialize_logging(arguments.log_file)
+    # Create the GIS
+    logger.info("Authenticating...")
+    # First step is to get authenticate and get a valid token
+    gis = GIS(arguments.org_url,
+              username=arguments.username,
+              password=arguments.password,
+              verify_cert=not arguments.skip_ssl_verification)
+
+    logger.info("Getting tracks layer")
+    if arguments.tracks_layer_url:
+        tracks_layer = FeatureLayer(url=arguments.tracks_layer_url, gis=gis)
+    else:
+        try:
+            tracks_layer = gis.admin.location_tracking.tracks_layer
+        except Exception as e:
+            logger.info(e)
+            logger.info("Getting location tracking service failed - check that you are an admin and that location tracking is enabled for your organization")
+            sys.exit(0)
+
+    logger.info("Getting polygons")
+    polygon_layer = FeatureLayer(url=arguments.polygon_layer_url, gis=gis)
+    object_id_field = polygon_layer.properties.objectIdField
+    polygon_features = polygon_layer.query(where=arguments.where, out_sr=SR).features
+    if len(polygon_features) == 0:
+        logger.info("No polygons found")
+        sys.exit(0)
+    polygons = [(feature.attributes[object_id_field], rings_to_shapely(feature.geometry["rings"])) for feature in polygon_features]
+
+    # Find the users with tracks near the polygons, then fetch all of their tracks for the time period once,
+    # so that leaving a polygon is detected wherever the next track is
+    start_date = pendulum.parse(arguments.start_date, tz=arguments.time_zone).in_tz('UTC') if arguments.start_date else None
+    end_date = pendulum.parse(arguments.end_date, tz=arguments.time_zone).in_tz('UTC') if arguments.end_date else None
+    time_clause = create_time_clause(start_date, end_date)
+    xmins, ymins, xmaxs, ymaxs = zip(*[polygon.bounds for _, polygon in polygons])
+    extent = {"xmin": min(xmins), "ymin": min(ymins), "xmax": max(xmaxs), "ymax": max(ymaxs), "spatialReference": SR}
+    logger.info("Finding users near the polygons")
+    if arguments.track_store:
+        track_store = open_track_store(arguments.track_store, logger)
+        start = int(start_date.timestamp() * 1000) if start_date else None
+        end = int(end_date.timestamp() * 1000) if end_date else None
+        bounds = (extent["xmin"], extent["ymin"], extent["xmax"], extent["ymax"])
+        users = sorted({row[0] for row in track_store.query(start, end, extent=bounds, columns=[CREATOR_FIELD])})
+        logger.info(f"Loading the tracks of {len(users)} users")
+        track_index = track_store.to_track_index(start, end, users=users) if users else TrackIndex([], [], [], [], [])
+        track_store.close()
+    else:
+        users = query_users(tracks_layer, time_clause, arcgis.geometry.filters.envelope_intersects(extent, sr=SR))
+        logger.info(f"Fetching the tracks of {len(users)} users")
+        users_string = ",".join("'" + user.replace("'", "''") + "'" for user in users)
+        track_index = TrackIndex.from_layer(tracks_layer,
+                                            where=f"{time_clause} AND {CREATOR_FIELD} IN ({users_string})" if users else "1=0",
+                                            page_size=arguments.page_size)
+    logger.info(f"Fetched {len(track_index)} tracks for {len(track_index.users)} users")
+
+    logger.info("Finding dwell events")
+    gap_tolerance = arguments.gap_tolerance * 60000 if arguments.gap_tolerance is not None else None
+    events = find_dwell_events(track_index, polygons, gap_tolerance)
+    with open(arguments.output_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Dwell Event", "Polygon ID", "User", "Start Time", "End Time"])
+        for i, (polygon_id, user, start, end) in enumerate(events, start=1):
+            writer.writerow([i, polygon_id, user, format_timestamp(start), format_timestamp(end)])
+    logger.info(f"Found {len(events)} dwell events, written to {arguments.output_file}")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Find the time periods that users were dwelling in polygons")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
+    parser.add_argument('-p', dest='password', help="The password to authenticate with", required=True)
+    parser.add_argument('-org', dest='org_url', help="The url of the org/portal to use", required=True)
+    # Parameters for tracker
+    parser.add_argument('-polygon-layer-url', dest='polygon_layer_url', help="The feature service URL of the polygon layer", required=True)
+    parser.add_argument('-where', dest='where', help="Query conditions for the polygons to use. Defaults to all (1=1)", default="1=1")
+    parser.add_argument('-tracks-layer-url', dest='tracks_layer_url', default=None,
+                        help="The tracks layer (either location tracking service or tracks view) you'd like to use. "
+                             "Defaults to the Location Tracking Service tracks layer")
+    parser.add_argument('-start-date', dest='start_date', default=None,
+                        help="The start of the time period to search, e.g. '2020-04-14 07:00:00' (optional)")
+    parser.add_argument('-end-date', dest='end_date', default=None,
+                        help="The end of the time period to search, e.g. '2020-04-14 18:30:00' (optional)")
+    parser.add_argument('-time-zone', dest='time_zone', default='UTC', help="The time zone of the start and end dates. Defaults to UTC")
+    parser.add_argument('-gap-tolerance', dest='gap_tolerance', type=float, default=None,
+                        help="If there are no tracks for longer than this number of minutes, the dwell ends at the last track before the gap (optional)")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of tracks to request per page. Defaults to the max record count of the tracks layer")
+    parser.add_argument('-output-file', dest='output_file', default="dwell_times.csv",
+                        help="The CSV file to write the dwell events to. Defaults to dwell_times.csv")
+    parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('--skip-ssl-verification',
+                        dest='skip_ssl_verification',
+                        action='store_true',
+                        help="Verify the SSL Certificate of the server")
+    add_track_store_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        with profile(args):
+            main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
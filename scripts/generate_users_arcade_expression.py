@@ -14,38 +14,102 @@
 """
 import argparse
 import csv
+import sys
 import textwrap
 
 
-def main(args):
-    expression = ""
+def quote(value):
+    """
+    Quotes a value as an Arcade string literal
+    :param value: (string) The value
+    :return: (string) The quoted value
+    """
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def read_rows(args):
+    """
+    Reads the username and other values from the CSV file
+    :param args: The command line arguments
+    :return: (list) The (username, value) pairs
+    """
     with open(args.file) as f:
         reader = csv.DictReader(f, skipinitialspace=True)
-        for i, row in enumerate(reader):
-            if i == 0:
-                expression += textwrap.dedent(f"""
-                if ($feature.created_user == '{row[args.username_column].strip()}') {{
-                    return '{row[args.other_column].strip()}'
-                }}
-                """)
-            else:
-                expression += textwrap.dedent(f"""
-                else if ($feature.created_user == '{row[args.username_column].strip()}') {{
-                    return '{row[args.other_column].strip()}'
-                }}
-                """)
-        expression += textwrap.dedent("""
-        return ''
-        """)
+        return [(row[args.username_column].strip(), row[args.other_column].strip()) for row in reader]
+
+
+def generate_if_else_expression(rows):
+    """
+    Generates an if / else if expression with one branch per user
+    :param rows: (list) The (username, value) pairs
+    :return: (string) The expression
+    """
+    branches = []
+    for i, (username, value) in enumerate(rows):
+        branches.append(textwrap.dedent(f"""
+        {'if' if i == 0 else 'else if'} ($feature.created_user == {quote(username)}) {{
+            return {quote(value)}
+        }}
+        """))
+    branches.append(textwrap.dedent("""
+    return ''
+    """))
+    return "".join(branches)
+
+
+def generate_lookup_expression(rows):
+    """
+    Generates an expression that looks the user up in a dictionary, so the cost of evaluating it doesn't grow with the number of users
+    :param rows: (list) The (username, value) pairs
+    :return: (string) The expression
+    """
+    # Like the if / else if expression, the first row of a user wins
+    values = {}
+    for username, value in rows:
+        values.setdefault(username, value)
+    entries = ",\n".join(f"    {quote(username)}, {quote(value)}" for username, value in values.items())
+    return "\nvar lookup = Dictionary(\n" + entries + "\n)\n" + textwrap.dedent("""
+    var user = $feature.created_user
+    if (!IsEmpty(user) && HasKey(lookup, user)) {
+        return lookup[user]
+    }
+    return ''
+    """)
+
+
+def main(args):
+    rows = read_rows(args)
+    if args.mode == "lookup":
+        expression = generate_lookup_expression(rows)
+    else:
+        expression = generate_if_else_expression(rows)
+    # Report to stderr so the expression can still be redirected to a file or the clipboard
+    print(f"Generated the {args.mode} expression for {len(rows)} users ({len(expression)} characters)", file=sys.stderr)
+    if args.max_size and len(expression) > args.max_size:
+        print(f"The expression is larger than the maximum size of {args.max_size} characters. "
+              f"Use --mode lookup for large user lists, or increase --max-size", file=sys.stderr)
+        sys.exit(1)
     print(expression)
 
 
-if __name__ == "__main__":
+def create_parser():
+    """
+    Creates the parser of the command line arguments
+    :return: (ArgumentParser) The parser
+    """
     # Get all of the commandline arguments
     parser = argparse.ArgumentParser("Generates an Arcade expression using a CSV file.")
     parser.add_argument('--file', '-f', dest='file', help="The file to open", required=True)
     parser.add_argument('--username-column', dest='username_column', help="The name of the column containing the usernames", default="username")
     parser.add_argument('--other-column', dest='other_column', help="The name of the other column containing the names, categories, or other strings.",
                         default="category")
-    args = parser.parse_args()
+    parser.add_argument('--mode', dest='mode', choices=['if-else', 'lookup'], default='if-else',
+                        help="Generate an if / else if branch per user (if-else), or a dictionary lookup (lookup) which is faster for large user lists")
+    parser.add_argument('--max-size', dest='max_size', type=int, default=262144,
+                        help="Refuse to output an expression larger than this number of characters (0 for no limit). Defaults to 262144")
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
     main(args)
@@ -0,0 +1,85 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This module converts between Esri JSON geometries and shapely geometries, and tests many points against a geometry at once,
+    so scripts can do geometry work locally rather than with the geometry service.
+"""
+from shapely.geometry import LinearRing, MultiLineString, Polygon
+from shapely.geometry.polygon import orient
+from shapely.ops import unary_union
+
+try:
+    # shapely 2
+    from shapely import contains_xy as _contains_xy
+except ImportError:
+    from shapely.vectorized import contains as _contains_xy
+
+
+def rings_to_shapely(rings):
+    """
+    Converts Esri polygon rings (clockwise exterior rings, counterclockwise holes) to a shapely geometry
+    :param rings: (list) The rings
+    :return: (shapely.geometry.base.BaseGeometry) The polygon or multipolygon
+    """
+    exteriors = []
+    holes = []
+    for ring in rings:
+        if len(ring) < 4:
+            continue
+        if LinearRing(ring).is_ccw:
+            holes.append(Polygon(ring))
+        else:
+            exteriors.append(Polygon(ring))
+    # Each hole belongs to the smallest exterior ring containing it
+    exterior_holes = [[] for _ in exteriors]
+    for hole in holes:
+        containing = [i for i, exterior in enumerate(exteriors) if exterior.contains(hole.representative_point())]
+        if containing:
+            exterior_holes[min(containing, key=lambda i: exteriors[i].area)].append(hole.exterior.coords)
+    return unary_union([Polygon(exterior.exterior.coords, exterior_holes[i]) for i, exterior in enumerate(exteriors)])
+
+
+def paths_to_shapely(paths):
+    """
+    Converts Esri polyline paths to a shapely geometry
+    :param paths: (list) The paths
+    :return: (shapely.geometry.MultiLineString) The lines
+    """
+    return MultiLineString([path for path in paths if len(path) >= 2])
+
+
+def shapely_to_rings(shape):
+    """
+    Converts a shapely polygon or multipolygon to Esri polygon rings
+    :param shape: (shapely.geometry.base.BaseGeometry) The geometry
+    :return: (list) The rings, with clockwise exterior rings and counterclockwise holes
+    """
+    polygons = getattr(shape, "geoms", [shape])
+    rings = []
+    for polygon in polygons:
+        if polygon.is_empty or polygon.geom_type != "Polygon":
+            continue
+        polygon = orient(polygon, sign=-1.0)
+        rings.append([list(point) for point in polygon.exterior.coords])
+        rings.extend([list(point) for point in interior.coords] for interior in polygon.interiors)
+    return rings
+
+
+def contains_xy(shape, xs, ys):
+    """
+    Tests which points fall within a geometry, without creating a geometry per point
+    :param shape: (shapely.geometry.base.BaseGeometry) The geometry
+    :param xs: (ndarray) The x coordinates of the points
+    :param ys: (ndarray) The y coordinates of the points
+    :return: (ndarray) A boolean array that is True for the points within the geometry
+    """
+    return _contains_xy(shape, xs, ys)
@@ -0,0 +1,218 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This sample identifies the buildings that were inspected by walking around them, the same way as the
+    "Identify Inspected Buildings" notebook. The tracks for the day are fetched once and joined to all of the
+    buffered buildings locally, and the buildings are checked in parallel.
+"""
+import argparse
+import concurrent.futures
+import csv
+import logging
+import logging.handlers
+import traceback
+import sys
+import numpy
+import pendulum
+import arcgis
+from shapely.geometry import Polygon
+from arcgis.gis import GIS
+from arcgis.features import FeatureLayer
+from geometry_utils import contains_xy, rings_to_shapely
+from instrumentation import add_profile_arguments, profile
+from track_index import SR, TrackIndex, create_time_clause
+from track_store import add_track_store_arguments, open_track_store
+
+
+def initialize_logging(log_file=None):
+    """
+    Setup logging
+    :param log_file: (string) The file to log to
+    :return: (Logger) a logging instance
+    """
+    # initialize logging
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(filename)30s:%(lineno)4s - %(funcName)30s()][%(threadName)5s] [%(name)10.10s] [%(levelname)8s] %(message)s")
+    # Grab the root logger
+    logger = logging.getLogger()
+    # Set the root logger logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+    logger.setLevel(logging.DEBUG)
+    # Create a handler to print to the console
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(formatter)
+    sh.setLevel(logging.INFO)
+    # Create a handler to log to the specified file
+    if log_file:
+        rh = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760)
+        rh.setFormatter(formatter)
+        rh.setLevel(logging.DEBUG)
+        logger.addHandler(rh)
+    # Add the handlers to the root logger
+    logger.addHandler(sh)
+    return logger
+
+
+def is_inspected(building, user_tracks):
+    """
+    Checks whether a user walked around a building. The tracks of each user near the building, in time order, form a
+    polygon. The building is inspected if the polygon of any user contains it
+    :param building: (shapely.geometry.base.BaseGeometry) The building footprint
+    :param user_tracks: (list) The (n, 2) coordinate array of the tracks of each user near the building
+    :return: (bool) True if the building was inspected
+    """
+    for coordinates in user_tracks:
+        if len(coordinates) < 3:
+            continue
+        polygon = Polygon(coordinates)
+        if not polygon.is_valid:
+            # tracks that cross themselves make a self-intersecting ring, which needs to be cleaned up to be tested
+            polygon = polygon.buffer(0)
+        if polygon.contains(building):
+            return True
+    return False
+
+
+def inspect_chunk(chunk):
+    """
+    Checks a chunk of buildings. This runs in a worker process
+    :param chunk: (list) (building, list of user track coordinates) pairs
+    :return: (list) The inspected flag of each building
+    """
+    return [int(is_inspected(building, user_tracks)) for building, user_tracks in chunk]
+
+
+def find_user_tracks(track_index, buildings, buffer_distance):
+    """
+    Joins the tracks to the buffered buildings
+    :param track_index: (TrackIndex) The tracks
+    :param buildings: (list) The building footprints
+    :param buffer_distance: (float) The distance around the buildings to consider tracks in
+    :return: (generator) Yields the (n, 2) coordinate array of the tracks of each user in each buffered building
+    """
+    for building in buildings:
+        buffered = building.buffer(buffer_distance)
+        positions = track_index.query_envelope(*buffered.bounds)
+        positions = positions[contains_xy(buffered, track_index.xs[positions], track_index.ys[positions])]
+        yield [numpy.column_stack((track_index.xs[user_positions], track_index.ys[user_positions]))
+               for _, user_positions in track_index.split_by_user(positions)]
+
+
+def main(arguments):
+    # initialize logger
+    logger = initialize_logging(arguments.log_file)
+    if arguments.track_store and arguments.wkid != SR["wkid"]:
+        raise Exception(f"The track store holds Web Mercator coordinates, -wkid must be {SR['wkid']} to use it")
+    # Create the GIS
+    logger.info("Authenticating...")
+    # First step is to get authenticate and get a valid token
+    gis = GIS(arguments.org_url,
+              username=arguments.username,
+              password=arguments.password,
+              verify_cert=not arguments.skip_ssl_verification)
+
+    logger.info("Getting tracks layer")
+    if arguments.tracks_layer_url:
+        tracks_layer = FeatureLayer(url=arguments.tracks_layer_url, gis=gis)
+    else:
+        try:
+            tracks_layer = gis.admin.location_tracking.tracks_layer
+        except Exception as e:
+            logger.info(e)
+            logger.info("Getting location tracking service failed - check that you are an admin and that location tracking is enabled for your organization")
+            sys.exit(0)
+
+    sr = {'wkid': arguments.wkid, 'latestWkid': arguments.wkid}
+    logger.info("Getting buildings")
+    buildings_layer = FeatureLayer(url=arguments.buildings_layer_url, gis=gis)
+    object_id_field = buildings_layer.properties.objectIdField
+    building_features = buildings_layer.query(where=arguments.where, out_fields=object_id_field, out_sr=sr).features
+    if len(building_features) == 0:
+        logger.info("No buildings found")
+        sys.exit(0)
+    object_ids = [feature.attributes[object_id_field] for feature in building_features]
+    buildings = [rings_to_shapely(feature.geometry["rings"]) for feature in building_features]
+
+    # Fetch the tracks near the buildings for the day once
+    start_date = pendulum.parse(arguments.start_date, tz=arguments.time_zone).in_tz('UTC')
+    end_date = pendulum.parse(arguments.end_date, tz=arguments.time_zone).in_tz('UTC')
+    xmins, ymins, xmaxs, ymaxs = zip(*[building.bounds for building in buildings])
+    extent = {"xmin": min(xmins) - arguments.buffer_distance, "ymin": min(ymins) - arguments.buffer_distance,
+              "xmax": max(xmaxs) + arguments.buffer_distance, "ymax": max(ymaxs) + arguments.buffer_distance,
+              "spatialReference": sr}
+    logger.info("Fetching tracks")
+    if arguments.track_store:
+        track_store = open_track_store(arguments.track_store, logger)
+        track_index = track_store.to_track_index(int(start_date.timestamp() * 1000), int(end_date.timestamp() * 1000),
+                                                 extent=(extent["xmin"], extent["ymin"], extent["xmax"], extent["ymax"]))
+        track_store.close()
+    else:
+        track_index = TrackIndex.from_layer(tracks_layer,
+                                            where=create_time_clause(start_date, end_date),
+                                            out_sr=sr,
+                                            geometry_filter=arcgis.geometry.filters.envelope_intersects(extent, sr=sr),
+                                            page_size=arguments.page_size)
+    logger.info(f"Fetched {len(track_index)} tracks for {len(track_index.users)} users")
+
+    logger.info(f"Checking {len(buildings)} buildings")
+    pairs = list(zip(buildings, find_user_tracks(track_index, buildings, arguments.buffer_distance)))
+    chunks = [pairs[i:i + arguments.chunk_size] for i in range(0, len(pairs), arguments.chunk_size)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=arguments.max_workers) as executor:
+        inspected = [flag for flags in executor.map(inspect_chunk, chunks) for flag in flags]
+
+    with open(arguments.output_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([object_id_field, "inspected"])
+        writer.writerows(zip(object_ids, inspected))
+    logger.info(f"{sum(inspected)} of {len(buildings)} buildings were inspected. Results written to {arguments.output_file}")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Identify the buildings that were inspected by walking around them")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
+    parser.add_argument('-p', dest='password', help="The password to authenticate with", required=True)
+    parser.add_argument('-org', dest='org_url', help="The url of the org/portal to use", required=True)
+    # Parameters for tracker
+    parser.add_argument('-buildings-layer-url', dest='buildings_layer_url', help="The feature service URL of the building footprints layer", required=True)
+    parser.add_argument('-where', dest='where', help="Query conditions for the buildings to check. Defaults to all (1=1)", default="1=1")
+    parser.add_argument('-tracks-layer-url', dest='tracks_layer_url', default=None,
+                        help="The tracks layer (either location tracking service or tracks view) you'd like to use. "
+                             "Defaults to the Location Tracking Service tracks layer")
+    parser.add_argument('-start-date', dest='start_date', required=True, help="The start of the time period to use, e.g. '2020-03-26'")
+    parser.add_argument('-end-date', dest='end_date', required=True, help="The end of the time period to use, e.g. '2020-03-27'")
+    parser.add_argument('-time-zone', dest='time_zone', default='UTC', help="The time zone of the start and end dates. Defaults to UTC")
+    parser.add_argument('-wkid', dest='wkid', type=int, default=3857,
+                        help="The projected spatial reference to do the analysis in, e.g. 32619 for UTM Zone 19N. Defaults to 3857")
+    parser.add_argument('-buffer-distance', dest='buffer_distance', type=float, default=15,
+                        help="The distance around the buildings (in the units of the spatial reference) to use tracks in. Defaults to 15")
+    parser.add_argument('-chunk-size', dest='chunk_size', type=int, default=100, help="The number of buildings to check per task. Defaults to 100")
+    parser.add_argument('-max-workers', dest='max_workers', type=int, default=None,
+                        help="The number of processes used to check the buildings. Defaults to the number of CPUs")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of tracks to request per page. Defaults to the max record count of the tracks layer")
+    parser.add_argument('-output-file', dest='output_file', default="inspected_buildings.csv",
+                        help="The CSV file to write the inspected flag of each building to. Defaults to inspected_buildings.csv")
+    parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('--skip-ssl-verification',
+                        dest='skip_ssl_verification',
+                        action='store_true',
+                        help="Verify the SSL Certificate of the server")
+    add_track_store_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        with profile(args):
+            main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
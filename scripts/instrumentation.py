@@ -0,0 +1,306 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This module records the calls the scripts make to ArcGIS - feature layer queries and edits, geometry service
+    operations, and item exports and downloads - so a slow run can be broken down by the function that made them.
+    Each call is attributed to the script function it was made from (its phase), with its latency, the number of
+    HTTP requests it sent, the bytes transferred, and the number of records returned.
+    The scripts enable it with --profile, which logs a summary table at the end of the run, -profile-file, which
+    writes the summary as JSON, and -profile-trace-file, which writes every call as a Chrome trace
+    (open it in chrome://tracing or https://ui.perfetto.dev).
+"""
+import bisect
+import contextlib
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# The upper bounds of the latency histogram buckets, in milliseconds. The last bucket has no upper bound
+HISTOGRAM_BUCKETS_MS = [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# The maximum number of calls recorded for the Chrome trace
+MAX_TRACE_EVENTS = 200000
+# Warn about a phase that makes this many calls of the same operation, which is usually one query per feature (N+1)
+N_PLUS_ONE_CALLS = 100
+# (module, class or None for module functions, function) of the operations to record
+OPERATIONS = [
+    ("arcgis.features", "FeatureLayer", "query"),
+    ("arcgis.features", "FeatureLayer", "edit_features"),
+    ("arcgis.features", "FeatureLayer", "delete_features"),
+    ("arcgis.geometry", None, "buffer"),
+    ("arcgis.geometry", None, "union"),
+    ("arcgis.geometry", None, "intersect"),
+    ("arcgis.gis", "Item", "export"),
+    ("arcgis.gis", "Item", "download"),
+]
+# Frames in these modules are skipped when finding the script function a call was made from
+LIBRARY_MODULES = ("arcgis", "requests", "urllib3", "concurrent", "threading", "contextlib", __name__)
+
+
+def add_profile_arguments(parser):
+    """
+    Adds the profiling arguments to the argument parser of a script
+    :param parser: (ArgumentParser) The parser
+    """
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help="If provided, log a summary of the calls made to ArcGIS per phase at the end of the run")
+    parser.add_argument('-profile-file', dest='profile_file', default=None,
+                        help="A JSON file to write the summary of the calls made to ArcGIS to, including latency histograms (optional)")
+    parser.add_argument('-profile-trace-file', dest='profile_trace_file', default=None,
+                        help="A Chrome trace file (chrome://tracing or https://ui.perfetto.dev) to write every call made to ArcGIS to (optional)")
+
+
+@contextlib.contextmanager
+def profile(arguments):
+    """
+    Profiles the calls made within the with block, if the command line arguments ask for it. At the end, the summary
+    is logged and the profile files are written, even if the script failed or exited
+    :param arguments: (Namespace) The command line arguments, with the arguments added by add_profile_arguments
+    :return: (Profiler) The profiler, or None if profiling is off
+    """
+    profile_file = getattr(arguments, "profile_file", None)
+    trace_file = getattr(arguments, "profile_trace_file", None)
+    if not (getattr(arguments, "profile", False) or profile_file or trace_file):
+        yield None
+        return
+    profiler = Profiler()
+    profiler.install()
+    try:
+        yield profiler
+    finally:
+        profiler.uninstall()
+        logger = logging.getLogger()
+        logger.info(f"Profile of the calls made to ArcGIS:\n{profiler.format_table()}")
+        for warning in profiler.find_repeated_calls():
+            logger.warning(warning)
+        if profile_file:
+            profiler.write_json(profile_file)
+            logger.info(f"Profile written to {profile_file}")
+        if trace_file:
+            profiler.write_chrome_trace(trace_file)
+            logger.info(f"Chrome trace written to {trace_file}")
+
+
+def count_records(result):
+    """
+    Counts the records returned by a call
+    :param result: The result of the call
+    :return: (int) The number of features, object ids, edit results, rows, or geometries returned
+    """
+    if result is None or isinstance(result, (bool, int, float, str)):
+        return 0
+    if hasattr(result, "features"):
+        return len(result.features)
+    if isinstance(result, dict):
+        if "objectIds" in result:
+            return len(result["objectIds"] or [])
+        if any(key in result for key in ("addResults", "updateResults", "deleteResults")):
+            return sum(len(result.get(key) or []) for key in ("addResults", "updateResults", "deleteResults"))
+        return 1 if any(key in result for key in ("rings", "paths", "points", "x")) else 0
+    if hasattr(result, "__len__"):
+        return len(result)
+    return 0
+
+
+def find_phase():
+    """
+    Finds the script function a call was made from, skipping the frames of this module and of the libraries
+    :return: (string) <script>.<function>
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.split(".")[0] not in LIBRARY_MODULES:
+            return f"{os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return "unknown"
+
+
+class Profiler(object):
+    """
+    Records the calls made to ArcGIS, by replacing the functions of the ArcGIS API for Python with wrappers that time them.
+    HTTP requests sent with requests are attributed to the call that sent them, and counted as "http" calls if they
+    were sent outside of a recorded operation (for example to sign in)
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.events = []
+        self.dropped_events = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._originals = []
+        self._start = time.perf_counter()
+
+    def install(self):
+        """
+        Replaces the recorded operations with wrappers. Operations of modules that can't be imported are skipped
+        """
+        for module_name, class_name, function_name in OPERATIONS:
+            try:
+                owner = importlib.import_module(module_name)
+                if class_name:
+                    owner = getattr(owner, class_name)
+            except (ImportError, AttributeError):
+                continue
+            if hasattr(owner, function_name):
+                self._wrap(owner, function_name, function_name if class_name is None else f"{class_name}.{function_name}")
+        try:
+            import requests
+        except ImportError:
+            return
+        original_send = requests.Session.send
+
+        def send(session, request, **kwargs):
+            return self._send(original_send, session, request, **kwargs)
+
+        self._originals.append((requests.Session, "send", original_send))
+        requests.Session.send = send
+
+    def uninstall(self):
+        """
+        Restores the original functions
+        """
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        self._originals = []
+
+    def _wrap(self, owner, name, operation):
+        original = getattr(owner, name)
+
+        def wrapper(*args, **kwargs):
+            return self._call(operation, original, args, kwargs)
+
+        wrapper.__name__ = getattr(original, "__name__", name)
+        wrapper.__doc__ = getattr(original, "__doc__", None)
+        self._originals.append((owner, name, original))
+        setattr(owner, name, wrapper)
+
+    def _call(self, operation, function, args, kwargs):
+        if getattr(self._local, "call", None) is not None:
+            # an operation made by another one (for example the pages of a query) is part of the outer call
+            return function(*args, **kwargs)
+        call = {"operation": operation, "phase": find_phase(), "http_requests": 0, "bytes_sent": 0, "bytes_received": 0, "records": 0, "error": False}
+        self._local.call = call
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+            call["records"] = count_records(result)
+            return result
+        except Exception:
+            call["error"] = True
+            raise
+        finally:
+            self._local.call = None
+            self._record(call, start, time.perf_counter())
+
+    def _send(self, original_send, session, request, **kwargs):
+        call = getattr(self._local, "call", None)
+        start = time.perf_counter()
+        response = original_send(session, request, **kwargs)
+        # a streamed response hasn't been read yet, so its size comes from the headers
+        received = int(response.headers.get("Content-Length") or 0) if kwargs.get("stream") else len(response.content or b"")
+        sent = len(request.body or b"")
+        if call is None:
+            self._record({"operation": "http", "phase": find_phase(), "http_requests": 1, "bytes_sent": sent, "bytes_received": received,
+                          "records": 0, "error": not response.ok}, start, time.perf_counter())
+        else:
+            call["http_requests"] += 1
+            call["bytes_sent"] += sent
+            call["bytes_received"] += received
+        return response
+
+    def _record(self, call, start, end):
+        duration_ms = (end - start) * 1000
+        key = (call["phase"], call["operation"])
+        with self._lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = {"phase": call["phase"], "operation": call["operation"], "calls": 0, "errors": 0, "http_requests": 0,
+                                           "records": 0, "bytes_sent": 0, "bytes_received": 0, "total_ms": 0.0, "durations_ms": [],
+                                           "histogram": [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)}
+            stats["calls"] += 1
+            stats["errors"] += int(call["error"])
+            for name in ("http_requests", "records", "bytes_sent", "bytes_received"):
+                stats[name] += call[name]
+            stats["total_ms"] += duration_ms
+            stats["durations_ms"].append(duration_ms)
+            stats["histogram"][bisect.bisect_left(HISTOGRAM_BUCKETS_MS, duration_ms)] += 1
+            if len(self.events) < MAX_TRACE_EVENTS:
+                self.events.append({"name": call["operation"], "cat": call["phase"], "ph": "X", "ts": round((start - self._start) * 1000000),
+                                    "dur": round(duration_ms * 1000), "pid": os.getpid(), "tid": threading.get_ident(),
+                                    "args": {name: call[name] for name in ("phase", "http_requests", "records", "bytes_sent", "bytes_received", "error")}})
+            else:
+                self.dropped_events += 1
+
+    def summary(self):
+        """
+        Summarizes the calls per phase and operation, slowest first
+        :return: (list) A dict per phase and operation with the number of calls, errors, HTTP requests, records, and bytes,
+                 and the total, mean, median, 95th percentile, and maximum latency in milliseconds
+        """
+        rows = []
+        with self._lock:
+            for stats in self.stats.values():
+                durations = sorted(stats["durations_ms"])
+                row = {name: value for name, value in stats.items() if name != "durations_ms"}
+                row.update({
+                    "total_ms": round(stats["total_ms"], 1),
+                    "mean_ms": round(stats["total_ms"] / stats["calls"], 1),
+                    "p50_ms": round(durations[(len(durations) - 1) // 2], 1),
+                    "p95_ms": round(durations[int(0.95 * (len(durations) - 1))], 1),
+                    "max_ms": round(durations[-1], 1),
+                })
+                rows.append(row)
+        return sorted(rows, key=lambda row: -row["total_ms"])
+
+    def format_table(self):
+        """
+        Formats the summary as a table
+        :return: (string) The table
+        """
+        columns = ["phase", "operation", "calls", "errors", "http_requests", "records", "bytes_received", "total_ms", "mean_ms", "p95_ms", "max_ms"]
+        rows = [columns] + [[str(row[column]) for column in columns] for row in self.summary()]
+        widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+        return "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
+
+    def find_repeated_calls(self, threshold=N_PLUS_ONE_CALLS):
+        """
+        Finds the phases that call an operation many times, which usually means one request per feature
+        :param threshold: (int) The number of calls to warn about
+        :return: (list) A warning message per phase and operation
+        """
+        return [f"{row['phase']} called {row['operation']} {row['calls']} times ({row['total_ms'] / 1000:.1f} seconds). "
+                f"If it is called once per feature, fetching the data for all of the features at once may be faster"
+                for row in self.summary() if row["operation"] != "http" and row["calls"] >= threshold]
+
+    def write_json(self, path):
+        """
+        Writes the summary, including the latency histograms, to a JSON file
+        :param path: (string) The path of the file
+        """
+        with open(path, "w") as f:
+            json.dump({"histogram_buckets_ms": HISTOGRAM_BUCKETS_MS, "elapsed_ms": round((time.perf_counter() - self._start) * 1000, 1),
+                       "operations": self.summary()}, f, indent=2)
+
+    def write_chrome_trace(self, path):
+        """
+        Writes every recorded call to a Chrome trace file
+        :param path: (string) The path of the file
+        """
+        with self._lock:
+            events = list(self.events)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"dropped_events": self.dropped_events}}, f)
@@ -14,12 +14,22 @@
     That allows the user to support dynamic joins of data.
 """
 import argparse
+import datetime
+import json
 import logging
 import logging.handlers
+import os
+import random
+import time
 import traceback
 import sys
-from arcgis.gis import GIS
 from arcgis.features import FeatureLayer
+from edit_utils import edit_features_in_batches, normalize_global_id
+from instrumentation import add_profile_arguments, profile
+from session_cache import add_cache_arguments, connect
+
+# The distance (in meters) a location can move before the mirrored feature is updated
+GEOMETRY_TOLERANCE = 0.01
 
 
 def initialize_logging(log_file=None):
@@ -56,16 +66,243 @@ def return_field_name(layer, name_to_check):
             return field['name']
 
 
+def is_unchanged(feature, mirror_feature, ignored_fields):
+    """
+    Checks whether the mirrored feature already has the same attributes and geometry as the LKL feature
+    :param feature: (Feature) The LKL feature
+    :param mirror_feature: (Feature) The mirrored feature
+    :param ignored_fields: (set) The (lowercase) field names to skip, such as the object id field
+    :return: (bool) True if nothing has changed
+    """
+    for field, value in feature.attributes.items():
+        if field.lower() in ignored_fields or field not in mirror_feature.attributes:
+            continue
+        if mirror_feature.attributes[field] != value:
+            return False
+    geometry = feature.geometry or {}
+    mirror_geometry = mirror_feature.geometry or {}
+    if not geometry or not mirror_geometry:
+        return geometry == mirror_geometry
+    return abs(geometry["x"] - mirror_geometry["x"]) <= GEOMETRY_TOLERANCE and abs(geometry["y"] - mirror_geometry["y"]) <= GEOMETRY_TOLERANCE
+
+
+def compute_edits(lkl_features, mirror_features, lkl_global_id_field, mirror_global_id_field, ignored_fields):
+    """
+    Computes the edits needed to make the mirrored layer match the LKL layer in a single pass
+    :param lkl_features: (list) The LKL features
+    :param mirror_features: (list) The features currently in the mirrored layer
+    :param lkl_global_id_field: (string) The global id field name of the LKL layer
+    :param mirror_global_id_field: (string) The global id field name of the mirrored layer
+    :param ignored_fields: (set) The (lowercase) field names to skip when checking for changes
+    :return: (tuple) The features to add, the features to update, and the global ids to delete
+    """
+    mirror_by_id = {normalize_global_id(f.attributes[mirror_global_id_field]): f for f in mirror_features}
+    add_features = []
+    update_features = []
+    for feature in lkl_features:
+        mirror_feature = mirror_by_id.pop(normalize_global_id(feature.attributes[lkl_global_id_field]), None)
+        if mirror_feature is None:
+            add_features.append(feature)
+        elif not is_unchanged(feature, mirror_feature, ignored_fields):
+            update_features.append(feature)
+    # anything left in the mirror is a device that is no longer in the LKL layer
+    delete_ids = [f.attributes[mirror_global_id_field] for f in mirror_by_id.values()]
+    return add_features, update_features, delete_ids
+
+
+def load_state(state_file):
+    """
+    Loads the incremental sync state (watermark) from a JSON file
+    :param state_file: (string) The path of the state file
+    :return: (dict) The state, or an empty dict if the file does not exist yet
+    """
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def save_state(state_file, state):
+    """
+    Saves the incremental sync state to a JSON file. The file is replaced atomically so an interrupted run can't corrupt it
+    :param state_file: (string) The path of the state file
+    :param state: (dict) The state to save
+    """
+    temp_file = f"{state_file}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_file, state_file)
+
+
+def create_state(features, watermark_field, global_id_field):
+    """
+    Creates the state recording the newest change that has been mirrored
+    :param features: (list) The LKL features that were synced
+    :param watermark_field: (string) The date field used as the watermark
+    :param global_id_field: (string) The global id field of the LKL layer
+    :return: (dict) The state
+    """
+    watermark = max((f.attributes[watermark_field] for f in features if f.attributes[watermark_field] is not None), default=None)
+    # The where clause only has second precision, so remember the features changed within the last second to ignore them next time
+    watermark_second = watermark - watermark % 1000 if watermark is not None else None
+    return {
+        "watermark_field": watermark_field,
+        "watermark": watermark,
+        "watermark_ids": {normalize_global_id(f.attributes[global_id_field]): f.attributes[watermark_field] for f in features
+                          if watermark_second is not None and f.attributes[watermark_field] is not None and f.attributes[watermark_field] >= watermark_second}
+    }
+
+
+def query_mirror_features(mirror_layer, mirror_global_id_field, global_ids, chunk_size=500):
+    """
+    Queries the mirrored features with the given global ids
+    :param mirror_layer: (FeatureLayer) The mirrored layer
+    :param mirror_global_id_field: (string) The global id field of the mirrored layer
+    :param global_ids: (list) The global ids to query
+    :param chunk_size: (int) The number of global ids to put in each query
+    :return: (list) The mirrored features
+    """
+    features = []
+    for i in range(0, len(global_ids), chunk_size):
+        ids_string = ", ".join(f"'{global_id}'" for global_id in global_ids[i:i + chunk_size])
+        features.extend(mirror_layer.query(f"{mirror_global_id_field} IN ({ids_string})", out_sr=3857).features)
+    return features
+
+
+def resolve_fields(lkl_layer, mirror_layer):
+    """
+    Resolves the field names used to sync the layers
+    :param lkl_layer: (FeatureLayer) The LKL layer
+    :param mirror_layer: (FeatureLayer) The mirrored layer
+    :return: (dict) The global id fields of both layers, the watermark field, and the (lowercase) fields to skip when comparing features
+    """
+    lkl_global_id_field = return_field_name(lkl_layer, "global_id")
+    mirror_global_id_field = return_field_name(mirror_layer, "global_id")
+    return {
+        "lkl_global_id": lkl_global_id_field,
+        "mirror_global_id": mirror_global_id_field,
+        "watermark": return_field_name(lkl_layer, "last_edited_date") or return_field_name(lkl_layer, "location_timestamp"),
+        "ignored": {lkl_layer.properties.objectIdField.lower(), mirror_layer.properties.objectIdField.lower(),
+                    lkl_global_id_field.lower(), mirror_global_id_field.lower()}
+    }
+
+
+def sync(lkl_layer, mirror_layer, logger, state_file=None, full_sync=False, batch_size=500, max_workers=4, max_retries=3, fields=None):
+    """
+    Mirrors the LKL layer into the mirrored layer
+    :param lkl_layer: (FeatureLayer) The LKL layer
+    :param mirror_layer: (FeatureLayer) The mirrored layer
+    :param logger: (Logger) The logger to use
+    :param state_file: (string) If provided, only the LKL features changed since the watermark in this file are synced
+    :param full_sync: (bool) If True, compare every feature even if there is a watermark (this also finds deleted LKLs)
+    :param batch_size: (int) The number of edits to send in each request
+    :param max_workers: (int) The number of requests to send concurrently
+    :param max_retries: (int) The number of times to retry a failed request
+    :param fields: (dict) The field names from resolve_fields. Resolved from the layers if not provided
+    """
+    if fields is None:
+        fields = resolve_fields(lkl_layer, mirror_layer)
+    lkl_global_id_field = fields["lkl_global_id"]
+    mirror_global_id_field = fields["mirror_global_id"]
+    watermark_field = fields["watermark"]
+    ignored_fields = fields["ignored"]
+    state = load_state(state_file) if state_file and not full_sync else {}
+
+    if state.get("watermark") is not None and state.get("watermark_field") == watermark_field:
+        # Query only the LKLs changed since the watermark
+        since = datetime.datetime.utcfromtimestamp(state["watermark"] / 1000)
+        logger.info(f"Querying LKL data changed since {since}")
+        lkl_features = lkl_layer.query(f"{watermark_field} >= timestamp '{since.strftime('%Y-%m-%d %H:%M:%S')}'", out_sr=3857).features
+        watermark_ids = state.get("watermark_ids", {})
+        changed_features = [f for f in lkl_features
+                            if watermark_ids.get(normalize_global_id(f.attributes[lkl_global_id_field])) != f.attributes[watermark_field]]
+        if len(changed_features) == 0:
+            logger.info("No LKL changes since the last sync")
+            return
+        mirror_features = query_mirror_features(mirror_layer, mirror_global_id_field, [f.attributes[lkl_global_id_field] for f in changed_features])
+    else:
+        # Query LKL and mirror layer
+        lkl_features = changed_features = lkl_layer.query('1=1', out_sr=3857).features
+        if len(lkl_features) == 0:
+            logger.info("No LKLs in your layer yet!")
+            return
+        mirror_features = mirror_layer.query('1=1', out_sr=3857).features
+
+    logger.info("Iterating through current LKL data")
+    add_features, update_features, delete_ids = compute_edits(changed_features,
+                                                              mirror_features,
+                                                              lkl_global_id_field,
+                                                              mirror_global_id_field,
+                                                              ignored_fields)
+    logger.info(f"Adds: {len(add_features)}, updates: {len(update_features)}, deletes: {len(delete_ids)}, "
+                f"unchanged: {len(changed_features) - len(add_features) - len(update_features)}")
+    failed = 0
+    if add_features or update_features or delete_ids:
+        logger.info("Posting updated data to mirrored layer")
+        summary = edit_features_in_batches(mirror_layer, logger, adds=add_features, updates=update_features, deletes=delete_ids,
+                                           batch_size=batch_size, max_workers=max_workers, max_retries=max_retries, use_global_ids=True)
+        failed = summary["failed"]
+    else:
+        logger.info("Mirrored layer is already up to date")
+    if state_file:
+        if failed:
+            # Keep the previous watermark so the changes are compared with the mirror again, and the failed edits retried, on the next sync
+            logger.warning(f"{failed} edit(s) failed, the watermark was not advanced")
+        else:
+            save_state(state_file, create_state(lkl_features, watermark_field, lkl_global_id_field))
+
+
+def watch(lkl_layer, mirror_layer, logger, interval, jitter=None, full_sync=False, **sync_arguments):
+    """
+    Runs sync cycles on a fixed cadence, reusing the authenticated session and resolved field names.
+    Cycles never overlap: if a cycle takes longer than the interval, the cycles that should have started in the meantime are skipped
+    :param lkl_layer: (FeatureLayer) The LKL layer
+    :param mirror_layer: (FeatureLayer) The mirrored layer
+    :param logger: (Logger) The logger to use
+    :param interval: (float) The number of seconds between the start of each cycle
+    :param jitter: (float) The maximum number of seconds to randomly delay each cycle by. Defaults to 10% of the interval
+    :param full_sync: (bool) If True, the first cycle compares every feature
+    :param sync_arguments: The other arguments to pass to sync
+    """
+    if jitter is None:
+        jitter = interval * 0.1
+    fields = resolve_fields(lkl_layer, mirror_layer)
+    cycle = 0
+    skipped_cycles = 0
+    next_start = time.monotonic()
+    logger.info(f"Watching for LKL changes every {interval} seconds")
+    try:
+        while True:
+            cycle += 1
+            cycle_start = time.monotonic()
+            try:
+                sync(lkl_layer, mirror_layer, logger, full_sync=full_sync and cycle == 1, fields=fields, **sync_arguments)
+            except Exception as e:
+                # Keep watching, the next cycle may succeed
+                logger.error(f"Cycle {cycle} failed: {e}")
+                logger.debug(traceback.format_exc().replace("\n", " | "))
+            latency = time.monotonic() - cycle_start
+            next_start += interval
+            missed = 0
+            if time.monotonic() > next_start:
+                missed = int((time.monotonic() - next_start) // interval) + 1
+                next_start += missed * interval
+                skipped_cycles += missed
+            logger.info(f"Cycle {cycle} completed in {latency:.2f} seconds")
+            if missed:
+                logger.warning(f"Cycle {cycle} took longer than the interval, skipped {missed} cycle(s) ({skipped_cycles} in total)")
+            time.sleep(max(0, next_start - time.monotonic()) + random.uniform(0, jitter))
+    except KeyboardInterrupt:
+        logger.info(f"Stopped watching after {cycle} cycle(s), skipped {skipped_cycles} cycle(s)")
+
+
 def main(arguments):
     # initialize logger
     logger = initialize_logging(arguments.log_file)
     # Create the GIS
     logger.info("Authenticating...")
     # First step is to get authenticate and get a valid token
-    gis = GIS(arguments.org_url,
-              username=arguments.username,
-              password=arguments.password,
-              verify_cert=not arguments.skip_ssl_verification)
+    gis = connect(arguments, logger, use_cached_token=not arguments.watch)
 
     # Get the feature layer
     if gis.content.get(arguments.item_id):
@@ -77,34 +314,32 @@ def main(arguments):
         else:
             logger.info("Please pass an LKL layer url!")
             sys.exit(0)
-
-        # Query LKL and mirror layer
-        lkl_fset = lkl_layer.query('1=1', out_sr=3857)
-        if len(lkl_fset) == 0:
-            logger.info("No LKLs in your layer yet!")
-            sys.exit(0)
-        mirror_fset = mirror_layer.query('1=1', out_sr=3857)
-
-        add_features = []
-        update_features = []
-        logger.info("Iterating through current LKL data")
-        for feature in lkl_fset:
-            for mirror_feature in mirror_fset:
-                # use "in" instead of == comparison due to the potential for brackets to be in the GUID field
-                if mirror_feature.attributes[return_field_name(mirror_layer, "global_id")].lower() in feature.attributes["globalid"].lower():
-                    update_features.append(feature)
-                    break
-            else:
-                add_features.append(feature)
-
-        logger.info("Posting updated data to mirrored layer")
-        mirror_layer.edit_features(adds=add_features, updates=update_features, use_global_ids=True)
+        if arguments.watch:
+            watch(lkl_layer, mirror_layer, logger,
+                  interval=arguments.interval,
+                  jitter=arguments.jitter,
+                  full_sync=arguments.full_sync,
+                  state_file=arguments.state_file,
+                  batch_size=arguments.batch_size,
+                  max_workers=arguments.max_workers,
+                  max_retries=arguments.max_retries)
+            return
+        sync(lkl_layer, mirror_layer, logger,
+             state_file=arguments.state_file,
+             full_sync=arguments.full_sync,
+             batch_size=arguments.batch_size,
+             max_workers=arguments.max_workers,
+             max_retries=arguments.max_retries)
         logger.info("Completed!")
     else:
         logger.info("Item not found")
 
 
-if __name__ == "__main__":
+def create_parser():
+    """
+    Creates the parser of the command line arguments
+    :return: (ArgumentParser) The parser
+    """
     # Get all of the commandline arguments
     parser = argparse.ArgumentParser("Python script which maintains an exact replica of your LKL layer "
                                      "in a separate feature service, so that data can be joined")
@@ -118,13 +353,33 @@ if __name__ == "__main__":
                         help="The last known location (LKL) layer (either location tracking service or tracks view) you'd like to use. "
                              "This URL should end in /1")
     parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('-state-file', dest='state_file', default=None,
+                        help="A JSON file used to store the time of the last synced change. If provided, only LKLs changed since then are synced (optional)")
+    parser.add_argument('--full-sync', dest='full_sync', action='store_true',
+                        help="If provided with -state-file, compare all LKLs instead of only the changed ones. This also removes deleted LKLs from the mirror")
+    parser.add_argument('-batch-size', dest='batch_size', type=int, default=500, help="The number of edits to send in each request")
+    parser.add_argument('-max-workers', dest='max_workers', type=int, default=4, help="The number of edit requests to send concurrently")
+    parser.add_argument('-max-retries', dest='max_retries', type=int, default=3, help="The number of times to retry a failed edit request")
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help="If provided, keep running and sync every -interval seconds instead of syncing once")
+    parser.add_argument('--interval', '-interval', dest='interval', type=float, default=60,
+                        help="The number of seconds between the start of each sync when using --watch. Defaults to 60")
+    parser.add_argument('-jitter', dest='jitter', type=float, default=None,
+                        help="The maximum number of seconds to randomly delay each sync by when using --watch. Defaults to 10%% of the interval")
     parser.add_argument('--skip-ssl-verification',
                         dest='skip_ssl_verification',
                         action='store_true',
                         help="Verify the SSL Certificate of the server")
-    args = parser.parse_args()
+    add_profile_arguments(parser)
+    add_cache_arguments(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
     try:
-        main(args)
+        with profile(args):
+            main(args)
     except Exception as e:
         logging.getLogger().critical("Exception detected, script exiting")
         logging.getLogger().critical(e)
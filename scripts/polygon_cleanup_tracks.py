@@ -14,13 +14,21 @@
     Requires being an admin to run this script
 """
 import argparse
+import collections
+import datetime
+import json
 import logging
 import logging.handlers
+import numpy
+import os
+import time
 import traceback
 import sys
-from arcgis.gis import GIS
 from arcgis.features import FeatureLayer
 from arcgis import geometry
+from instrumentation import add_profile_arguments, profile
+from session_cache import add_cache_arguments, connect, get_tracks_layer
+from track_index import query_pages
 
 
 def initialize_logging(log_file=None):
@@ -60,23 +68,292 @@ def form_donut(rings):
     return rings
 
 
+def query_polygons(layer, where, page_size=None):
+    """
+    Queries the polygons one page at a time so layers with many polygons don't have to be returned in one request
+    :param layer: (FeatureLayer) The polygon layer
+    :param where: (string) The where clause
+    :param page_size: (int) The number of polygons to request per page. Defaults to (and is capped to) the maxRecordCount of the layer
+    :return: (list) The polygon features
+    """
+    pages = query_pages(layer, where, out_sr=3857, page_size=page_size, order_by=f"{layer.properties.objectIdField} ASC")
+    return [feature for page in pages for feature in page]
+
+
+def union_locally(geometries):
+    """
+    Unions polygons with the local geometry engine (shapely) instead of the geometry service
+    :param geometries: (list) The polygon geometries
+    :return: (dict) The unioned polygon
+    """
+    # shapely is only needed with --local-geometry
+    from shapely.ops import unary_union
+    from geometry_utils import rings_to_shapely, shapely_to_rings
+    union = unary_union([rings_to_shapely(g["rings"]) for g in geometries])
+    return {"rings": shapely_to_rings(union), "spatialReference": {"wkid": 3857}}
+
+
+def count_tracks(tracks_layer, features, object_id_field, union_geometry, symmetric_difference, logger):
+    """
+    Counts the tracks that would be deleted, per polygon and per user, without deleting anything.
+    The tracks are fetched in one paged pull and assigned to the polygons locally (with shapely), rather than with a query per polygon
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :param features: (list) The polygon features
+    :param object_id_field: (string) The object id field of the polygon layer, used to identify the polygons
+    :param union_geometry: (dict) The union of the polygons
+    :param symmetric_difference: (bool) If True, count the tracks outside the polygons rather than inside.
+                                 The per polygon counts are then the tracks that would be kept
+    :param logger: (Logger) The logger to use
+    :return: (dict) The number of tracks that would be deleted per user
+    """
+    # shapely is only needed with --dry-run and --local-geometry
+    from geometry_utils import contains_xy, rings_to_shapely
+    # only the tracks inside the union can be deleted, unless the tracks outside of it are
+    geometry_filter = None if symmetric_difference else geometry.filters.intersects(union_geometry, sr=3857)
+    users, xs, ys = [], [], []
+    for page in query_pages(tracks_layer, "1=1", out_fields="created_user", out_sr=3857, geometry_filter=geometry_filter):
+        for feature in page:
+            point = feature.geometry or {}
+            users.append(feature.attributes["created_user"])
+            xs.append(numpy.nan if point.get("x") is None else point["x"])
+            ys.append(numpy.nan if point.get("y") is None else point["y"])
+    # sort the tracks by x, so the tracks within the bounds of each polygon are found with a binary search
+    order = numpy.argsort(numpy.array(xs, dtype=numpy.float64), kind="mergesort")
+    users = numpy.array(users, dtype=object)[order]
+    xs = numpy.array(xs, dtype=numpy.float64)[order]
+    ys = numpy.array(ys, dtype=numpy.float64)[order]
+    inside = numpy.zeros(len(xs), dtype=bool)
+    for feature in features:
+        polygon_id = feature.attributes.get(object_id_field)
+        shape = rings_to_shapely(feature.geometry["rings"])
+        xmin, ymin, xmax, ymax = shape.bounds
+        first, last = numpy.searchsorted(xs, xmin, side="left"), numpy.searchsorted(xs, xmax, side="right")
+        positions = first + numpy.flatnonzero((ys[first:last] >= ymin) & (ys[first:last] <= ymax))
+        positions = positions[contains_xy(shape, xs[positions], ys[positions])]
+        inside[positions] = True
+        polygon_counts = collections.Counter(users[positions])
+        logger.info(f"Polygon {polygon_id}: {len(positions)} tracks would be {'kept' if symmetric_difference else 'deleted'} "
+                    f"({', '.join(f'{user}: {count}' for user, count in sorted(polygon_counts.items()))})")
+    counts = dict(collections.Counter(users[~inside] if symmetric_difference else users[inside]))
+    for user, count in sorted(counts.items()):
+        if count:
+            logger.info(f"User {user}: {count} tracks")
+    logger.info(f"Total: {sum(counts.values())} tracks would be deleted")
+    return counts
+
+
+def load_state(state_file, job):
+    """
+    Loads the progress of an interrupted cleanup
+    :param state_file: (string) The path of the state file
+    :param job: (dict) The parameters of the current cleanup. Progress from a cleanup with different parameters is ignored.
+                The job section of the state also holds the extent and time range the tiles and time slices were created from
+    :return: (dict) The state
+    """
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+        if all(state.get("job", {}).get(key) == value for key, value in job.items()):
+            return state
+    return {"job": dict(job), "completed": [], "deleted": 0}
+
+
+def save_state(state_file, state):
+    """
+    Saves the progress of the cleanup, replacing the file atomically so an interruption can't corrupt it
+    :param state_file: (string) The path of the state file
+    :param state: (dict) The state to save
+    """
+    temp_file = f"{state_file}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_file, state_file)
+
+
+def get_extent(rings):
+    """
+    Computes the extent of polygon rings
+    :param rings: (list) The rings
+    :return: (tuple) xmin, ymin, xmax, ymax
+    """
+    xs = [point[0] for ring in rings for point in ring]
+    ys = [point[1] for ring in rings for point in ring]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def create_tiles(extent, tile_size):
+    """
+    Splits an extent into square tiles
+    :param extent: (tuple) xmin, ymin, xmax, ymax
+    :param tile_size: (float) The width and height of a tile in meters
+    :return: (list) The tiles as polygon geometries
+    """
+    xmin, ymin, xmax, ymax = extent
+    tiles = []
+    y = ymin
+    while y < ymax or not tiles:
+        x = xmin
+        while x < xmax or x == xmin:
+            tiles.append({"rings": [[[x, y], [x, y + tile_size], [x + tile_size, y + tile_size], [x + tile_size, y], [x, y]]],
+                          "spatialReference": {"wkid": 3857}})
+            x += tile_size
+        y += tile_size
+    return tiles
+
+
+def clip_to_tiles(gis, cleanup_geometry, tiles, chunk_size=100, local_geometry=False):
+    """
+    Intersects the cleanup geometry with each tile using the geometry service or the local geometry engine
+    :param gis: (GIS) The GIS to use
+    :param cleanup_geometry: (dict) The polygon to clip
+    :param tiles: (list) The tiles
+    :param chunk_size: (int) The number of tiles to send per request
+    :param local_geometry: (bool) If True, use the local geometry engine (shapely)
+    :return: (list) The part of the cleanup geometry within each tile (an empty polygon if the tile doesn't overlap it)
+    """
+    if local_geometry:
+        from shapely.geometry import Polygon
+        from geometry_utils import rings_to_shapely, shapely_to_rings
+        cleanup_shape = rings_to_shapely(cleanup_geometry["rings"])
+        return [{"rings": shapely_to_rings(cleanup_shape.intersection(Polygon(tile["rings"][0]))), "spatialReference": {"wkid": 3857}}
+                for tile in tiles]
+    clipped = []
+    for i in range(0, len(tiles), chunk_size):
+        clipped.extend(geometry.intersect(spatial_ref=3857, geometries=tiles[i:i + chunk_size], geometry=cleanup_geometry, gis=gis))
+    return clipped
+
+
+def get_time_range(tracks_layer):
+    """
+    Gets the time range of the tracks layer
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :return: (list) The timestamps (epoch ms) of the first and last tracks, or None if there are no tracks
+    """
+    statistics = [{"statisticType": "min", "onStatisticField": "location_timestamp", "outStatisticFieldName": "first_track"},
+                  {"statisticType": "max", "onStatisticField": "location_timestamp", "outStatisticFieldName": "last_track"}]
+    features = tracks_layer.query(where="1=1", out_statistics=statistics).features
+    if not features or features[0].attributes["first_track"] is None:
+        return None
+    return [features[0].attributes["first_track"], features[0].attributes["last_track"]]
+
+
+def create_time_slices(time_range, time_slice_hours):
+    """
+    Splits a time range into slices
+    :param time_range: (list) The timestamps (epoch ms) of the first and last tracks, or None if there are no tracks
+    :param time_slice_hours: (float) The length of each slice in hours
+    :return: (list) The where clause of each slice
+    """
+    if not time_range:
+        return []
+    first_track = datetime.datetime.utcfromtimestamp(time_range[0] / 1000).replace(minute=0, second=0, microsecond=0)
+    last_track = datetime.datetime.utcfromtimestamp(time_range[1] / 1000)
+    slices = []
+    slice_start = first_track
+    while slice_start <= last_track:
+        slice_end = slice_start + datetime.timedelta(hours=time_slice_hours)
+        slices.append(f"location_timestamp >= timestamp '{slice_start.strftime('%Y-%m-%d %H:%M:%S')}' AND "
+                      f"location_timestamp < timestamp '{slice_end.strftime('%Y-%m-%d %H:%M:%S')}'")
+        slice_start = slice_end
+    return slices
+
+
+def delete_in_batches(tracks_layer, object_ids, batch_size):
+    """
+    Deletes tracks by object id in batches
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :param object_ids: (list) The object ids to delete
+    :param batch_size: (int) The number of tracks to delete per request
+    :return: (int) The number of tracks that were deleted
+    """
+    deleted = 0
+    for i in range(0, len(object_ids), batch_size):
+        result = tracks_layer.delete_features(deletes=",".join(str(object_id) for object_id in object_ids[i:i + batch_size]))
+        deleted += len([r for r in result["deleteResults"] if r.get("success")])
+    return deleted
+
+
+def tiled_cleanup(gis, tracks_layer, cleanup_geometry, extent, logger, tile_size=10000, time_slice_hours=24, batch_size=1000,
+                  state_file=None, job=None, local_geometry=False):
+    """
+    Deletes the tracks intersecting the cleanup geometry one tile and time slice at a time, in batches of object ids.
+    Completed tiles and time slices are recorded in the state file so an interrupted cleanup can be resumed. Deleting tracks
+    can change the extent and time range of the tracks layer, so the ones of the first run are saved and reused on resume
+    :param gis: (GIS) The GIS to use
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :param cleanup_geometry: (dict) The polygon containing the tracks to delete
+    :param extent: (tuple) xmin, ymin, xmax, ymax of the area to split into tiles, unless resuming
+    :param logger: (Logger) The logger to use
+    :param tile_size: (float) The width and height of a tile in meters
+    :param time_slice_hours: (float) The length of each time slice in hours
+    :param batch_size: (int) The number of tracks to delete per request
+    :param state_file: (string) The file used to record progress (optional)
+    :param job: (dict) The parameters of the cleanup, used to check that the state file belongs to the same cleanup
+    :param local_geometry: (bool) If True, clip the tiles with the local geometry engine (shapely)
+    :return: (int) The number of tracks that were deleted
+    """
+    state = load_state(state_file, job) if state_file else {"job": dict(job or {}), "completed": [], "deleted": 0}
+    if "extent" in state["job"]:
+        logger.info(f"Resuming cleanup, {len(state['completed'])} tile/time slice(s) were already completed")
+    else:
+        state["job"]["extent"] = list(extent)
+        state["job"]["time_range"] = get_time_range(tracks_layer)
+        if state_file:
+            save_state(state_file, state)
+    tiles = create_tiles(state["job"]["extent"], tile_size)
+    logger.info(f"Clipping cleanup geometry to {len(tiles)} tile(s)")
+    clipped_tiles = clip_to_tiles(gis, cleanup_geometry, tiles, local_geometry=local_geometry)
+    time_slices = create_time_slices(state["job"]["time_range"], time_slice_hours)
+    completed = set(state["completed"])
+    deleted = 0
+    start_time = time.time()
+    for tile_index, clipped_tile in enumerate(clipped_tiles):
+        if not clipped_tile or not clipped_tile.get("rings"):
+            continue
+        intersect_filter = geometry.filters.intersects(clipped_tile, sr=3857)
+        if all(f"{tile_index}:{slice_index}" in completed for slice_index in range(len(time_slices))):
+            continue
+        # Skip all of the time slices of tiles without tracks using a single count
+        if tracks_layer.query(where="1=1", geometry_filter=intersect_filter, return_count_only=True) == 0:
+            continue
+        for slice_index, time_slice in enumerate(time_slices):
+            unit = f"{tile_index}:{slice_index}"
+            if unit in completed:
+                continue
+            object_ids = tracks_layer.query(where=time_slice, geometry_filter=intersect_filter, return_ids_only=True)["objectIds"]
+            unit_deleted = 0
+            if object_ids:
+                unit_deleted = delete_in_batches(tracks_layer, object_ids, batch_size)
+                deleted += unit_deleted
+                elapsed = time.time() - start_time
+                logger.info(f"Tile {tile_index + 1}/{len(tiles)}, time slice {slice_index + 1}/{len(time_slices)}: "
+                            f"deleted {deleted} tracks so far ({deleted / elapsed if elapsed else 0:.0f} tracks/second)")
+            completed.add(unit)
+            if state_file:
+                state["completed"].append(unit)
+                state["deleted"] += unit_deleted
+                save_state(state_file, state)
+    if state_file and os.path.exists(state_file):
+        # The cleanup is complete, so the next run starts from the beginning
+        os.remove(state_file)
+    return deleted
+
+
 def main(arguments):
     # initialize logger
     logger = initialize_logging(arguments.log_file)
     # Create the GIS
     logger.info("Authenticating...")
     # First step is to get authenticate and get a valid token
-    gis = GIS(arguments.org_url,
-              username=arguments.username,
-              password=arguments.password,
-              verify_cert=not arguments.skip_ssl_verification)
+    # A tiled cleanup can run for longer than a cached token is valid, so it always signs in
+    gis = connect(arguments, logger, use_cached_token=not arguments.tiled)
     if not gis.properties.isPortal:
         logger.error("This script only works with ArcGIS Enterprise")
         sys.exit(0)
 
     logger.info("Getting location tracking service")
     try:
-        tracks_layer = gis.admin.location_tracking.tracks_layer
+        tracks_layer = get_tracks_layer(gis)
     except Exception as e:
         logger.info(e)
         logger.info("Getting location tracking service failed - check that you are an admin and that location tracking is enabled for your organization")
@@ -84,19 +361,46 @@ def main(arguments):
 
     logger.info("Getting polygon layer")
     try:
-        layer = FeatureLayer(url=args.layer_url, gis=gis)
+        layer = FeatureLayer(url=arguments.layer_url, gis=gis)
         _ = layer._lyr_json
     except Exception as e:
         logger.info(e)
         logger.info("Layer could not be found based on given input. Please check your parameters again. Exiting the script")
         sys.exit(0)
 
-    features = layer.query(where=args.where, out_sr=3857).features
+    features = query_polygons(layer, arguments.where, arguments.page_size)
     if len(features) > 0:
         geometries = [feature.geometry for feature in features]
         logger.info("Unifying geometry data")
-        union_geometry = geometry.union(spatial_ref=3857, geometries=geometries, gis=gis)
-        if args.symmetric_difference:
+        if arguments.local_geometry:
+            union_geometry = union_locally(geometries)
+        else:
+            union_geometry = geometry.union(spatial_ref=3857, geometries=geometries, gis=gis)
+        if arguments.dry_run:
+            logger.info("Counting features")
+            count_tracks(tracks_layer, features, layer.properties.objectIdField, union_geometry, arguments.symmetric_difference, logger)
+            logger.info("Dry run completed, no tracks were deleted")
+            return
+        if arguments.tiled:
+            if arguments.symmetric_difference:
+                extent = tracks_layer.query(where="1=1", out_sr=3857, return_extent_only=True)["extent"]
+                extent = (extent["xmin"], extent["ymin"], extent["xmax"], extent["ymax"])
+                union_geometry['rings'] = form_donut(union_geometry['rings'])
+            else:
+                extent = get_extent(union_geometry['rings'])
+            job = {"layer_url": arguments.layer_url, "where": arguments.where, "symmetric_difference": arguments.symmetric_difference,
+                   "tile_size": arguments.tile_size, "time_slice_hours": arguments.time_slice_hours}
+            deleted = tiled_cleanup(gis, tracks_layer, union_geometry, extent, logger,
+                                    tile_size=arguments.tile_size,
+                                    time_slice_hours=arguments.time_slice_hours,
+                                    batch_size=arguments.batch_size,
+                                    state_file=arguments.state_file,
+                                    job=job,
+                                    local_geometry=arguments.local_geometry)
+            logger.info(f"Deleted: {deleted} tracks")
+            logger.info("Completed!")
+            return
+        if arguments.symmetric_difference:
             union_geometry['rings'] = form_donut(union_geometry['rings'])
         intersect_filter = geometry.filters.intersects(union_geometry, sr=3857)
         logger.info("Querying features")
@@ -106,7 +410,11 @@ def main(arguments):
         logger.info("Completed!")
 
 
-if __name__ == "__main__":
+def create_parser():
+    """
+    Creates the parser of the command line arguments
+    :return: (ArgumentParser) The parser
+    """
     # Get all of the commandline arguments
     parser = argparse.ArgumentParser(
         "This sample allows cleanup of track points from a tracks layer based on a spatial relationship to polygon geometry")
@@ -121,13 +429,39 @@ if __name__ == "__main__":
     parser.add_argument('--symmetric-difference', action='store_true', dest='symmetric_difference',
                         help="If provided, delete the tracks outside the polygon(s). If not provided, delete the tracks inside the polygon")
     parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('--local-geometry', action='store_true', dest='local_geometry',
+                        help="If provided, union and clip the polygons with the local geometry engine (shapely) instead of the geometry service")
+    parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                        help="If provided, log the number of tracks that would be deleted per polygon and per user without deleting anything. "
+                             "Requires shapely")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of polygons to request per page. Defaults to the max record count of the polygon layer")
+    parser.add_argument('--tiled', action='store_true', dest='tiled',
+                        help="If provided, split the cleanup into spatial tiles and time slices and delete the tracks in batches of object ids. "
+                             "Use this for large tracks layers where a single delete request times out")
+    parser.add_argument('-tile-size', dest='tile_size', type=float, default=10000,
+                        help="The width and height of each tile in meters when using --tiled. Defaults to 10000")
+    parser.add_argument('-time-slice-hours', dest='time_slice_hours', type=float, default=24,
+                        help="The length of each time slice in hours when using --tiled. Defaults to 24")
+    parser.add_argument('-batch-size', dest='batch_size', type=int, default=1000,
+                        help="The number of tracks to delete per request when using --tiled. Defaults to 1000")
+    parser.add_argument('-state-file', dest='state_file', default="polygon_cleanup_state.json",
+                        help="The file used to record the progress of a --tiled cleanup so it can be resumed if interrupted. "
+                             "Defaults to polygon_cleanup_state.json")
     parser.add_argument('--skip-ssl-verification',
                         dest='skip_ssl_verification',
                         action='store_true',
                         help="Verify the SSL Certificate of the server")
-    args = parser.parse_args()
+    add_profile_arguments(parser)
+    add_cache_arguments(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
     try:
-        main(args)
+        with profile(args):
+            main(args)
     except Exception as e:
         logging.getLogger().critical("Exception detected, script exiting")
         logging.getLogger().critical(e)
@@ -0,0 +1,444 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This sample performs proximity tracing on a single machine, without GeoAnalytics Server.
+    Given starting entities (people, vehicles, ...), it finds all entities that have been near them, and repeats
+    for each newly found entity. It uses the same algorithm as the "Proximity Tracing" notebook:
+     1. Find all proximity events, where two entities are within the search distance and search duration of each other.
+        The observations are hashed into time buckets and spatial cells, and the buckets are searched in parallel
+     2. Group consecutive proximity events between two entities into single sustained events
+     3. Walk the contacts with a priority queue, always visiting the earliest contact of an entity first
+"""
+import argparse
+import concurrent.futures
+import csv
+import heapq
+import itertools
+import logging
+import logging.handlers
+import os
+import traceback
+import sys
+import numpy
+import pendulum
+from arcgis.gis import GIS
+from arcgis.features import FeatureLayer
+from instrumentation import add_profile_arguments, profile
+from track_index import TIMESTAMP_FIELD, create_time_clause, query_pages
+
+WGS84 = {'wkid': 4326}
+EARTH_RADIUS = 6371008.8
+
+
+def initialize_logging(log_file=None):
+    """
+    Setup logging
+    :param log_file: (string) The file to log to
+    :return: (Logger) a logging instance
+    """
+    # initialize logging
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(filename)30s:%(lineno)4s - %(funcName)30s()][%(threadName)5s] [%(name)10.10s] [%(levelname)8s] %(message)s")
+    # Grab the root logger
+    logger = logging.getLogger()
+    # Set the root logger logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+    logger.setLevel(logging.DEBUG)
+    # Create a handler to print to the console
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(formatter)
+    sh.setLevel(logging.INFO)
+    # Create a handler to log to the specified file
+    if log_file:
+        rh = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760)
+        rh.setFormatter(formatter)
+        rh.setLevel(logging.DEBUG)
+        logger.addHandler(rh)
+    # Add the handlers to the root logger
+    logger.addHandler(sh)
+    return logger
+
+
+def _expand_ranges(lo, hi):
+    """
+    Expands the ranges [lo, hi) of a sorted array into pairs of (range number, position)
+    :param lo: (ndarray) The first position of each range
+    :param hi: (ndarray) The position after the last of each range
+    :return: (tuple) The range number and the position of each element of all ranges
+    """
+    counts = hi - lo
+    total = counts.sum()
+    offsets = numpy.cumsum(counts) - counts
+    return numpy.repeat(numpy.arange(len(lo)), counts), numpy.repeat(lo - offsets, counts) + numpy.arange(total)
+
+
+def find_nearby_pairs(positions, xs, ys, timestamps, codes, first_bucket, last_bucket, search_distance, search_duration):
+    """
+    Finds the pairs of observations of different entities within the search distance and duration of each other.
+    The observations are hashed into cells that are search_duration long and search_distance wide, so only the
+    neighbouring cells need to be searched. Each pair is found once, from the observation in the earlier cell.
+    This runs in a worker process for the observations of a range of time buckets
+    :param positions: (ndarray) The positions of the observations in the full arrays
+    :param xs: (ndarray) The x coordinates of the observations, in meters
+    :param ys: (ndarray) The y coordinates of the observations, in meters
+    :param timestamps: (ndarray) The timestamps (epoch ms) of the observations
+    :param codes: (ndarray) The entity code of each observation
+    :param first_bucket: (int) The first time bucket to search from
+    :param last_bucket: (int) The time bucket after the last one to search from. Its observations must be included
+    :param search_distance: (float) The search distance in meters
+    :param search_duration: (int) The search duration in milliseconds
+    :return: (tuple) The positions of the first and second observation of each pair
+    """
+    buckets = timestamps // search_duration - first_bucket
+    cxs = numpy.floor(xs / search_distance).astype(numpy.int64)
+    cys = numpy.floor(ys / search_distance).astype(numpy.int64)
+    cxs -= cxs.min() - 1
+    cys -= cys.min() - 1
+    width = int(cxs.max()) + 2
+    height = int(cys.max()) + 2
+    keys = (buckets * width + cxs) * height + cys
+    order = numpy.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    queries = numpy.flatnonzero(buckets < last_bucket - first_bucket)
+    # half of the neighbouring cells in the same time bucket, and all of them in the next time bucket
+    offsets = [(0, 0, 0), (0, 0, 1), (0, 1, -1), (0, 1, 0), (0, 1, 1)]
+    offsets += [(1, dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+    firsts, seconds = [], []
+    for db, dx, dy in offsets:
+        targets = keys[queries] + (db * width + dx) * height + dy
+        lo = numpy.searchsorted(sorted_keys, targets, side="left")
+        hi = numpy.searchsorted(sorted_keys, targets, side="right")
+        query_numbers, sorted_positions = _expand_ranges(lo, hi)
+        first = queries[query_numbers]
+        second = order[sorted_positions]
+        mask = codes[first] != codes[second]
+        if (db, dx, dy) == (0, 0, 0):
+            mask &= first < second
+        mask &= (xs[first] - xs[second]) ** 2 + (ys[first] - ys[second]) ** 2 <= search_distance * search_distance
+        mask &= numpy.abs(timestamps[first] - timestamps[second]) <= search_duration
+        firsts.append(positions[first[mask]])
+        seconds.append(positions[second[mask]])
+    return numpy.concatenate(firsts), numpy.concatenate(seconds)
+
+
+class ProximityTracing(object):
+    """
+    Finds the proximity events between the observations of entities, and traces the contacts of starting entities
+    """
+
+    def __init__(self, entities, timestamps, xs, ys, search_distance, search_duration, gap_tolerance=None, max_workers=None):
+        """
+        :param entities: (array-like) The entity id of each observation
+        :param timestamps: (array-like) The timestamp (epoch ms) of each observation
+        :param xs: (array-like) The longitude of each observation
+        :param ys: (array-like) The latitude of each observation
+        :param search_distance: (float) The distance in meters within which two entities are near each other
+        :param search_duration: (int) The time in milliseconds within which two entities are near each other
+        :param gap_tolerance: (int) Proximity events between two entities less than this many milliseconds apart are
+                              merged into a single event (optional). Consecutive observations are always merged
+        :param max_workers: (int) The number of processes used to find proximity events. Defaults to the number of CPUs
+        """
+        self.search_distance = float(search_distance)
+        self.search_duration = int(search_duration)
+        self.gap_tolerance = gap_tolerance
+        self.max_workers = max_workers or os.cpu_count()
+        names, codes = numpy.unique(numpy.asarray(entities, dtype=object).astype(str), return_inverse=True)
+        timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+        # sort by entity, then by time, so consecutive observations of an entity have consecutive positions
+        order = numpy.lexsort((timestamps, codes))
+        self.entities = [str(name) for name in names]
+        self.codes = codes[order]
+        self.offsets = numpy.searchsorted(self.codes, numpy.arange(len(self.entities) + 1))
+        self.timestamps = timestamps[order]
+        self.longitudes = numpy.asarray(xs, dtype=numpy.float64)[order]
+        self.latitudes = numpy.asarray(ys, dtype=numpy.float64)[order]
+        # project to meters around the center of the data, which is accurate enough at city scale
+        center_latitude = numpy.radians(self.latitudes.mean()) if len(self.latitudes) else 0
+        self.xs = EARTH_RADIUS * numpy.radians(self.longitudes) * numpy.cos(center_latitude)
+        self.ys = EARTH_RADIUS * numpy.radians(self.latitudes)
+        self.proximity_events = None
+        self._graph = None
+
+    def find_pairs(self):
+        """
+        Finds the pairs of nearby observations, searching ranges of time buckets in parallel
+        :return: (tuple) The positions of the first and second observation of each pair
+        """
+        if len(self.timestamps) == 0:
+            return numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64)
+        time_order = numpy.argsort(self.timestamps, kind="stable")
+        buckets = self.timestamps[time_order] // self.search_duration
+        # split the time buckets into chunks with roughly equal numbers of observations
+        chunk_count = self.max_workers * 4
+        boundaries = numpy.unique(buckets[numpy.linspace(0, len(buckets) - 1, chunk_count + 1).astype(numpy.int64)])
+        boundaries = numpy.append(boundaries, buckets[-1] + 1)
+        chunks = []
+        for first_bucket, last_bucket in zip(boundaries[:-1], boundaries[1:]):
+            lo = numpy.searchsorted(buckets, first_bucket, side="left")
+            hi = numpy.searchsorted(buckets, last_bucket, side="right")
+            positions = time_order[lo:hi]
+            chunks.append((positions, self.xs[positions], self.ys[positions], self.timestamps[positions], self.codes[positions],
+                           int(first_bucket), int(last_bucket), self.search_distance, self.search_duration))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(find_nearby_pairs, *zip(*chunks)))
+        return numpy.concatenate([first for first, _ in results]), numpy.concatenate([second for _, second in results])
+
+    def find_proximity_events(self):
+        """
+        Finds all sustained proximity events. Each event is recorded in both directions (A near B and B near A).
+        An event continues while the observations of the from entity near the to entity are consecutive, or
+        less than the gap tolerance apart
+        :return: (dict) The from code, to code, start time, end time, longitude and latitude (of the first observation) of each event
+        """
+        first, second = self.find_pairs()
+        froms = numpy.concatenate((first, second))
+        to_codes = self.codes[numpy.concatenate((second, first))]
+        # one record per observation of the from entity and entity it is near, sorted by entity pair and time
+        order = numpy.lexsort((froms, to_codes, self.codes[froms]))
+        froms = froms[order]
+        to_codes = to_codes[order]
+        unique = numpy.ones(len(froms), dtype=bool)
+        unique[1:] = (froms[1:] != froms[:-1]) | (to_codes[1:] != to_codes[:-1])
+        froms = froms[unique]
+        to_codes = to_codes[unique]
+        from_codes = self.codes[froms]
+        times = self.timestamps[froms]
+        continues = (from_codes[1:] == from_codes[:-1]) & (to_codes[1:] == to_codes[:-1])
+        if self.gap_tolerance:
+            continues &= (froms[1:] - froms[:-1] <= 1) | (numpy.diff(times) < self.gap_tolerance)
+        else:
+            continues &= froms[1:] - froms[:-1] <= 1
+        starts = numpy.flatnonzero(numpy.concatenate(([True], ~continues))) if len(froms) else numpy.array([], dtype=numpy.int64)
+        ends = numpy.append(starts[1:], len(froms)) - 1
+        self.proximity_events = {
+            "from": from_codes[starts],
+            "to": to_codes[starts],
+            "start": times[starts],
+            "end": times[ends],
+            "x": self.longitudes[froms[starts]],
+            "y": self.latitudes[froms[starts]],
+        }
+        self._graph = None
+        return self.proximity_events
+
+    def _build_graph(self):
+        """
+        Builds a directed multigraph of the proximity events as nested dictionaries:
+        {from code: {to code: (ndarray of event ends, ndarray of event numbers sorted by end)}}
+        """
+        events = self.proximity_events
+        order = numpy.lexsort((events["end"], events["to"], events["from"]))
+        pair_changes = numpy.flatnonzero(numpy.concatenate(([True], (numpy.diff(events["from"][order]) != 0) | (numpy.diff(events["to"][order]) != 0))))
+        pair_ends = numpy.append(pair_changes[1:], len(order))
+        self._graph = {}
+        for start, end in zip(pair_changes, pair_ends):
+            numbers = order[start:end]
+            self._graph.setdefault(int(events["from"][numbers[0]]), {})[int(events["to"][numbers[0]])] = (events["end"][numbers], numbers)
+
+    def find_next_events(self, code, start):
+        """
+        Finds the earliest proximity event with each other entity that ends after the start time
+        :param code: (int) The entity code
+        :param start: (int) The start time (epoch ms)
+        :return: (list) The event number of each next event
+        """
+        next_events = []
+        for ends, numbers in self._graph.get(code, {}).values():
+            position = numpy.searchsorted(ends, start, side="right")
+            if position < len(ends):
+                next_events.append(int(numbers[position]))
+        return next_events
+
+    def trace(self, root_entities, max_depth=100):
+        """
+        Traces the contacts of the root entities. Contacts are visited in order of their contact time so each entity
+        is reached through its earliest contact
+        :param root_entities: (list) (entity id, start time epoch ms) pairs to start the trace with
+        :param max_depth: (int) The maximum number of contacts between a root entity and a traced entity
+        :return: (list) (from id, to id, depth, duration minutes, start, end, longitude, latitude) of each traced entity
+        """
+        if self.proximity_events is None:
+            self.find_proximity_events()
+        if self._graph is None:
+            self._build_graph()
+        events = self.proximity_events
+        codes = {entity: code for code, entity in enumerate(self.entities)}
+        search_queue = []
+        # Breaks ties between queue entries with the same time and entity, so the result rows are never compared
+        sequence = itertools.count()
+        visited = set()
+        trace_result = []
+        for entity_id, start_time in root_entities:
+            if str(entity_id) not in codes:
+                continue
+            heapq.heappush(search_queue, (start_time, codes[str(entity_id)], 0, next(sequence), None))
+            trace_result.append((None, str(entity_id), 0, 0.0, start_time, start_time, None, None))
+        while search_queue:
+            start, code, depth, _, result_row = heapq.heappop(search_queue)
+            if code in visited:
+                continue
+            visited.add(code)
+            if result_row:
+                trace_result.append(result_row)
+            if depth < max_depth:
+                for number in self.find_next_events(code, start):
+                    event_start = int(events["start"][number])
+                    event_end = int(events["end"][number])
+                    to_code = int(events["to"][number])
+                    result_row = (self.entities[code], self.entities[to_code], depth + 1, round((event_end - event_start) / 60000, 2),
+                                  event_start, event_end, float(events["x"][number]), float(events["y"][number]))
+                    heapq.heappush(search_queue, (event_start, to_code, depth + 1, next(sequence), result_row))
+        return trace_result
+
+    def build_trace_tracks(self, trace_result):
+        """
+        Finds the observations of each traced entity from the time it was reached
+        :param trace_result: (list) The result of trace
+        :return: (generator) Yields (entity id, timestamp, longitude, latitude, depth) of each observation
+        """
+        codes = {entity: code for code, entity in enumerate(self.entities)}
+        for _, entity_id, depth, _, start, _, _, _ in trace_result:
+            code = codes[entity_id]
+            lo = self.offsets[code] + numpy.searchsorted(self.timestamps[self.offsets[code]:self.offsets[code + 1]], start, side="left")
+            for position in range(lo, self.offsets[code + 1]):
+                yield entity_id, int(self.timestamps[position]), float(self.longitudes[position]), float(self.latitudes[position]), depth
+
+
+def format_timestamp(timestamp):
+    return pendulum.from_timestamp(timestamp / 1000).to_datetime_string()
+
+
+def write_csv(path, header, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def main(arguments):
+    # initialize logger
+    logger = initialize_logging(arguments.log_file)
+    # Create the GIS
+    logger.info("Authenticating...")
+    # First step is to get authenticate and get a valid token
+    gis = GIS(arguments.org_url,
+              username=arguments.username,
+              password=arguments.password,
+              verify_cert=not arguments.skip_ssl_verification)
+
+    logger.info("Getting tracks layer")
+    if arguments.tracks_layer_url:
+        tracks_layer = FeatureLayer(url=arguments.tracks_layer_url, gis=gis)
+    else:
+        try:
+            tracks_layer = gis.admin.location_tracking.tracks_layer
+        except Exception as e:
+            logger.info(e)
+            logger.info("Getting location tracking service failed - check that you are an admin and that location tracking is enabled for your organization")
+            sys.exit(0)
+
+    root_entities = [(entity_id, pendulum.parse(start, tz=arguments.time_zone).in_tz('UTC')) for entity_id, start in arguments.initial_entities]
+    end_date = pendulum.parse(arguments.end_date, tz=arguments.time_zone).in_tz('UTC') if arguments.end_date else None
+    # only the observations after the earliest start time can be part of the trace
+    where = f"({create_time_clause(min(start for _, start in root_entities), end_date)}) AND ({arguments.where})"
+
+    logger.info("Querying tracks")
+    entities, timestamps, xs, ys = [], [], [], []
+    for page in query_pages(tracks_layer, where, out_fields=f"{arguments.entity_id_field},{TIMESTAMP_FIELD}", out_sr=WGS84, page_size=arguments.page_size):
+        for feature in page:
+            entities.append(feature.attributes[arguments.entity_id_field])
+            timestamps.append(feature.attributes[TIMESTAMP_FIELD])
+            xs.append(feature.geometry["x"])
+            ys.append(feature.geometry["y"])
+    logger.info(f"Loaded {len(timestamps)} observations")
+
+    tracing = ProximityTracing(entities, timestamps, xs, ys,
+                               search_distance=arguments.search_distance,
+                               search_duration=int(arguments.search_duration * 60000),
+                               gap_tolerance=int(arguments.gap_tolerance * 60000) if arguments.gap_tolerance else None,
+                               max_workers=arguments.max_workers)
+    logger.info("Finding proximity events")
+    events = tracing.find_proximity_events()
+    logger.info(f"Found {len(events['start'])} proximity events")
+    if arguments.output_all_proximity_events:
+        write_csv(arguments.output_all_proximity_events,
+                  ["from_id", "to_id", "duration_minutes", "start_time", "end_time", "x", "y"],
+                  ((tracing.entities[f], tracing.entities[t], round((e - s) / 60000, 2), format_timestamp(s), format_timestamp(e), x, y)
+                   for f, t, s, e, x, y in zip(events["from"], events["to"], events["start"], events["end"], events["x"], events["y"])))
+        logger.info(f"Wrote all proximity events to {arguments.output_all_proximity_events}")
+
+    logger.info("Performing trace")
+    trace_result = tracing.trace([(entity_id, int(start.timestamp() * 1000)) for entity_id, start in root_entities], arguments.max_depth)
+    write_csv(arguments.output_trace_events,
+              ["from_id", "to_id", "depth", "duration_minutes", "start_time", "end_time", "x", "y"],
+              ((from_id, to_id, depth, duration, format_timestamp(start), format_timestamp(end), x, y)
+               for from_id, to_id, depth, duration, start, end, x, y in trace_result))
+    logger.info(f"Traced {len(trace_result)} entities, wrote trace events to {arguments.output_trace_events}")
+    if arguments.output_trace_tracks:
+        write_csv(arguments.output_trace_tracks,
+                  [arguments.entity_id_field, TIMESTAMP_FIELD, "x", "y", "depth"],
+                  ((entity_id, format_timestamp(timestamp), x, y, depth)
+                   for entity_id, timestamp, x, y, depth in tracing.build_trace_tracks(trace_result)))
+        logger.info(f"Wrote trace tracks to {arguments.output_trace_tracks}")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Trace the contacts of entities using their tracks")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
+    parser.add_argument('-p', dest='password', help="The password to authenticate with", required=True)
+    parser.add_argument('-org', dest='org_url', help="The url of the org/portal to use", required=True)
+    # Parameters for tracker
+    parser.add_argument('-initial-entity', dest='initial_entities', nargs=2, action='append', required=True, metavar=('ENTITY_ID', 'START_TIME'),
+                        help="An entity to begin the trace with and the time to start from, e.g. -initial-entity janedoe '2020-04-24 00:00:00'. "
+                             "Can be provided multiple times")
+    parser.add_argument('-tracks-layer-url', dest='tracks_layer_url', default=None,
+                        help="The tracks layer (either location tracking service or tracks view) you'd like to use. "
+                             "Defaults to the Location Tracking Service tracks layer")
+    parser.add_argument('-where', dest='where', default="1=1",
+                        help="Query conditions for the tracks to use, e.g. 'horizontal_accuracy <= 100'. Defaults to all (1=1)")
+    parser.add_argument('-end-date', dest='end_date', default=None, help="Ignore tracks after this time (optional)")
+    parser.add_argument('-time-zone', dest='time_zone', default='UTC', help="The time zone of the start and end times. Defaults to UTC")
+    parser.add_argument('-entity-id-field', dest='entity_id_field', default="created_user",
+                        help="The name of the field uniquely identifying an entity. Defaults to created_user")
+    parser.add_argument('-search-distance', dest='search_distance', type=float, default=10,
+                        help="The distance in meters within which two entities are near each other. Defaults to 10")
+    parser.add_argument('-search-duration', dest='search_duration', type=float, default=1,
+                        help="The time in minutes within which two entities are near each other. Defaults to 1")
+    parser.add_argument('-gap-tolerance', dest='gap_tolerance', type=float, default=1,
+                        help="Proximity events less than this many minutes apart are merged into a single event. 0 only merges consecutive "
+                             "observations. Defaults to 1")
+    parser.add_argument('-max-depth', dest='max_depth', type=int, default=100,
+                        help="The maximum number of contacts between an initial entity and a traced entity. Defaults to 100")
+    parser.add_argument('-max-workers', dest='max_workers', type=int, default=None,
+                        help="The number of processes used to find proximity events. Defaults to the number of CPUs")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of tracks to request per page. Defaults to the max record count of the tracks layer")
+    parser.add_argument('-output-trace-events', dest='output_trace_events', default="trace_events.csv",
+                        help="The CSV file to write the trace events to. Defaults to trace_events.csv")
+    parser.add_argument('-output-trace-tracks', dest='output_trace_tracks', default=None,
+                        help="The CSV file to write the tracks of the traced entities (after they were reached) to (optional)")
+    parser.add_argument('-output-all-proximity-events', dest='output_all_proximity_events', default=None,
+                        help="The CSV file to write all proximity events to (optional)")
+    parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('--skip-ssl-verification',
+                        dest='skip_ssl_verification',
+                        action='store_true',
+                        help="Verify the SSL Certificate of the server")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        with profile(args):
+            main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
@@ -0,0 +1,258 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This sample checks whether users followed the routes assigned to them, the same way as the
+    "Visualize Route Deviance" notebook, for many users and routes at once.
+    The routes and tracks are loaded once, and the user/route pairs are checked locally in parallel.
+"""
+import argparse
+import concurrent.futures
+import csv
+import logging
+import logging.handlers
+import math
+import traceback
+import sys
+import numpy
+import pendulum
+from shapely.geometry import Point
+from arcgis.gis import GIS
+from arcgis.features import FeatureLayer
+from geometry_utils import contains_xy, paths_to_shapely
+from instrumentation import add_profile_arguments, profile
+from track_index import SR, CREATOR_FIELD, TrackIndex, create_time_clause
+from track_store import add_track_store_arguments, open_track_store
+
+EARTH_RADIUS = 6378137.0
+
+
+def initialize_logging(log_file=None):
+    """
+    Setup logging
+    :param log_file: (string) The file to log to
+    :return: (Logger) a logging instance
+    """
+    # initialize logging
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(filename)30s:%(lineno)4s - %(funcName)30s()][%(threadName)5s] [%(name)10.10s] [%(levelname)8s] %(message)s")
+    # Grab the root logger
+    logger = logging.getLogger()
+    # Set the root logger logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+    logger.setLevel(logging.DEBUG)
+    # Create a handler to print to the console
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(formatter)
+    sh.setLevel(logging.INFO)
+    # Create a handler to log to the specified file
+    if log_file:
+        rh = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760)
+        rh.setFormatter(formatter)
+        rh.setLevel(logging.DEBUG)
+        logger.addHandler(rh)
+    # Add the handlers to the root logger
+    logger.addHandler(sh)
+    return logger
+
+
+def read_assignments(assignments_file):
+    """
+    Reads the user/route assignments
+    :param assignments_file: (string) A CSV file with username and route_item_id columns
+    :return: (list) (username, route item id) pairs
+    """
+    with open(assignments_file, newline="") as f:
+        return [(row["username"].strip(), row["route_item_id"].strip()) for row in csv.DictReader(f)]
+
+
+def load_route(gis, item_id, line_layer_index, stops_layer_index, buffer_distance):
+    """
+    Loads the line and stops of a route item, and buffers them in Web Mercator.
+    Web Mercator distances grow with latitude, so the buffer distance is scaled for the latitude of the route
+    :param gis: (GIS) The GIS
+    :param item_id: (string) The route item id
+    :param line_layer_index: (int) The index of the route line layer in the item
+    :param stops_layer_index: (int) The index of the stops layer in the item
+    :param buffer_distance: (float) The buffer distance in meters
+    :return: (tuple) The buffered route line, and the buffered first and last stops
+    """
+    layers = gis.content.get(item_id).layers
+    line_features = layers[line_layer_index].query(out_sr=SR).features
+    line = paths_to_shapely([path for feature in line_features for path in feature.geometry["paths"]])
+    stops = layers[stops_layer_index].query(out_sr=SR, order_by_fields=f"{layers[stops_layer_index].properties.objectIdField} ASC").features
+    latitude = math.degrees(2 * math.atan(math.exp(line.centroid.y / EARTH_RADIUS)) - math.pi / 2)
+    distance = buffer_distance / math.cos(math.radians(latitude))
+    start = Point(stops[0].geometry["x"], stops[0].geometry["y"]).buffer(distance)
+    end = Point(stops[-1].geometry["x"], stops[-1].geometry["y"]).buffer(distance)
+    return line.buffer(distance), start, end
+
+
+def check_route(timestamps, xs, ys, route_area, start_area, end_area):
+    """
+    Checks the tracks of a user against a route. The route ends at the first track near the last stop after the user
+    has left the first stop, so a route that starts and ends at the same depot is not ended by the tracks before
+    departure. It starts at the last track near the first stop before that. The tracks in between are tested against
+    the buffered route
+    :param timestamps: (ndarray) The timestamps (epoch ms) of the user's tracks, sorted
+    :param xs: (ndarray) The x coordinates of the tracks
+    :param ys: (ndarray) The y coordinates of the tracks
+    :param route_area: (shapely.geometry.base.BaseGeometry) The buffered route line
+    :param start_area: (shapely.geometry.base.BaseGeometry) The buffered first stop
+    :param end_area: (shapely.geometry.base.BaseGeometry) The buffered last stop
+    :return: (dict) The status, route start and end times, number of tracks and tracks off the route, and the
+             (start time, end time, number of tracks) of each deviation
+    """
+    result = {"status": "", "start": None, "end": None, "tracks": 0, "off_route": 0, "deviations": []}
+    in_start = contains_xy(start_area, xs, ys)
+    at_start = numpy.flatnonzero(in_start)
+    left_start = numpy.flatnonzero(~in_start[at_start[0]:]) if len(at_start) else []
+    if len(left_start) == 0:
+        result["status"] = "did not start the route"
+        return result
+    departure = at_start[0] + left_start[0]
+    at_end = numpy.flatnonzero(contains_xy(end_area, xs[departure:], ys[departure:]))
+    if len(at_end) == 0:
+        result["status"] = "did not reach the end of the route"
+        return result
+    end = departure + at_end[0]
+    start = numpy.flatnonzero(in_start[:end])[-1]
+    off_route = ~contains_xy(route_area, xs[start:end + 1], ys[start:end + 1])
+    times = timestamps[start:end + 1]
+    # each run of consecutive tracks off the route is a deviation
+    changes = numpy.flatnonzero(numpy.diff(numpy.concatenate(([False], off_route, [False])).astype(numpy.int8)))
+    result.update({
+        "status": "deviated" if off_route.any() else "followed",
+        "start": int(timestamps[start]),
+        "end": int(timestamps[end]),
+        "tracks": len(off_route),
+        "off_route": int(off_route.sum()),
+        "deviations": [(int(times[first]), int(times[last - 1]), int(last - first)) for first, last in zip(changes[::2], changes[1::2])],
+    })
+    return result
+
+
+def format_timestamp(timestamp):
+    return pendulum.from_timestamp(timestamp / 1000).to_datetime_string() if timestamp is not None else ""
+
+
+def main(arguments):
+    # initialize logger
+    logger = initialize_logging(arguments.log_file)
+    # Create the GIS
+    logger.info("Authenticating...")
+    # First step is to get authenticate and get a valid token
+    gis = GIS(arguments.org_url,
+              username=arguments.username,
+              password=arguments.password,
+              verify_cert=not arguments.skip_ssl_verification)
+
+    logger.info("Getting tracks layer")
+    if arguments.tracks_layer_url:
+        tracks_layer = FeatureLayer(url=arguments.tracks_layer_url, gis=gis)
+    else:
+        try:
+            tracks_layer = gis.admin.location_tracking.tracks_layer
+        except Exception as e:
+            logger.info(e)
+            logger.info("Getting location tracking service failed - check that you are an admin and that location tracking is enabled for your organization")
+            sys.exit(0)
+
+    assignments = read_assignments(arguments.assignments_file)
+    logger.info(f"Loading {len(set(route for _, route in assignments))} routes")
+    routes = {route: load_route(gis, route, arguments.line_layer_index, arguments.stops_layer_index, arguments.buffer_distance)
+              for route in sorted(set(route for _, route in assignments))}
+
+    logger.info("Loading tracks")
+    start_date = pendulum.parse(arguments.start_date, tz=arguments.time_zone).in_tz('UTC')
+    end_date = pendulum.parse(arguments.end_date, tz=arguments.time_zone).in_tz('UTC')
+    users = sorted(set(user for user, _ in assignments))
+    if arguments.track_store:
+        track_store = open_track_store(arguments.track_store, logger)
+        track_index = track_store.to_track_index(int(start_date.timestamp() * 1000), int(end_date.timestamp() * 1000), users=users)
+        track_store.close()
+    else:
+        users_string = ",".join(f"'{user}'" for user in users)
+        track_index = TrackIndex.from_layer(tracks_layer, where=f"{create_time_clause(start_date, end_date)} AND {CREATOR_FIELD} IN ({users_string})",
+                                            page_size=arguments.page_size)
+    logger.info(f"Loaded {len(track_index)} tracks for {len(track_index.users)} users")
+
+    logger.info(f"Checking {len(assignments)} assignments")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=arguments.max_workers) as executor:
+        futures = []
+        for user, route in assignments:
+            positions = track_index.query_time(user)
+            futures.append(executor.submit(check_route, track_index.timestamps[positions], track_index.xs[positions], track_index.ys[positions],
+                                           *routes[route]))
+        results = [future.result() for future in futures]
+
+    with open(arguments.output_file, "w", newline="") as summary_file, open(arguments.deviations_file, "w", newline="") as deviations_file:
+        summary_writer = csv.writer(summary_file)
+        summary_writer.writerow(["username", "route_item_id", "status", "route_start", "route_end", "tracks", "off_route_tracks", "percent_off_route",
+                                 "deviations"])
+        deviations_writer = csv.writer(deviations_file)
+        deviations_writer.writerow(["username", "route_item_id", "deviation", "start_time", "end_time", "tracks"])
+        for (user, route), result in zip(assignments, results):
+            percent = round(100 * result["off_route"] / result["tracks"], 2) if result["tracks"] else ""
+            summary_writer.writerow([user, route, result["status"], format_timestamp(result["start"]), format_timestamp(result["end"]),
+                                     result["tracks"], result["off_route"], percent, len(result["deviations"])])
+            for i, (start, end, count) in enumerate(result["deviations"], start=1):
+                deviations_writer.writerow([user, route, i, format_timestamp(start), format_timestamp(end), count])
+            logger.debug(f"{user} on {route}: {result['status']}")
+    deviated = len([result for result in results if result["status"] == "deviated"])
+    logger.info(f"{deviated} of {len(assignments)} assignments deviated from their route. Results written to {arguments.output_file} "
+                f"and {arguments.deviations_file}")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Check whether users followed their assigned routes")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
+    parser.add_argument('-p', dest='password', help="The password to authenticate with", required=True)
+    parser.add_argument('-org', dest='org_url', help="The url of the org/portal to use", required=True)
+    # Parameters for tracker
+    parser.add_argument('-assignments-file', dest='assignments_file', required=True,
+                        help="A CSV file with username and route_item_id columns, assigning a route to each user")
+    parser.add_argument('-start-date', dest='start_date', required=True, help="The start of the time period to check, e.g. '2020-02-13 01:10:00'")
+    parser.add_argument('-end-date', dest='end_date', required=True, help="The end of the time period to check, e.g. '2020-02-13 11:10:00'")
+    parser.add_argument('-time-zone', dest='time_zone', default='UTC', help="The time zone of the start and end dates. Defaults to UTC")
+    parser.add_argument('-tracks-layer-url', dest='tracks_layer_url', default=None,
+                        help="The tracks layer (either location tracking service or tracks view) you'd like to use. "
+                             "Defaults to the Location Tracking Service tracks layer")
+    parser.add_argument('-buffer-distance', dest='buffer_distance', type=float, default=150,
+                        help="Tracks within this distance (in meters) of the route are on the route, and within this distance of the first "
+                             "and last stops start and end the route. Defaults to 150")
+    parser.add_argument('-line-layer-index', dest='line_layer_index', type=int, default=0,
+                        help="The index of the route line layer in the route items. Defaults to 0")
+    parser.add_argument('-stops-layer-index', dest='stops_layer_index', type=int, default=3,
+                        help="The index of the stops layer in the route items. Defaults to 3")
+    parser.add_argument('-max-workers', dest='max_workers', type=int, default=None,
+                        help="The number of processes used to check the assignments. Defaults to the number of CPUs")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of tracks to request per page. Defaults to the max record count of the tracks layer")
+    parser.add_argument('-output-file', dest='output_file', default="route_deviance.csv",
+                        help="The CSV file to write the summary of each assignment to. Defaults to route_deviance.csv")
+    parser.add_argument('-deviations-file', dest='deviations_file', default="route_deviations.csv",
+                        help="The CSV file to write each deviation to. Defaults to route_deviations.csv")
+    parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('--skip-ssl-verification',
+                        dest='skip_ssl_verification',
+                        action='store_true',
+                        help="Verify the SSL Certificate of the server")
+    add_track_store_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        with profile(args):
+            main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
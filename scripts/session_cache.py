@@ -0,0 +1,208 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This module caches the token of a sign in and the service URLs resolved through it (for example the tracks layer of
+    the location tracking service) in a local file, so scripts that run often don't sign in and look the services up
+    on every run. Cached entries are used until they expire, and a token that is rejected is dropped and replaced by
+    signing in again.
+    The cache file is only readable by the current user and never contains passwords.
+"""
+import binascii
+import hashlib
+import json
+import os
+import tempfile
+import time
+from arcgis.gis import GIS
+from arcgis.features import FeatureLayer
+
+# The lifetime of the tokens requested for the cache, in minutes
+TOKEN_EXPIRATION_MINUTES = 120
+# Cached tokens are only used while they stay valid for this many more seconds, so a run doesn't outlive its token. A token
+# can't be refreshed without the password, so scripts that may run for longer sign in instead (use_cached_token=False)
+TOKEN_EXPIRY_MARGIN_SECONDS = 3600
+# How long resolved service URLs are cached for, in seconds
+URL_EXPIRATION_SECONDS = 86400
+# The number of PBKDF2 iterations of the password hash that ties a cached token to the password it was created with
+PASSWORD_HASH_ITERATIONS = 10000
+
+
+def add_cache_arguments(parser, default=None):
+    """
+    Adds the session cache arguments to the argument parser of a script
+    :param parser: (ArgumentParser) The parser
+    :param default: (string) The default cache file. Defaults to no caching
+    """
+    parser.add_argument('-session-cache', dest='session_cache', default=default,
+                        help="A file used to cache the sign in token and the resolved service URLs between runs (optional)")
+    parser.add_argument('--no-session-cache', dest='session_cache', action='store_const', const=None,
+                        help="If provided, sign in and resolve the service URLs without the session cache")
+
+
+class SessionCache(object):
+    """
+    A JSON file of cache entries keyed by user and org. Each entry holds a token and resolved service URLs with their
+    expiry times (epoch seconds)
+    """
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+
+    def _load(self):
+        try:
+            status = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+        if os.name == "posix" and (status.st_uid != os.getuid() or status.st_mode & 0o077):
+            self.logger.warning(f"Ignoring the session cache {self.path} because it is not private to the current user")
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Ignoring the unreadable session cache {self.path}: {e}")
+            return {}
+
+    def _save(self, entries):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Write to a private temporary file and rename it, so concurrent runs never read a partial file
+        handle, temporary_path = tempfile.mkstemp(dir=directory, prefix=".session_cache")
+        try:
+            with os.fdopen(handle, "w") as f:
+                json.dump(entries, f)
+            os.replace(temporary_path, self.path)
+        except Exception:
+            os.remove(temporary_path)
+            raise
+
+    def get(self, key):
+        """
+        Gets a cache entry, without its expired values
+        :param key: (string) The key of the entry
+        :return: (dict) The entry, empty if there is none
+        """
+        entry = self._load().get(key, {})
+        now = time.time()
+        if entry.get("token_expires", 0) - TOKEN_EXPIRY_MARGIN_SECONDS <= now:
+            entry.pop("token", None)
+        entry["urls"] = {name: url for name, url in entry.get("urls", {}).items() if url["expires"] > now}
+        return entry
+
+    def update(self, key, function):
+        """
+        Updates a cache entry
+        :param key: (string) The key of the entry
+        :param function: (function) Called with the entry (dict) to update it in place
+        """
+        entries = self._load()
+        function(entries.setdefault(key, {}))
+        self._save(entries)
+
+
+def get_cache_key(org_url, username):
+    """
+    Gets the key of the cache entry of a user in an org
+    :param org_url: (string) The url of the org/portal
+    :param username: (string) The username
+    :return: (string) The key
+    """
+    return f"{username.lower()}@{org_url.rstrip('/').lower()}"
+
+
+def hash_password(password, salt):
+    """
+    Hashes a password, so a cached token is only used with the password it was created with
+    :param password: (string) The password
+    :param salt: (string) The hex encoded salt
+    :return: (string) The hex encoded hash
+    """
+    return binascii.hexlify(hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), binascii.unhexlify(salt), PASSWORD_HASH_ITERATIONS)).decode()
+
+
+def connect(arguments, logger, use_cached_token=True):
+    """
+    Signs in to the org with the username and password of the command line arguments. If the arguments have a session
+    cache, a cached token of the same user and password is used instead of signing in, and the token of a new sign in
+    is cached
+    :param arguments: (Namespace) The command line arguments, with org_url, username, password and optionally
+                      skip_ssl_verification and session_cache
+    :param logger: (Logger) The logger
+    :param use_cached_token: (bool) Whether a cached token can be used. Tokens can't be refreshed, so long running
+                             scripts should sign in (and still cache the token for other runs)
+    :return: (GIS) The GIS. Its session cache is set as gis.session_cache, and its key as gis.session_cache_key
+    """
+    verify_cert = not getattr(arguments, "skip_ssl_verification", False)
+    cache_file = getattr(arguments, "session_cache", None)
+    if not cache_file:
+        gis = GIS(arguments.org_url, username=arguments.username, password=arguments.password, verify_cert=verify_cert)
+        gis.session_cache = None
+        return gis
+
+    cache = SessionCache(cache_file, logger)
+    key = get_cache_key(arguments.org_url, arguments.username)
+    entry = cache.get(key)
+    if use_cached_token and entry.get("token") and hash_password(arguments.password, entry["salt"]) == entry["password_hash"]:
+        try:
+            gis = GIS(arguments.org_url, token=entry["token"], verify_cert=verify_cert)
+            if gis.users.me is None or gis.users.me.username.lower() != arguments.username.lower():
+                raise Exception("The cached token is not signed in as the user")
+            logger.info("Using the cached sign in")
+            gis.session_cache, gis.session_cache_key = cache, key
+            return gis
+        except Exception as e:
+            logger.info(f"The cached sign in was rejected, signing in again: {e}")
+
+    gis = GIS(arguments.org_url, username=arguments.username, password=arguments.password, verify_cert=verify_cert,
+              expiration=TOKEN_EXPIRATION_MINUTES)
+    token = gis._con.token
+    gis.session_cache, gis.session_cache_key = cache, key
+    if token:
+        salt = binascii.hexlify(os.urandom(16)).decode()
+
+        def store_token(cached_entry):
+            cached_entry.update(token=token, token_expires=time.time() + TOKEN_EXPIRATION_MINUTES * 60,
+                                salt=salt, password_hash=hash_password(arguments.password, salt))
+
+        cache.update(key, store_token)
+    return gis
+
+
+def resolve_url(gis, name, resolver):
+    """
+    Gets a service URL from the session cache of the GIS, or resolves and caches it
+    :param gis: (GIS) A GIS returned by connect
+    :param name: (string) The name of the URL in the cache
+    :param resolver: (function) Called without arguments to resolve the URL when it isn't cached
+    :return: (string) The URL
+    """
+    cache = getattr(gis, "session_cache", None)
+    if cache is None:
+        return resolver()
+    cached = cache.get(gis.session_cache_key)["urls"].get(name)
+    if cached:
+        return cached["url"]
+    url = resolver()
+    expires = time.time() + URL_EXPIRATION_SECONDS
+    cache.update(gis.session_cache_key, lambda entry: entry.setdefault("urls", {}).update({name: {"url": url, "expires": expires}}))
+    return url
+
+
+def get_tracks_layer(gis):
+    """
+    Gets the tracks layer of the location tracking service, using the session cache for its URL
+    :param gis: (GIS) A GIS returned by connect
+    :return: (FeatureLayer) The tracks layer
+    """
+    url = resolve_url(gis, "tracks_layer", lambda: gis.admin.location_tracking.tracks_layer.url)
+    return FeatureLayer(url=url, gis=gis)
@@ -0,0 +1,330 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This module loads tracks into an in-memory index so that questions like
+    "was user X near point P around time T?" can be answered locally instead of with a query per question.
+    The tracks of each user are stored as compact NumPy arrays sorted by timestamp, and a uniform grid over
+    the coordinates is used for radius queries across all users.
+"""
+import collections
+import concurrent.futures
+import itertools
+import numpy
+
+# Spatial reference and field names of the tracks layer
+SR = {'wkid': 3857, 'latestWkid': 3857}
+ACCURACY_FIELD = "horizontal_accuracy"
+CREATOR_FIELD = "created_user"
+TIMESTAMP_FIELD = "location_timestamp"
+
+
+def query_pages(layer, where, out_fields="*", out_sr=SR, page_size=None, geometry_filter=None, order_by=None, max_workers=1):
+    """
+    Queries a layer one page at a time, in a stable order so that paging neither skips nor repeats features.
+    The server never returns more than maxRecordCount features per request, so the page size is capped to it
+    :param layer: (FeatureLayer) The layer to query
+    :param where: (string) The where clause
+    :param out_fields: (string) The fields to return
+    :param out_sr: (dict) The spatial reference to return the geometries in
+    :param page_size: (int) The number of records to request per page. Defaults to (and is capped to) the maxRecordCount of the layer
+    :param geometry_filter: (dict) A geometry filter to apply (optional)
+    :param order_by: (string) The order of the features. Defaults to the timestamp, then the object id
+    :param max_workers: (int) The number of pages to fetch concurrently. Pages are still yielded in order, so at most
+                        max_workers pages are held in memory
+    :return: (generator) Yields the list of features of each page
+    """
+    max_record_count = layer.properties.maxRecordCount
+    page_size = min(page_size or max_record_count, max_record_count)
+    order_by = order_by or f"{TIMESTAMP_FIELD} ASC, {layer.properties.objectIdField} ASC"
+
+    def query_page(offset):
+        return layer.query(where=where,
+                           out_fields=out_fields,
+                           out_sr=out_sr,
+                           geometry_filter=geometry_filter,
+                           order_by_fields=order_by,
+                           result_offset=offset,
+                           result_record_count=page_size,
+                           return_all_records=False).features
+
+    if max_workers > 1:
+        count = layer.query(where=where, geometry_filter=geometry_filter, return_count_only=True)
+        offsets = iter(range(0, count, page_size))
+        # The connection of the layer's GIS is shared by all of the threads, so HTTP connections are pooled
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = collections.deque(executor.submit(query_page, offset) for offset in itertools.islice(offsets, max_workers))
+            while pending:
+                features = pending.popleft().result()
+                for offset in itertools.islice(offsets, 1):
+                    pending.append(executor.submit(query_page, offset))
+                if features:
+                    yield features
+        return
+    offset = 0
+    while True:
+        features = query_page(offset)
+        if features:
+            yield features
+        if len(features) < page_size:
+            break
+        offset += len(features)
+
+
+def create_time_clause(start_date=None, end_date=None):
+    """
+    Creates a where clause for the tracks between two dates
+    :param start_date: (datetime) The start date in UTC (inclusive, optional)
+    :param end_date: (datetime) The end date in UTC (exclusive, optional)
+    :return: (string) The where clause
+    """
+    clauses = []
+    if start_date:
+        clauses.append(f"{TIMESTAMP_FIELD} >= timestamp '{start_date.strftime('%Y-%m-%d %H:%M:%S')}'")
+    if end_date:
+        clauses.append(f"{TIMESTAMP_FIELD} < timestamp '{end_date.strftime('%Y-%m-%d %H:%M:%S')}'")
+    return " AND ".join(clauses) or "1=1"
+
+
+def _to_epoch_ms(values):
+    """
+    Converts timestamps (epoch ms, datetimes or datetime64) to an int64 array of epoch milliseconds
+    :param values: (array-like) The timestamps to convert
+    :return: (ndarray) The epoch milliseconds
+    """
+    values = numpy.asarray(values)
+    if numpy.issubdtype(values.dtype, numpy.datetime64):
+        return values.astype("datetime64[ms]").astype(numpy.int64)
+    if values.dtype == object:
+        return numpy.array([numpy.datetime64(value, "ms").astype(numpy.int64) for value in values], dtype=numpy.int64)
+    return values.astype(numpy.int64)
+
+
+class TrackIndex(object):
+    """
+    An in-memory index of tracks.
+    Timestamps are epoch milliseconds and coordinates are in the spatial reference the tracks were loaded in (3857 by default),
+    so radius queries use the units of that spatial reference
+    """
+
+    def __init__(self, users, timestamps, xs, ys, accuracies=None, cell_size=100):
+        """
+        Builds the index
+        :param users: (array-like) The user of each track
+        :param timestamps: (array-like) The timestamp of each track (epoch ms, datetimes or datetime64)
+        :param xs: (array-like) The x coordinate of each track
+        :param ys: (array-like) The y coordinate of each track
+        :param accuracies: (array-like) The horizontal accuracy of each track (optional)
+        :param cell_size: (float) The size of the grid cells used for radius queries
+        """
+        self.cell_size = float(cell_size)
+        user_names, user_codes = numpy.unique(numpy.asarray(users, dtype=object).astype(str), return_inverse=True)
+        timestamps = _to_epoch_ms(timestamps)
+        # sort by user, then by time, so each user is a contiguous time-sorted slice
+        order = numpy.lexsort((timestamps, user_codes))
+        self.users = [str(user) for user in user_names]
+        self._user_positions = {user: position for position, user in enumerate(self.users)}
+        self._offsets = numpy.searchsorted(user_codes[order], numpy.arange(len(self.users) + 1))
+        self.user_codes = user_codes[order].astype(numpy.int32)
+        self.timestamps = timestamps[order]
+        self.xs = numpy.asarray(xs, dtype=numpy.float64)[order]
+        self.ys = numpy.asarray(ys, dtype=numpy.float64)[order]
+        if accuracies is None:
+            self.accuracies = numpy.full(len(self.timestamps), numpy.nan, dtype=numpy.float32)
+        else:
+            self.accuracies = numpy.asarray(accuracies, dtype=numpy.float32)[order]
+        # the grid is a sorted array of cell keys, so the points of a cell are found with a binary search
+        cell_keys = self._cell_keys(numpy.floor(self.xs / self.cell_size), numpy.floor(self.ys / self.cell_size))
+        self._cell_order = numpy.argsort(cell_keys, kind="stable")
+        self._sorted_cell_keys = cell_keys[self._cell_order]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @staticmethod
+    def _cell_keys(cxs, cys):
+        return numpy.asarray(cxs, dtype=numpy.int64) * 4294967296 + (numpy.asarray(cys, dtype=numpy.int64) + 2147483648)
+
+    @classmethod
+    def from_features(cls, features, cell_size=100):
+        """
+        Builds the index from tracks features
+        :param features: (iterable) The track features (for example the features of a FeatureSet)
+        :param cell_size: (float) The size of the grid cells used for radius queries
+        :return: (TrackIndex) The index
+        """
+        users, timestamps, xs, ys, accuracies = [], [], [], [], []
+        for feature in features:
+            users.append(feature.attributes[CREATOR_FIELD])
+            timestamps.append(feature.attributes[TIMESTAMP_FIELD])
+            accuracy = feature.attributes.get(ACCURACY_FIELD)
+            accuracies.append(numpy.nan if accuracy is None else accuracy)
+            xs.append(feature.geometry["x"])
+            ys.append(feature.geometry["y"])
+        return cls(users, timestamps, xs, ys, accuracies, cell_size=cell_size)
+
+    @classmethod
+    def from_dataframe(cls, df, cell_size=100):
+        """
+        Builds the index from a spatially enabled dataframe of tracks
+        :param df: (DataFrame) The tracks with a SHAPE column of points
+        :param cell_size: (float) The size of the grid cells used for radius queries
+        :return: (TrackIndex) The index
+        """
+        accuracies = df[ACCURACY_FIELD].values if ACCURACY_FIELD in df.columns else None
+        return cls(df[CREATOR_FIELD].values,
+                   df[TIMESTAMP_FIELD].values,
+                   [shape["x"] for shape in df["SHAPE"]],
+                   [shape["y"] for shape in df["SHAPE"]],
+                   accuracies,
+                   cell_size=cell_size)
+
+    @classmethod
+    def from_layer(cls, tracks_layer, where="1=1", out_sr=SR, page_size=None, cell_size=100, geometry_filter=None):
+        """
+        Builds the index from the tracks of a layer, fetching them one page at a time
+        :param tracks_layer: (FeatureLayer) The tracks layer to query
+        :param where: (string) The where clause of the tracks to load
+        :param out_sr: (dict) The spatial reference to load the tracks in
+        :param page_size: (int) The number of records to request per page. Defaults to the maxRecordCount of the layer
+        :param cell_size: (float) The size of the grid cells used for radius queries
+        :param geometry_filter: (dict) A geometry filter to apply, for example the extent of the area of interest (optional)
+        :return: (TrackIndex) The index
+        """
+        out_fields = f"{CREATOR_FIELD},{TIMESTAMP_FIELD},{ACCURACY_FIELD}"
+        pages = query_pages(tracks_layer, where, out_fields=out_fields, out_sr=out_sr, page_size=page_size, geometry_filter=geometry_filter)
+        return cls.from_features((feature for page in pages for feature in page), cell_size=cell_size)
+
+    def _time_slice(self, user, start=None, end=None):
+        """
+        Finds the positions of the tracks of a user within a time range using a binary search
+        :return: (tuple) The start and end positions in the index arrays
+        """
+        position = self._user_positions.get(str(user))
+        if position is None:
+            return 0, 0
+        first, last = self._offsets[position], self._offsets[position + 1]
+        timestamps = self.timestamps[first:last]
+        if start is not None:
+            first_in_range = first + numpy.searchsorted(timestamps, _to_epoch_ms([start])[0], side="left")
+        else:
+            first_in_range = first
+        if end is not None:
+            last_in_range = first + numpy.searchsorted(timestamps, _to_epoch_ms([end])[0], side="right")
+        else:
+            last_in_range = last
+        return first_in_range, last_in_range
+
+    def query_time(self, user, start=None, end=None, max_accuracy=None):
+        """
+        Returns the tracks of a user within a time range (inclusive)
+        :param user: (string) The user
+        :param start: (epoch ms, datetime or datetime64) The start of the range (optional)
+        :param end: (epoch ms, datetime or datetime64) The end of the range (optional)
+        :param max_accuracy: (float) Only return tracks with a horizontal accuracy less than or equal to this (optional)
+        :return: (ndarray) The positions of the matching tracks in the index arrays, sorted by time
+        """
+        first, last = self._time_slice(user, start, end)
+        positions = numpy.arange(first, last)
+        if max_accuracy is not None:
+            positions = positions[self.accuracies[first:last] <= max_accuracy]
+        return positions
+
+    def query(self, user, start, end, x, y, radius, max_accuracy=None):
+        """
+        Returns the tracks of a user within a time range and within a radius of a point
+        :param user: (string) The user
+        :param start: (epoch ms, datetime or datetime64) The start of the range
+        :param end: (epoch ms, datetime or datetime64) The end of the range
+        :param x: (float) The x coordinate of the point
+        :param y: (float) The y coordinate of the point
+        :param radius: (float) The search radius
+        :param max_accuracy: (float) Only return tracks with a horizontal accuracy less than or equal to this (optional)
+        :return: (ndarray) The positions of the matching tracks in the index arrays, sorted by time
+        """
+        positions = self.query_time(user, start, end, max_accuracy)
+        distances_squared = (self.xs[positions] - x) ** 2 + (self.ys[positions] - y) ** 2
+        return positions[distances_squared <= radius * radius]
+
+    def is_near(self, user, start, end, x, y, radius, max_accuracy=None):
+        """
+        Checks if a user was within a radius of a point during a time range
+        :return: (bool) True if at least one track matches
+        """
+        return len(self.query(user, start, end, x, y, radius, max_accuracy)) > 0
+
+    def query_radius(self, x, y, radius, start=None, end=None, max_accuracy=None):
+        """
+        Returns the tracks of all users within a radius of a point using the grid
+        :param x: (float) The x coordinate of the point
+        :param y: (float) The y coordinate of the point
+        :param radius: (float) The search radius
+        :param start: (epoch ms, datetime or datetime64) The start of the time range (optional)
+        :param end: (epoch ms, datetime or datetime64) The end of the time range (optional)
+        :param max_accuracy: (float) Only return tracks with a horizontal accuracy less than or equal to this (optional)
+        :return: (ndarray) The positions of the matching tracks in the index arrays, sorted by user and time
+        """
+        return self.query_envelope(x - radius, y - radius, x + radius, y + radius, start, end, max_accuracy,
+                                   center=(x, y), radius=radius)
+
+    def query_envelope(self, xmin, ymin, xmax, ymax, start=None, end=None, max_accuracy=None, center=None, radius=None):
+        """
+        Returns the tracks of all users within an envelope using the grid
+        :param xmin: (float) The minimum x of the envelope
+        :param ymin: (float) The minimum y of the envelope
+        :param xmax: (float) The maximum x of the envelope
+        :param ymax: (float) The maximum y of the envelope
+        :param start: (epoch ms, datetime or datetime64) The start of the time range (optional)
+        :param end: (epoch ms, datetime or datetime64) The end of the time range (optional)
+        :param max_accuracy: (float) Only return tracks with a horizontal accuracy less than or equal to this (optional)
+        :param center: (tuple) If provided with radius, only return tracks within the radius of this (x, y) point
+        :param radius: (float) The search radius to use with center
+        :return: (ndarray) The positions of the matching tracks in the index arrays, sorted by user and time
+        """
+        cxs = numpy.arange(numpy.floor(xmin / self.cell_size), numpy.floor(xmax / self.cell_size) + 1)
+        cys = numpy.arange(numpy.floor(ymin / self.cell_size), numpy.floor(ymax / self.cell_size) + 1)
+        keys = self._cell_keys(numpy.repeat(cxs, len(cys)), numpy.tile(cys, len(cxs)))
+        firsts = numpy.searchsorted(self._sorted_cell_keys, keys, side="left")
+        lasts = numpy.searchsorted(self._sorted_cell_keys, keys, side="right")
+        positions = numpy.concatenate([self._cell_order[first:last] for first, last in zip(firsts, lasts) if last > first] or
+                                      [numpy.empty(0, dtype=numpy.int64)])
+        xs, ys = self.xs[positions], self.ys[positions]
+        mask = (xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)
+        if center is not None and radius is not None:
+            mask &= (xs - center[0]) ** 2 + (ys - center[1]) ** 2 <= radius * radius
+        if start is not None:
+            mask &= self.timestamps[positions] >= _to_epoch_ms([start])[0]
+        if end is not None:
+            mask &= self.timestamps[positions] <= _to_epoch_ms([end])[0]
+        if max_accuracy is not None:
+            mask &= self.accuracies[positions] <= max_accuracy
+        return numpy.sort(positions[mask])
+
+    def split_by_user(self, positions):
+        """
+        Splits sorted positions by user
+        :param positions: (ndarray) Positions in the index arrays, sorted (as returned by the queries)
+        :return: (generator) Yields (user, positions of the user's tracks sorted by time)
+        """
+        if len(positions) == 0:
+            return
+        codes = self.user_codes[positions]
+        boundaries = numpy.flatnonzero(codes[1:] != codes[:-1]) + 1
+        for user_positions in numpy.split(positions, boundaries):
+            yield self.users[self.user_codes[user_positions[0]]], user_positions
+
+    def users_of(self, positions):
+        """
+        Returns the users of tracks
+        :param positions: (ndarray) The positions of the tracks in the index arrays
+        :return: (list) The user of each track
+        """
+        return [self.users[code] for code in self.user_codes[positions]]
@@ -0,0 +1,387 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This module keeps a copy of a tracks layer in a local SQLite database, so analyses can query tracks by time,
+    user, and extent without downloading them again on every run.
+    Each sync only pulls the tracks added since the last sync (by object id), removes the tracks that have passed the
+    retention period, and mirrors tracks deleted from the layer (for example by polygon_cleanup_tracks).
+    It can be run as a script to sync the store, or imported to sync and query it.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import sqlite3
+import time
+import traceback
+import sys
+import numpy
+from arcgis.gis import GIS
+from arcgis.features import FeatureLayer
+from instrumentation import add_profile_arguments, profile
+from track_index import SR, ACCURACY_FIELD, CREATOR_FIELD, TIMESTAMP_FIELD, TrackIndex, create_time_clause, query_pages
+
+RETENTION_UNITS_MS = {"HOURS": 3600000, "DAYS": 86400000, "WEEKS": 604800000, "MONTHS": 2592000000, "YEARS": 31536000000}
+
+
+def initialize_logging(log_file=None):
+    """
+    Setup logging
+    :param log_file: (string) The file to log to
+    :return: (Logger) a logging instance
+    """
+    # initialize logging
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(filename)30s:%(lineno)4s - %(funcName)30s()][%(threadName)5s] [%(name)10.10s] [%(levelname)8s] %(message)s")
+    # Grab the root logger
+    logger = logging.getLogger()
+    # Set the root logger logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+    logger.setLevel(logging.DEBUG)
+    # Create a handler to print to the console
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(formatter)
+    sh.setLevel(logging.INFO)
+    # Create a handler to log to the specified file
+    if log_file:
+        rh = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760)
+        rh.setFormatter(formatter)
+        rh.setLevel(logging.DEBUG)
+        logger.addHandler(rh)
+    # Add the handlers to the root logger
+    logger.addHandler(sh)
+    return logger
+
+
+class TrackStore(object):
+    """
+    A local SQLite copy of a tracks layer. The tracks are stored in Web Mercator with epoch millisecond timestamps,
+    indexed by user and time, and by extent with an R-tree when SQLite supports it
+    """
+
+    def __init__(self, path):
+        """
+        :param path: (string) The path of the SQLite database. It is created if it doesn't exist
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(f"""
+            CREATE TABLE IF NOT EXISTS tracks (
+                objectid INTEGER PRIMARY KEY,
+                {CREATOR_FIELD} TEXT,
+                {TIMESTAMP_FIELD} INTEGER,
+                x REAL,
+                y REAL,
+                {ACCURACY_FIELD} REAL,
+                attributes TEXT
+            );
+            CREATE INDEX IF NOT EXISTS tracks_user_time ON tracks ({CREATOR_FIELD}, {TIMESTAMP_FIELD});
+            CREATE INDEX IF NOT EXISTS tracks_time ON tracks ({TIMESTAMP_FIELD});
+            CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        try:
+            self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tracks_rtree USING rtree(id, xmin, xmax, ymin, ymax)")
+            self.has_rtree = True
+        except sqlite3.OperationalError:
+            # SQLite was built without the R-tree module, extent queries filter on the coordinates instead
+            self.has_rtree = False
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def get_state(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def add_features(self, features, object_id_field="objectid"):
+        """
+        Adds (or replaces) track features
+        :param features: (list) The track features, in Web Mercator
+        :param object_id_field: (string) The object id field of the tracks layer
+        """
+        core_fields = {object_id_field, CREATOR_FIELD, TIMESTAMP_FIELD, ACCURACY_FIELD}
+        rows = []
+        for feature in features:
+            attributes = feature.attributes
+            rows.append((attributes[object_id_field], attributes.get(CREATOR_FIELD), attributes.get(TIMESTAMP_FIELD),
+                         feature.geometry["x"], feature.geometry["y"], attributes.get(ACCURACY_FIELD),
+                         json.dumps({name: value for name, value in attributes.items() if name not in core_fields})))
+        self.connection.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        if self.has_rtree:
+            self.connection.executemany("INSERT OR REPLACE INTO tracks_rtree VALUES (?, ?, ?, ?, ?)",
+                                        [(row[0], row[3], row[3], row[4], row[4]) for row in rows])
+
+    def delete(self, object_ids):
+        """
+        Deletes tracks by object id
+        :param object_ids: (list) The object ids to delete
+        """
+        object_ids = [(int(object_id),) for object_id in object_ids]
+        self.connection.executemany("DELETE FROM tracks WHERE objectid = ?", object_ids)
+        if self.has_rtree:
+            self.connection.executemany("DELETE FROM tracks_rtree WHERE id = ?", object_ids)
+
+    def delete_before(self, timestamp):
+        """
+        Deletes the tracks older than a timestamp
+        :param timestamp: (int) The epoch milliseconds
+        :return: (int) The number of tracks deleted
+        """
+        if self.has_rtree:
+            self.connection.execute(f"DELETE FROM tracks_rtree WHERE id IN (SELECT objectid FROM tracks WHERE {TIMESTAMP_FIELD} < ?)", (timestamp,))
+        return self.connection.execute(f"DELETE FROM tracks WHERE {TIMESTAMP_FIELD} < ?", (timestamp,)).rowcount
+
+    def sync(self, tracks_layer, logger, retention=None, page_size=None, reconcile=True, reconcile_chunk_size=100000, max_workers=4):
+        """
+        Brings the store up to date with the tracks layer:
+         1. The tracks past the retention period are removed
+         2. The tracks with an object id greater than the last synced one (the high-water mark) are added, one page at a time
+         3. The tracks deleted from the layer are removed. The store is split into ranges of object ids, and the number
+            of tracks in each range is compared with the layer. Only the ids of ranges that differ are fetched
+        :param tracks_layer: (FeatureLayer) The tracks layer
+        :param logger: (Logger) The logger to use
+        :param retention: (int) The retention period in milliseconds (optional)
+        :param page_size: (int) The number of tracks to request per page. Defaults to (and is capped to) the maxRecordCount of the layer
+        :param reconcile: (bool) Whether to mirror deleted tracks
+        :param reconcile_chunk_size: (int) The number of stored tracks to compare per count request
+        :param max_workers: (int) The number of count requests to send concurrently
+        :return: (dict) The number of tracks added, expired, and deleted
+        """
+        object_id_field = tracks_layer.properties.objectIdField
+        summary = {"added": 0, "expired": 0, "deleted": 0}
+        retention_clause = "1=1"
+        if retention:
+            cutoff = int(time.time() * 1000) - retention
+            summary["expired"] = self.delete_before(cutoff)
+            retention_clause = create_time_clause(datetime.datetime.utcfromtimestamp(cutoff / 1000))
+            self.connection.commit()
+
+        high_water_mark = self.get_state("high_water_mark", 0)
+        for features in query_pages(tracks_layer, f"{object_id_field} > {high_water_mark} AND {retention_clause}", out_sr=SR,
+                                    page_size=page_size, order_by=f"{object_id_field} ASC"):
+            self.add_features(features, object_id_field)
+            high_water_mark = max(feature.attributes[object_id_field] for feature in features)
+            # commit each page with its high-water mark so an interrupted sync resumes where it left off
+            self.set_state("high_water_mark", high_water_mark)
+            self.connection.commit()
+            summary["added"] += len(features)
+            logger.debug(f"Added {summary['added']} tracks, high-water mark {high_water_mark}")
+        logger.info(f"Added {summary['added']} tracks and removed {summary['expired']} expired tracks")
+
+        if reconcile:
+            summary["deleted"] = self.reconcile(tracks_layer, logger, high_water_mark, retention_clause, reconcile_chunk_size, max_workers)
+        self.set_state("last_sync", int(time.time() * 1000))
+        self.connection.commit()
+        return summary
+
+    def reconcile(self, tracks_layer, logger, high_water_mark, retention_clause="1=1", chunk_size=100000, max_workers=4):
+        """
+        Removes the stored tracks that no longer exist in the layer
+        :return: (int) The number of tracks deleted
+        """
+        object_id_field = tracks_layer.properties.objectIdField
+        stored_ids = numpy.array([row[0] for row in self.connection.execute("SELECT objectid FROM tracks ORDER BY objectid")], dtype=numpy.int64)
+        ranges = [(int(stored_ids[i]), int(stored_ids[min(i + chunk_size, len(stored_ids)) - 1]), min(chunk_size, len(stored_ids) - i))
+                  for i in range(0, len(stored_ids), chunk_size)]
+
+        def range_clause(first, last):
+            return f"{object_id_field} >= {first} AND {object_id_field} <= {min(last, high_water_mark)} AND {retention_clause}"
+
+        def find_deleted(first, last, stored_count):
+            remote_count = tracks_layer.query(where=range_clause(first, last), return_count_only=True)
+            if remote_count == stored_count:
+                return []
+            remote_ids = set(tracks_layer.query(where=range_clause(first, last), return_ids_only=True)["objectIds"] or [])
+            local_ids = stored_ids[(stored_ids >= first) & (stored_ids <= last)]
+            return [object_id for object_id in local_ids.tolist() if object_id not in remote_ids]
+
+        deleted = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for object_ids in executor.map(lambda r: find_deleted(*r), ranges):
+                if object_ids:
+                    self.delete(object_ids)
+                    deleted += len(object_ids)
+        self.connection.commit()
+        logger.info(f"Compared {len(ranges)} ranges of object ids and removed {deleted} deleted tracks")
+        return deleted
+
+    def query(self, start=None, end=None, users=None, extent=None, max_accuracy=None, columns=None):
+        """
+        Queries the stored tracks
+        :param start: (int) The start of the time range, epoch ms (inclusive, optional)
+        :param end: (int) The end of the time range, epoch ms (exclusive, optional)
+        :param users: (list) Only return the tracks of these users (optional)
+        :param extent: (tuple) Only return the tracks within this (xmin, ymin, xmax, ymax) envelope, in Web Mercator (optional)
+        :param max_accuracy: (float) Only return tracks with a horizontal accuracy less than or equal to this (optional)
+        :param columns: (list) The columns to return. Defaults to the user, timestamp, x, y, and accuracy
+        :return: (cursor) The rows, sorted by user and time
+        """
+        columns = columns or [CREATOR_FIELD, TIMESTAMP_FIELD, "x", "y", ACCURACY_FIELD]
+        clauses, parameters = [], []
+        if start is not None:
+            clauses.append(f"{TIMESTAMP_FIELD} >= ?")
+            parameters.append(int(start))
+        if end is not None:
+            clauses.append(f"{TIMESTAMP_FIELD} < ?")
+            parameters.append(int(end))
+        if users:
+            clauses.append(f"{CREATOR_FIELD} IN ({','.join('?' * len(users))})")
+            parameters.extend(users)
+        if max_accuracy is not None:
+            clauses.append(f"{ACCURACY_FIELD} <= ?")
+            parameters.append(max_accuracy)
+        if extent:
+            # the R-tree stores rounded coordinates, so the exact coordinates are checked too
+            if self.has_rtree:
+                clauses.append("objectid IN (SELECT id FROM tracks_rtree WHERE xmax >= ? AND xmin <= ? AND ymax >= ? AND ymin <= ?)")
+                parameters.extend([extent[0], extent[2], extent[1], extent[3]])
+            clauses.append("x >= ? AND x <= ? AND y >= ? AND y <= ?")
+            parameters.extend([extent[0], extent[2], extent[1], extent[3]])
+        where = " AND ".join(clauses) or "1=1"
+        return self.connection.execute(f"SELECT {', '.join(columns)} FROM tracks WHERE {where} ORDER BY {CREATOR_FIELD}, {TIMESTAMP_FIELD}",
+                                       parameters)
+
+    def to_track_index(self, start=None, end=None, users=None, extent=None, max_accuracy=None, cell_size=100):
+        """
+        Loads the matching stored tracks into a TrackIndex. See query for the parameters
+        :return: (TrackIndex) The index
+        """
+        rows = self.query(start, end, users, extent, max_accuracy).fetchall()
+        if not rows:
+            return TrackIndex([], [], [], [], [], cell_size=cell_size)
+        users, timestamps, xs, ys, accuracies = zip(*rows)
+        return TrackIndex(users, numpy.array(timestamps, dtype=numpy.int64), xs, ys,
+                          [numpy.nan if accuracy is None else accuracy for accuracy in accuracies], cell_size=cell_size)
+
+
+def get_retention(gis, logger):
+    """
+    Gets the retention period of the location tracking service
+    :return: (int) The retention period in milliseconds, or None if retention is disabled or unknown
+    """
+    try:
+        lt = gis.admin.location_tracking
+        if lt.retention_period_enabled:
+            return int(lt.retention_period) * RETENTION_UNITS_MS[str(lt.retention_period_units).upper()]
+    except Exception as e:
+        logger.warning(f"Could not get the retention period of location tracking: {e}")
+    return None
+
+
+def add_track_store_arguments(parser):
+    """
+    Adds the -track-store argument, which makes a script load its tracks from a synced store instead of the tracks layer
+    :param parser: (ArgumentParser) The parser to add the argument to
+    """
+    parser.add_argument('-track-store', dest='track_store', default=None,
+                        help="Load the tracks from a SQLite track store kept up to date with track_store.py instead of the tracks layer (optional)")
+
+
+def open_track_store(path, logger):
+    """
+    Opens a track store to load tracks from. The store must have been synced at least once
+    :param path: (string) The path of the SQLite database
+    :param logger: (Logger) The logger to use
+    :return: (TrackStore) The store
+    """
+    if not os.path.exists(path):
+        raise Exception(f"Track store not found: {path}. Create it with track_store.py")
+    store = TrackStore(path)
+    last_sync = store.get_state("last_sync")
+    if last_sync is None:
+        store.close()
+        raise Exception(f"Track store {path} has not finished a sync. Sync it with track_store.py")
+    logger.info(f"Loading tracks from {path}, last synced {datetime.datetime.utcfromtimestamp(last_sync / 1000).strftime('%Y-%m-%d %H:%M:%S')} UTC")
+    return store
+
+
+def main(arguments):
+    # initialize logger
+    logger = initialize_logging(arguments.log_file)
+    # Create the GIS
+    logger.info("Authenticating...")
+    # First step is to get authenticate and get a valid token
+    gis = GIS(arguments.org_url,
+              username=arguments.username,
+              password=arguments.password,
+              verify_cert=not arguments.skip_ssl_verification)
+
+    logger.info("Getting tracks layer")
+    if arguments.tracks_layer_url:
+        tracks_layer = FeatureLayer(url=arguments.tracks_layer_url, gis=gis)
+    else:
+        try:
+            tracks_layer = gis.admin.location_tracking.tracks_layer
+        except Exception as e:
+            logger.info(e)
+            logger.info("Getting location tracking service failed - check that you are an admin and that location tracking is enabled for your organization")
+            sys.exit(0)
+
+    retention = arguments.retention_days * 86400000 if arguments.retention_days else get_retention(gis, logger)
+    store = TrackStore(arguments.database)
+    try:
+        summary = store.sync(tracks_layer, logger,
+                             retention=retention,
+                             page_size=arguments.page_size,
+                             reconcile=not arguments.skip_reconcile,
+                             reconcile_chunk_size=arguments.reconcile_chunk_size,
+                             max_workers=arguments.max_workers)
+        logger.info(f"Synced {arguments.database}: {summary['added']} added, {summary['expired']} expired, {summary['deleted']} deleted, "
+                    f"{len(store)} tracks stored")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Sync a local SQLite copy of a tracks layer")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
+    parser.add_argument('-p', dest='password', help="The password to authenticate with", required=True)
+    parser.add_argument('-org', dest='org_url', help="The url of the org/portal to use", required=True)
+    # Parameters for tracker
+    parser.add_argument('-tracks-layer-url', dest='tracks_layer_url', default=None,
+                        help="The tracks layer (either location tracking service or tracks view) you'd like to use. "
+                             "Defaults to the Location Tracking Service tracks layer")
+    parser.add_argument('-database', dest='database', default="tracks.sqlite", help="The SQLite database to sync. Defaults to tracks.sqlite")
+    parser.add_argument('-retention-days', dest='retention_days', type=float, default=None,
+                        help="Remove stored tracks older than this many days. Defaults to the retention period of location tracking")
+    parser.add_argument('-page-size', dest='page_size', type=int, default=None,
+                        help="The number of tracks to request per page. Defaults to the max record count of the tracks layer")
+    parser.add_argument('--skip-reconcile', dest='skip_reconcile', action='store_true',
+                        help="Don't check for tracks that were deleted from the layer, only add new tracks and remove expired ones")
+    parser.add_argument('-reconcile-chunk-size', dest='reconcile_chunk_size', type=int, default=100000,
+                        help="The number of stored tracks to compare with the layer per count request. Defaults to 100000")
+    parser.add_argument('-max-workers', dest='max_workers', type=int, default=4,
+                        help="The number of count requests to send concurrently. Defaults to 4")
+    parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('--skip-ssl-verification',
+                        dest='skip_ssl_verification',
+                        action='store_true',
+                        help="Verify the SSL Certificate of the server")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        with profile(args):
+            main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
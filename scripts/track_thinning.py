@@ -0,0 +1,333 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This module thins dense tracks before they are exported or turned into lines, so the output is much smaller while
+    keeping the shape of each user's movement. The tracks of each user are split into segments at time gaps, then:
+    1. Tracks less accurate than a maximum horizontal accuracy, or without coordinates, are removed
+    2. Stationary clusters (tracks that stay within a radius for a minimum time) are collapsed to their first and last track
+    3. The tracks are decimated so the kept tracks are at least a minimum distance travelled and a minimum time apart
+    4. Each segment is simplified with the Douglas-Peucker algorithm
+    The first and last track of each segment are always kept. The distances and time gaps are computed with NumPy, and
+    the loops only run once per kept track or stationary cluster rather than once per track.
+"""
+import collections
+import threading
+import numpy
+
+EARTH_RADIUS = 6371008.8
+# The stages of the thinning, in order, with the number of tracks remaining after each
+STAGES = ["input", "accuracy", "stationary", "decimation", "simplification"]
+
+
+def add_thinning_arguments(parser):
+    """
+    Adds the thinning arguments to the argument parser of a script
+    :param parser: (ArgumentParser) The parser
+    """
+    parser.add_argument('--thin', dest='thin', action='store_true',
+                        help="If provided, thin the tracks: remove inaccurate tracks, collapse stationary clusters, decimate, and simplify each segment")
+    parser.add_argument('-thin-max-accuracy', dest='thin_max_accuracy', type=float, default=50,
+                        help="Remove tracks with a horizontal accuracy above this many meters when using --thin (0 to keep them). Defaults to 50")
+    parser.add_argument('-thin-stationary-radius', dest='thin_stationary_radius', type=float, default=20,
+                        help="Collapse tracks that stay within this many meters for -thin-stationary-time seconds when using --thin "
+                             "(0 to keep them). Defaults to 20")
+    parser.add_argument('-thin-stationary-time', dest='thin_stationary_time', type=float, default=60,
+                        help="The minimum number of seconds a stationary cluster lasts when using --thin. Defaults to 60")
+    parser.add_argument('-thin-min-distance', dest='thin_min_distance', type=float, default=10,
+                        help="Keep tracks at least this many meters of travel apart when using --thin. Defaults to 10")
+    parser.add_argument('-thin-min-interval', dest='thin_min_interval', type=float, default=5,
+                        help="Keep tracks at least this many seconds apart when using --thin. Defaults to 5")
+    parser.add_argument('-thin-tolerance', dest='thin_tolerance', type=float, default=5,
+                        help="The Douglas-Peucker tolerance in meters when using --thin (0 to skip the simplification). Defaults to 5")
+    parser.add_argument('-thin-max-gap', dest='thin_max_gap', type=float, default=600,
+                        help="Split the tracks of a user into segments at time gaps of more than this many seconds when using --thin. Defaults to 600")
+
+
+def to_meters(xs, ys):
+    """
+    Projects longitudes and latitudes to local meters (equirectangular), which is accurate enough to compare the
+    short distances between consecutive tracks
+    :param xs: (ndarray) The longitudes
+    :param ys: (ndarray) The latitudes
+    :return: (tuple) The x and y coordinates in meters
+    """
+    lats = numpy.radians(ys)
+    return EARTH_RADIUS * numpy.radians(xs) * numpy.cos(lats), EARTH_RADIUS * lats
+
+
+def find_segments(codes, timestamps, max_gap_ms):
+    """
+    Splits tracks sorted by user and time into segments at each new user and at each time gap
+    :param codes: (ndarray) The user code of each track
+    :param timestamps: (ndarray) The timestamp (epoch ms) of each track
+    :param max_gap_ms: (float) The time gap in milliseconds above which a new segment starts
+    :return: (tuple) The start and (exclusive) end position of each segment
+    """
+    breaks = numpy.ones(len(timestamps), dtype=bool)
+    breaks[1:] = (codes[1:] != codes[:-1]) | (numpy.diff(timestamps) > max_gap_ms)
+    starts = numpy.flatnonzero(breaks)
+    return starts, numpy.append(starts[1:], len(timestamps))
+
+
+def _first_outside(xs, ys, anchor, end, radius):
+    """
+    Finds the first track after the anchor that is further than the radius from it, looking ahead in growing windows
+    :return: (int) Its position, or end if every track up to end is within the radius
+    """
+    size = 16
+    start = anchor + 1
+    while start < end:
+        stop = min(start + size, end)
+        outside = numpy.flatnonzero(numpy.hypot(xs[start:stop] - xs[anchor], ys[start:stop] - ys[anchor]) > radius)
+        if len(outside):
+            return start + outside[0]
+        start = stop
+        size *= 2
+    return end
+
+
+def collapse_stationary(xs, ys, timestamps, starts, ends, radius, min_duration_ms):
+    """
+    Finds stationary clusters: tracks that stay within a radius of the first track of the cluster for at least a
+    minimum time. Only runs of tracks whose steps are shorter than the radius are searched
+    :param xs: (ndarray) The x coordinates in meters
+    :param ys: (ndarray) The y coordinates in meters
+    :param timestamps: (ndarray) The timestamp (epoch ms) of each track
+    :param starts: (ndarray) The start position of each segment
+    :param ends: (ndarray) The end position of each segment
+    :param radius: (float) The radius in meters
+    :param min_duration_ms: (float) The minimum duration of a cluster in milliseconds
+    :return: (ndarray) False for the tracks inside a cluster, which are removed, and True for the others
+    """
+    keep = numpy.ones(len(xs), dtype=bool)
+    connected = numpy.zeros(len(xs), dtype=bool)
+    connected[1:] = numpy.hypot(numpy.diff(xs), numpy.diff(ys)) <= radius
+    connected[starts] = False
+    run_starts = numpy.flatnonzero(~connected)
+    run_ends = numpy.append(run_starts[1:], len(xs))
+    for run_start, run_end in zip(run_starts, run_ends):
+        if run_end - run_start < 3 or timestamps[run_end - 1] - timestamps[run_start] < min_duration_ms:
+            continue
+        anchor = run_start
+        while anchor < run_end - 2:
+            end = _first_outside(xs, ys, anchor, run_end, radius)
+            if end - anchor >= 3 and timestamps[end - 1] - timestamps[anchor] >= min_duration_ms:
+                keep[anchor + 1:end - 1] = False
+            anchor = end
+    return keep
+
+
+def decimate(xs, ys, timestamps, starts, ends, min_distance, min_interval_ms):
+    """
+    Keeps the first track of each segment, then each track that is at least a minimum distance travelled (along the
+    track) and a minimum time after the last kept track, and the last track of each segment
+    :param xs: (ndarray) The x coordinates in meters
+    :param ys: (ndarray) The y coordinates in meters
+    :param timestamps: (ndarray) The timestamp (epoch ms) of each track
+    :param starts: (ndarray) The start position of each segment
+    :param ends: (ndarray) The end position of each segment
+    :param min_distance: (float) The minimum distance in meters
+    :param min_interval_ms: (float) The minimum time in milliseconds
+    :return: (ndarray) True for each track that is kept
+    """
+    keep = numpy.zeros(len(xs), dtype=bool)
+    if len(xs) == 0:
+        return keep
+    # The distance travelled and the time since the start of the segment only grow along the arrays, so the next
+    # track to keep after each track is found for all tracks at once with a binary search
+    steps = numpy.zeros(len(xs))
+    steps[1:] = numpy.hypot(numpy.diff(xs), numpy.diff(ys))
+    steps[starts] = 0
+    travelled = numpy.cumsum(steps)
+    segment_lengths = ends - starts
+    elapsed = timestamps - numpy.repeat(timestamps[starts], segment_lengths)
+    elapsed = elapsed + numpy.repeat(numpy.arange(len(starts)) * (elapsed.max() + min_interval_ms + 1), segment_lengths)
+    next_positions = numpy.maximum.reduce([numpy.searchsorted(travelled, travelled + min_distance, side="left"),
+                                           numpy.searchsorted(elapsed, elapsed + min_interval_ms, side="left"),
+                                           numpy.arange(1, len(xs) + 1)]).tolist()
+    # Following the next tracks is a plain Python loop that only runs once per kept track
+    kept = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        position = start
+        while position < end:
+            kept.append(position)
+            position = next_positions[position]
+        kept.append(end - 1)
+    keep[kept] = True
+    return keep
+
+
+def simplify(xs, ys, starts, ends, tolerance):
+    """
+    Simplifies each segment with the Douglas-Peucker algorithm
+    :param xs: (ndarray) The x coordinates in meters
+    :param ys: (ndarray) The y coordinates in meters
+    :param starts: (ndarray) The start position of each segment
+    :param ends: (ndarray) The end position of each segment
+    :param tolerance: (float) The maximum distance in meters between the simplified and the original segment
+    :return: (ndarray) True for each track that is kept
+    """
+    keep = numpy.zeros(len(xs), dtype=bool)
+    keep[starts] = True
+    keep[ends - 1] = True
+    # The ranges of every segment that still need to be split are processed together, one level of the recursion at a time
+    firsts = starts[ends - starts > 2]
+    lasts = ends[ends - starts > 2] - 1
+    while len(firsts):
+        lengths = lasts - firsts - 1
+        offsets = numpy.cumsum(lengths) - lengths
+        range_ids = numpy.repeat(numpy.arange(len(firsts)), lengths)
+        interior = numpy.arange(lengths.sum()) - offsets[range_ids] + firsts[range_ids] + 1
+        first_points = firsts[range_ids]
+        last_points = lasts[range_ids]
+        dx = xs[last_points] - xs[first_points]
+        dy = ys[last_points] - ys[first_points]
+        px = xs[interior] - xs[first_points]
+        py = ys[interior] - ys[first_points]
+        chord = numpy.hypot(dx, dy)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            distances = numpy.where(chord > 0, numpy.abs(dx * py - dy * px) / chord, numpy.hypot(px, py))
+        # The furthest track of each range (the first one if there are several)
+        maxima = numpy.maximum.reduceat(distances, offsets)
+        furthest = numpy.flatnonzero(distances == maxima[range_ids])
+        furthest = furthest[numpy.unique(range_ids[furthest], return_index=True)[1]]
+        split = maxima > tolerance
+        splits = interior[furthest][split]
+        keep[splits] = True
+        firsts, lasts = numpy.concatenate((firsts[split], splits)), numpy.concatenate((splits, lasts[split]))
+        needs_split = lasts - firsts > 1
+        firsts, lasts = firsts[needs_split], lasts[needs_split]
+    return keep
+
+
+class TrackThinner(object):
+    """
+    Thins tracks with a fixed set of parameters, and counts the tracks remaining after each stage over every call,
+    so the reduction of a whole export can be reported
+    """
+
+    def __init__(self, max_accuracy=50, stationary_radius=20, stationary_time=60, min_distance=10, min_interval=5, tolerance=5, max_gap=600):
+        """
+        :param max_accuracy: (float) The maximum horizontal accuracy in meters. None or 0 to keep every track
+        :param stationary_radius: (float) The radius of stationary clusters in meters. None or 0 to keep them
+        :param stationary_time: (float) The minimum duration of stationary clusters in seconds
+        :param min_distance: (float) The minimum distance travelled between kept tracks in meters
+        :param min_interval: (float) The minimum time between kept tracks in seconds
+        :param tolerance: (float) The Douglas-Peucker tolerance in meters. None or 0 to skip the simplification
+        :param max_gap: (float) The time gap in seconds at which the tracks of a user are split into segments
+        """
+        self.max_accuracy = max_accuracy
+        self.stationary_radius = stationary_radius
+        self.stationary_time = stationary_time
+        self.min_distance = min_distance or 0
+        self.min_interval = min_interval or 0
+        self.tolerance = tolerance
+        self.max_gap = max_gap
+        self.counts = collections.OrderedDict((stage, 0) for stage in STAGES)
+        # The same thinner can be used by several threads
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_arguments(cls, arguments):
+        """
+        Creates a thinner from the command line arguments added by add_thinning_arguments
+        :param arguments: (Namespace) The command line arguments
+        :return: (TrackThinner) The thinner, or None if --thin wasn't provided
+        """
+        if not getattr(arguments, "thin", False):
+            return None
+        return cls(arguments.thin_max_accuracy, arguments.thin_stationary_radius, arguments.thin_stationary_time,
+                   arguments.thin_min_distance, arguments.thin_min_interval, arguments.thin_tolerance, arguments.thin_max_gap)
+
+    def thin(self, users, timestamps, xs, ys, accuracies=None, geographic=True):
+        """
+        Thins tracks, which can be in any order
+        :param users: (array-like) The user (or user code) of each track
+        :param timestamps: (array-like) The timestamp (epoch ms) of each track
+        :param xs: (array-like) The x coordinates
+        :param ys: (array-like) The y coordinates
+        :param accuracies: (array-like) The horizontal accuracy of each track (optional). Missing accuracies are NaN
+                           and are removed by the accuracy stage, as are tracks without coordinates (NaN)
+        :param geographic: (bool) True if the coordinates are longitudes and latitudes, False if they are in meters
+        :return: (ndarray) True for each track that is kept, in the order of the input
+        """
+        count = len(timestamps)
+        keep = numpy.zeros(count, dtype=bool)
+        if count == 0:
+            return keep
+        users = numpy.asarray(users)
+        if users.dtype.kind in "iu":
+            codes = users
+        else:
+            _, codes = numpy.unique(users.astype(str), return_inverse=True)
+        timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+        order = numpy.lexsort((timestamps, codes))
+        xs = numpy.asarray(xs, dtype=numpy.float64)[order]
+        ys = numpy.asarray(ys, dtype=numpy.float64)[order]
+        if geographic:
+            xs, ys = to_meters(xs, ys)
+
+        # positions (into the sorted arrays) of the tracks that are left after each stage
+        positions = numpy.flatnonzero(numpy.isfinite(xs) & numpy.isfinite(ys))
+        counts = collections.OrderedDict([("input", count)])
+        if self.max_accuracy and accuracies is not None:
+            with numpy.errstate(invalid="ignore"):
+                positions = positions[numpy.asarray(accuracies, dtype=numpy.float64)[order][positions] <= self.max_accuracy]
+        counts["accuracy"] = len(positions)
+        # The segments are found once, so later stages never join tracks across a gap
+        segment_ids = numpy.zeros(len(positions), dtype=numpy.int64)
+        if len(positions):
+            starts, _ = find_segments(codes[order][positions], timestamps[order][positions], self.max_gap * 1000)
+            segment_ids[starts] = 1
+            segment_ids = numpy.cumsum(segment_ids)
+
+        sorted_timestamps = timestamps[order]
+
+        def apply(stage, enabled, function):
+            # function(xs, ys, timestamps, segment starts, segment ends) returns the tracks to keep
+            nonlocal positions, segment_ids
+            if enabled and len(positions):
+                changes = numpy.ones(len(positions), dtype=bool)
+                changes[1:] = segment_ids[1:] != segment_ids[:-1]
+                starts = numpy.flatnonzero(changes)
+                ends = numpy.append(starts[1:], len(positions))
+                kept = function(xs[positions], ys[positions], sorted_timestamps[positions], starts, ends)
+                positions = positions[kept]
+                segment_ids = segment_ids[kept]
+            counts[stage] = len(positions)
+
+        apply("stationary", self.stationary_radius,
+              lambda x, y, t, starts, ends: collapse_stationary(x, y, t, starts, ends, self.stationary_radius, self.stationary_time * 1000))
+        apply("decimation", self.min_distance or self.min_interval,
+              lambda x, y, t, starts, ends: decimate(x, y, t, starts, ends, self.min_distance, self.min_interval * 1000))
+        apply("simplification", self.tolerance,
+              lambda x, y, t, starts, ends: simplify(x, y, starts, ends, self.tolerance))
+        keep[order[positions]] = True
+        with self._lock:
+            for stage, stage_count in counts.items():
+                self.counts[stage] += stage_count
+        return keep
+
+    @property
+    def reduction_ratio(self):
+        """
+        :return: (float) The number of input tracks per kept track
+        """
+        kept = self.counts["simplification"]
+        return self.counts["input"] / kept if kept else float("inf")
+
+    def summary(self):
+        """
+        :return: (string) The number of tracks remaining after each stage and the reduction ratio
+        """
+        stages = ", ".join(f"{stage} {count}" for stage, count in self.counts.items())
+        return f"Thinned {self.counts['input']} tracks to {self.counts['simplification']} ({self.reduction_ratio:.1f}x reduction): {stages}"
@@ -0,0 +1,73 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This is a single entry point for the scripts, with one subcommand per script. Only the script of the subcommand
+    is imported, so commands that don't need the ArcGIS API for Python (like arcade) start in a fraction of a second.
+    Commands that sign in use a session cache by default, which reuses the sign in token and the location tracking
+    service URLs of previous runs until they expire.
+"""
+import argparse
+import collections
+import importlib
+import logging
+import os
+import sys
+import traceback
+from instrumentation import profile
+
+# The subcommands and the scripts that implement them. Each script has a create_parser and a main function
+COMMANDS = collections.OrderedDict([
+    ("check-edits", ("check_edit_location", "Report features that were edited while the editor was not nearby")),
+    ("mirror-lkl", ("mirror_lkl_layer", "Mirror the last known locations layer into a separate feature service")),
+    ("cleanup", ("polygon_cleanup_tracks", "Delete the tracks inside or outside of polygons")),
+    ("export", ("export_tracks", "Export tracks to CSV or Parquet files")),
+    ("arcade", ("generate_users_arcade_expression", "Generate an Arcade expression from a CSV file of users")),
+])
+SESSION_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".tracker-scripts", "session_cache.json")
+
+
+def create_parser():
+    """
+    Creates the parser of the command line arguments
+    :return: (ArgumentParser) The parser
+    """
+    commands = "\n".join(f"  {name:<14}{description}" for name, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(prog="tracker.py",
+                                     description="Runs the location tracking scripts",
+                                     epilog=f"commands:\n{commands}\n\nUse tracker.py <command> -h to list the arguments of a command",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=list(COMMANDS), metavar='command', help="The command to run")
+    parser.add_argument('arguments', nargs=argparse.REMAINDER, help="The arguments of the command")
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    module_name, _ = COMMANDS[args.command]
+    # Import the script only now, so other commands don't pay for its imports
+    script = importlib.import_module(module_name)
+    command_parser = script.create_parser()
+    command_parser.prog = f"tracker.py {args.command}"
+    # Scripts that sign in cache their session unless -session-cache or --no-session-cache says otherwise
+    command_parser.set_defaults(session_cache=os.environ.get("TRACKER_SESSION_CACHE", SESSION_CACHE_FILE))
+    command_args = command_parser.parse_args(args.arguments)
+    try:
+        with profile(command_args):
+            script.main(command_args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,301 @@
+"""
+   Copyright 2021 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.​
+
+    This sample reports the status of location tracking in an organization as JSON, for example for a monitoring
+    dashboard that polls it every minute. It reports the same details as the "Location Tracking Status" notebook.
+    The queries run concurrently, the slow all-time statistics are cached for a configurable time, and the last
+    7 days are summed from cached daily counts so only today's tracks are counted on each run.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import time
+import traceback
+import sys
+from arcgis.gis import GIS
+from instrumentation import add_profile_arguments, profile
+from track_index import CREATOR_FIELD, create_time_clause
+
+TRACK_VIEW_QUERY = "typekeywords:'Location Tracking View'"
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def initialize_logging(log_file=None):
+    """
+    Setup logging
+    :param log_file: (string) The file to log to
+    :return: (Logger) a logging instance
+    """
+    # initialize logging
+    formatter = logging.Formatter(
+        "[%(asctime)s] [%(filename)30s:%(lineno)4s - %(funcName)30s()][%(threadName)5s] [%(name)10.10s] [%(levelname)8s] %(message)s")
+    # Grab the root logger
+    logger = logging.getLogger()
+    # Set the root logger logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
+    logger.setLevel(logging.DEBUG)
+    # Create a handler to print to the console. stdout is reserved for the JSON report
+    sh = logging.StreamHandler(sys.stderr)
+    sh.setFormatter(formatter)
+    sh.setLevel(logging.INFO)
+    # Create a handler to log to the specified file
+    if log_file:
+        rh = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=10485760)
+        rh.setFormatter(formatter)
+        rh.setLevel(logging.DEBUG)
+        logger.addHandler(rh)
+    # Add the handlers to the root logger
+    logger.addHandler(sh)
+    return logger
+
+
+def load_cache(cache_file):
+    """
+    Loads the cached statistics from a JSON file
+    :param cache_file: (string) The path of the cache file
+    :return: (dict) The cache, or an empty cache if the file does not exist yet
+    """
+    if not os.path.exists(cache_file):
+        return {"all_time": None, "daily": {}}
+    with open(cache_file) as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    """
+    Saves the cache or the report to a JSON file. The file is replaced atomically so readers never see a partial file
+    :param path: (string) The path of the file
+    :param data: (dict) The data to save
+    """
+    temp_file = f"{path}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_file, path)
+
+
+def count_per_user(tracks_layer, where="1=1"):
+    """
+    Counts the tracks of each user with a single grouped statistics query
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :param where: (string) The where clause
+    :return: (dict) The number of tracks of each user
+    """
+    features = tracks_layer.query(where=where,
+                                  group_by_fields_for_statistics=CREATOR_FIELD,
+                                  out_statistics=[{"statisticType": "count", "onStatisticField": "objectid", "outStatisticFieldName": "count"}]).features
+    return {feature.attributes[CREATOR_FIELD]: feature.attributes["count"] for feature in features}
+
+
+def count_day(tracks_layer, day):
+    """
+    Counts the tracks of each user on a UTC day
+    :param tracks_layer: (FeatureLayer) The tracks layer
+    :param day: (datetime.date) The day
+    :return: (dict) The number of tracks of each user
+    """
+    start = datetime.datetime(day.year, day.month, day.day)
+    return count_per_user(tracks_layer, create_time_clause(start, start + datetime.timedelta(days=1)))
+
+
+def get_status(lt):
+    """
+    Gets the status and retention period of location tracking
+    :param lt: (LocationTrackingManager) The location tracking manager of the org
+    :return: (dict) The status and retention period settings
+    """
+    return {
+        "status": lt.status,
+        "retention_period": lt.retention_period,
+        "retention_period_units": lt.retention_period_units,
+        "retention_period_enabled": lt.retention_period_enabled,
+    }
+
+
+def get_licenses(gis):
+    """
+    Gets the Tracker license report
+    :param gis: (GIS) The GIS
+    :return: (list) The license report records
+    """
+    report = gis.admin.license.get('Tracker for ArcGIS').report
+    return json.loads(report.to_json(orient="records")) if hasattr(report, "to_json") else report
+
+
+def top_users(counts, top):
+    """
+    Gets the users with the most tracks
+    :param counts: (dict) The number of tracks of each user
+    :param top: (int) The number of users to return
+    :return: (list) The user and count of the top users, most tracks first (ties by user name)
+    """
+    return [{"user": user, "count": count} for user, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:top]]
+
+
+def is_complete(day, fetched, late_upload_hours):
+    """
+    Checks whether the counts of a UTC day are final, because they were counted after the late uploads of the day
+    :param day: (datetime.date) The day
+    :param fetched: (float) The time the day was counted (epoch seconds)
+    :param late_upload_hours: (float) The number of hours after a day ends that its tracks are still expected to be uploaded
+    :return: (bool) True if the day never needs to be counted again
+    """
+    day_end = datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc) + datetime.timedelta(days=1)
+    return fetched >= day_end.timestamp() + late_upload_hours * 3600
+
+
+def create_report(gis, cache, logger, all_time_ttl=3600, days=7, top=5, max_workers=6, now=None, late_upload_hours=48):
+    """
+    Creates the status report, running the queries concurrently and updating the cache.
+    The all-time statistics are reused until they are older than the TTL. Tracker uploads the tracks recorded offline
+    when the device reconnects, so a previous day is recounted on the all-time TTL until it has been counted
+    late_upload_hours after it ended. Then it is complete and kept in the cache, so only today is counted on every run
+    :param gis: (GIS) The GIS
+    :param cache: (dict) The cache, as returned by load_cache. It is updated in place
+    :param logger: (Logger) The logger to use
+    :param all_time_ttl: (int) The number of seconds to cache the all-time statistics for
+    :param days: (int) The number of days, including today, to report the per user counts of
+    :param top: (int) The number of top users to report
+    :param max_workers: (int) The number of queries to run concurrently
+    :param now: (float) The current time (epoch seconds). Defaults to the current time
+    :param late_upload_hours: (float) The number of hours after a day ends that its tracks are still expected to be uploaded
+    :return: (dict) The report
+    """
+    now = now or time.time()
+    today = datetime.datetime.utcfromtimestamp(now).date()
+    window = [today - datetime.timedelta(days=n) for n in range(days - 1, -1, -1)]
+    lt = gis.admin.location_tracking
+    tracks_layer = lt.tracks_layer
+
+    tasks = {
+        "location_tracking": lambda: get_status(lt),
+        "licenses": lambda: get_licenses(gis),
+        "total_tracks": lambda: tracks_layer.query(return_count_only=True),
+        "track_views": lambda: len(gis.content.search(TRACK_VIEW_QUERY, max_items=10000)),
+    }
+    all_time = cache.get("all_time")
+    if not all_time or now - all_time["fetched"] >= all_time_ttl:
+        tasks["all_time"] = lambda: count_per_user(tracks_layer)
+    for day in window:
+        cached = cache["daily"].get(day.strftime(DATE_FORMAT))
+        if day == today or not cached or (not is_complete(day, cached["fetched"], late_upload_hours) and now - cached["fetched"] >= all_time_ttl):
+            tasks[day.strftime(DATE_FORMAT)] = functools.partial(count_day, tracks_layer, day)
+
+    results = {}
+    errors = {}
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(task): name for name, task in tasks.items()}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logger.warning(f"Getting {name} failed: {e}")
+                errors[name] = str(e)
+    logger.info(f"Ran {len(tasks)} queries in {time.time() - start_time:.1f} seconds")
+
+    if "all_time" in results:
+        cache["all_time"] = {"fetched": now, "users": results["all_time"]}
+    for day in window:
+        name = day.strftime(DATE_FORMAT)
+        if name in results:
+            cache["daily"][name] = {"fetched": now, "users": results[name]}
+    cache["daily"] = {name: value for name, value in cache["daily"].items() if name >= window[0].strftime(DATE_FORMAT)}
+
+    recent = {}
+    daily_tracks = {}
+    for day in window:
+        users = cache["daily"].get(day.strftime(DATE_FORMAT), {}).get("users", {})
+        daily_tracks[day.strftime(DATE_FORMAT)] = sum(users.values())
+        for user, count in users.items():
+            recent[user] = recent.get(user, 0) + count
+    all_time_users = (cache.get("all_time") or {}).get("users", {})
+    return {
+        "generated": datetime.datetime.utcfromtimestamp(now).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "location_tracking": results.get("location_tracking"),
+        "licenses": results.get("licenses"),
+        "total_tracks": results.get("total_tracks"),
+        "track_views": results.get("track_views"),
+        "users": len(all_time_users),
+        "top_users": top_users(all_time_users, top),
+        "all_time_age_seconds": round(now - cache["all_time"]["fetched"]) if cache.get("all_time") else None,
+        f"users_last_{days}_days": len(recent),
+        f"top_users_last_{days}_days": top_users(recent, top),
+        "daily_tracks": daily_tracks,
+        "errors": errors,
+    }
+
+
+def main(arguments):
+    # initialize logger
+    logger = initialize_logging(arguments.log_file)
+    # Create the GIS
+    logger.info("Authenticating...")
+    # First step is to get authenticate and get a valid token
+    gis = GIS(arguments.org_url,
+              username=arguments.username,
+              password=arguments.password,
+              verify_cert=not arguments.skip_ssl_verification)
+    cache = load_cache(arguments.cache_file)
+    report = create_report(gis, cache, logger,
+                           all_time_ttl=arguments.all_time_ttl * 60,
+                           days=arguments.days,
+                           top=arguments.top,
+                           max_workers=arguments.max_workers,
+                           late_upload_hours=arguments.late_upload_hours)
+    save_json(arguments.cache_file, cache)
+    if arguments.output_file:
+        save_json(arguments.output_file, report)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    # Get all of the commandline arguments
+    parser = argparse.ArgumentParser("Report the status of location tracking as JSON")
+    parser.add_argument('-u', dest='username', help="The username to authenticate with", required=True)
+    parser.add_argument('-p', dest='password', help="The password to authenticate with", required=True)
+    parser.add_argument('-org', dest='org_url', help="The url of the org/portal to use", required=True)
+    # Parameters for the report
+    parser.add_argument('-cache-file', dest='cache_file', default="tracking_status_cache.json",
+                        help="The file used to cache the statistics between runs. Defaults to tracking_status_cache.json")
+    parser.add_argument('-all-time-ttl', dest='all_time_ttl', type=float, default=60,
+                        help="The number of minutes to reuse the all-time per user statistics for. Defaults to 60")
+    parser.add_argument('-days', dest='days', type=int, default=7,
+                        help="The number of days, including today (UTC), to report the active users of. Defaults to 7")
+    parser.add_argument('-late-upload-hours', dest='late_upload_hours', type=float, default=48,
+                        help="The number of hours after a day ends that tracks recorded offline are still expected to be uploaded. "
+                             "Until then the day is recounted every -all-time-ttl minutes. Defaults to 48")
+    parser.add_argument('-top', dest='top', type=int, default=5, help="The number of top users to report. Defaults to 5")
+    parser.add_argument('-max-workers', dest='max_workers', type=int, default=6, help="The number of queries to run concurrently. Defaults to 6")
+    parser.add_argument('-output-file', dest='output_file', default=None,
+                        help="The file to write the JSON report to. It is replaced atomically. Defaults to printing the report")
+    parser.add_argument('-log-file', dest='log_file', help="The log file to write to (optional)")
+    parser.add_argument('--skip-ssl-verification',
+                        dest='skip_ssl_verification',
+                        action='store_true',
+                        help="Verify the SSL Certificate of the server")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        with profile(args):
+            main(args)
+    except Exception as e:
+        logging.getLogger().critical("Exception detected, script exiting")
+        logging.getLogger().critical(e)
+        logging.getLogger().critical(traceback.format_exc().replace("\n", " | "))
+        sys.exit(1)